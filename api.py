@@ -0,0 +1,314 @@
+"""Versioned JSON API, under /api/v1.
+
+Endpoints (all GET):
+
+- /timeline: the logged-in user's home timeline
+- /users/<id>: a profile
+- /users/<id>/messages: a user's messages, newest first
+- /users/<id>/following, /users/<id>/followers: users, by id
+- /users/<id>/likes: messages a user liked, most recently liked first
+- /search/users?q=, /search/messages?q=: search results, best first
+- /suggestions: users the logged-in user might follow
+- /trending: trending hashtags and messages
+
+Lists are pages of PAGE_SIZE, as {"messages": [...], "next": cursor} (or
+"users"); pass `?cursor=` the "next" of a page for the page after it.
+"next" is null on the last page. `?fields=id,text` picks which fields
+of each message (or user) to include; see MESSAGE_FIELDS and USER_FIELDS.
+Errors are {"error": message}, with a 4xx status.
+
+Responses are built with serializers compiled once per set of fields
+(see `Serializer`), and encoded with orjson when it's installed.
+"""
+
+import json
+
+from flask import Blueprint, current_app, g, request
+
+import graph
+import message_search
+import queries
+import search
+import timelines
+import trending
+from models import User, Follows, Likes
+from pagination import (PAGE_SIZE, decode_cursor, decode_rank_cursor,
+                        next_cursor)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+class ApiError(Exception):
+    """An error to answer with {"error": message} and `status`."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@api.errorhandler(ApiError)
+def api_error(error):
+    return json_response({"error": error.message}, error.status)
+
+
+@api.errorhandler(404)
+def not_found(error):
+    return json_response({"error": "Not found."}, 404)
+
+
+def dumps(data):
+    """Encode `data` as JSON bytes."""
+
+    if orjson is not None:
+        return orjson.dumps(data)
+
+    return json.dumps(data, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def json_response(data, status=200):
+    return current_app.response_class(dumps(data), status=status,
+                                      mimetype='application/json')
+
+
+##############################################################################
+# Serializers
+
+
+class Serializer:
+    """Turns objects into dicts of some of `fields`.
+
+    `fields` maps each field name to a Python expression of `obj` giving
+    its value. For each set of fields asked for, the expressions are
+    compiled once into a single function returning a dict literal, so
+    serializing a row is one call, with no per-field lookups or loops.
+    """
+
+    def __init__(self, fields, default=None):
+        self.fields = fields
+        self.default = tuple(default or fields)
+        self._compiled = {}
+
+    def names_from(self, param):
+        """The field names listed in a `?fields=` value (None: default).
+
+        Repeats are dropped and the names put in the order of `fields`, so
+        every spelling of the same set shares one compiled function.
+        """
+
+        if not param:
+            return self.default
+
+        names = {name.strip() for name in param.split(',') if name.strip()}
+        unknown = sorted(names.difference(self.fields))
+        if unknown:
+            raise ApiError(f"Unknown fields: {', '.join(unknown)}.")
+
+        ordered = tuple(name for name in self.fields if name in names)
+        return ordered or self.default
+
+    def compile(self, names):
+        """Return the function serializing `names` (compiled on first use)."""
+
+        function = self._compiled.get(names)
+        if function is None:
+            items = ', '.join(f"{name!r}: {self.fields[name]}"
+                              for name in names)
+            namespace = {}
+            exec(f"def serialize(obj):\n    return {{{items}}}\n", namespace)
+            function = self._compiled[names] = namespace['serialize']
+
+        return function
+
+    def many(self, objs, names):
+        serialize = self.compile(names)
+        return [serialize(obj) for obj in objs]
+
+
+# Timestamps are naive UTC datetimes
+MESSAGE_FIELDS = Serializer({
+    'id': "obj.id",
+    'text': "obj.text",
+    'timestamp': "obj.timestamp.isoformat() + 'Z'",
+    'user_id': "obj.user_id",
+    'user_username': "obj.user.username",
+    'user_image_url': "obj.user.image_url",
+})
+
+USER_FIELDS = Serializer({
+    'id': "obj.id",
+    'username': "obj.username",
+    'image_url': "obj.image_url",
+    'header_image_url': "obj.header_image_url",
+    'bio': "obj.bio",
+    'location': "obj.location",
+    'messages_count': "obj.messages_count",
+    'following_count': "obj.following_count",
+    'followers_count': "obj.followers_count",
+    'likes_count': "obj.likes_count",
+})
+
+# Fields of users in lists (what the HTML lists show), unless asked for
+USER_LIST_FIELDS = ('id', 'username', 'image_url', 'bio')
+
+
+def message_page(messages, cursor):
+    names = MESSAGE_FIELDS.names_from(request.args.get('fields'))
+    return json_response({"messages": MESSAGE_FIELDS.many(messages, names),
+                          "next": cursor})
+
+
+def user_page(users, cursor):
+    param = request.args.get('fields')
+    names = (USER_FIELDS.names_from(param) if param else USER_LIST_FIELDS)
+    return json_response({"users": USER_FIELDS.many(users, names),
+                          "next": cursor})
+
+
+def require_login():
+    if not g.user:
+        raise ApiError("Access unauthorized.", 401)
+
+
+def id_cursor(param='cursor'):
+    """Decode an id cursor (None: from the start)."""
+
+    try:
+        return int(request.args.get(param, ''))
+    except ValueError:
+        return None
+
+
+##############################################################################
+# Endpoints
+
+
+@api.route('/timeline')
+def timeline():
+    require_login()
+
+    messages = timelines.read_timeline(
+        g.user.id, position=decode_cursor(request.args.get('cursor')))
+
+    return message_page(messages, next_cursor(messages))
+
+
+@api.route('/users/<int:user_id>')
+def profile(user_id):
+    user = User.get_active_or_404(user_id)
+    names = USER_FIELDS.names_from(request.args.get('fields'))
+
+    return json_response({"user": USER_FIELDS.compile(names)(user)})
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    User.get_active_or_404(user_id)
+
+    messages = queries.author_messages(
+        user_id, decode_cursor(request.args.get('cursor'))).all()
+
+    return message_page(messages, next_cursor(messages))
+
+
+def follow_page(user_id, key, other):
+    """Page of users joined on `other` where `key` is `user_id`, by id."""
+
+    require_login()
+    User.get_active_or_404(user_id)
+
+    query = (User.query
+                 .join(Follows, other == User.id)
+                 .filter(key == user_id, User.deleted_at.is_(None))
+                 .order_by(other))
+
+    after = id_cursor()
+    if after is not None:
+        query = query.filter(other > after)
+
+    users = query.limit(PAGE_SIZE).all()
+    cursor = str(users[-1].id) if len(users) == PAGE_SIZE else None
+
+    return user_page(users, cursor)
+
+
+@api.route('/users/<int:user_id>/following')
+def following(user_id):
+    return follow_page(user_id, Follows.user_following_id,
+                       Follows.user_being_followed_id)
+
+
+@api.route('/users/<int:user_id>/followers')
+def followers(user_id):
+    return follow_page(user_id, Follows.user_being_followed_id,
+                       Follows.user_following_id)
+
+
+@api.route('/users/<int:user_id>/likes')
+def likes(user_id):
+    require_login()
+    User.get_active_or_404(user_id)
+
+    query = queries.liked_messages(user_id).add_columns(Likes.id)
+
+    before = id_cursor()
+    if before is not None:
+        query = query.filter(Likes.id < before)
+
+    rows = query.limit(PAGE_SIZE).all()
+    cursor = str(rows[-1][1]) if len(rows) == PAGE_SIZE else None
+
+    return message_page([message for message, _ in rows], cursor)
+
+
+@api.route('/suggestions')
+def suggestions():
+    """Users the logged-in user might follow (see graph.py).
+
+    Empty until this process has built its follow graph, rather than
+    holding the request for the build.
+    """
+
+    require_login()
+    return user_page(graph.suggestions(g.user.id, PAGE_SIZE), None)
+
+
+@api.route('/trending')
+def trending_now():
+    """Trending hashtags (with their decayed counts) and messages."""
+
+    names = MESSAGE_FIELDS.names_from(request.args.get('fields'))
+
+    return json_response({
+        "hashtags": [{"tag": tag, "score": round(score, 3)}
+                     for tag, score in trending.top_hashtags(PAGE_SIZE)],
+        "messages": MESSAGE_FIELDS.many(trending.top_messages(PAGE_SIZE),
+                                        names),
+    })
+
+
+@api.route('/search/users')
+def search_users():
+    page = id_cursor() or 1
+    users = search.search_users(request.args.get('q', '').strip(), page)
+
+    cursor = None
+    if len(users) == search.SEARCH_PAGE_SIZE and page < search.MAX_SEARCH_PAGE:
+        cursor = str(page + 1)
+
+    return user_page(users, cursor)
+
+
+@api.route('/search/messages')
+def search_messages():
+    messages, cursor = message_search.search_messages(
+        request.args.get('q', '').strip(),
+        decode_rank_cursor(request.args.get('cursor')))
+
+    return message_page(messages, cursor)
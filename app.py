@@ -1,12 +1,36 @@
 import os
+import time
 
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
+from flask import (Flask, Response, render_template, request, flash,
+                   redirect, session, g, jsonify)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
+from werkzeug.local import LocalProxy
 
+from api import api
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Follows, Likes
+from models import (db, connect_db, create_missing_indexes,
+                    User, Message, Follows)
+import counters
+import deletion
+import graph
+import http_cache
+import live
+import message_likes
+import message_search
+import passwords
+import queries
+import search
+import timelines
+import trending
+from pagination import decode_cursor, decode_rank_cursor, next_cursor
 from jinja2.exceptions import UndefinedError
+from fragments import FragmentCache, SqliteFragmentStore
+from instrumentation import Instrumentation
+from jobs import JobRunner, MemoryQueue, SqliteQueue
+from ratelimit import (RateLimiter, MemoryBackend, SqliteBackend,
+                       FailedLoginCache)
+from user_cache import UserCache
 CURR_USER_KEY = "curr_user"
 
 app = Flask(__name__)
@@ -20,10 +44,124 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Users with more followers than this have their messages merged into
+# followers' feeds at read time instead of being fanned out on write.
+app.config['TIMELINE_FANOUT_THRESHOLD'] = int(
+    os.environ.get('TIMELINE_FANOUT_THRESHOLD', 10000))
+
+# Request metrics (see instrumentation.py)
+app.config['SERVER_TIMING'] = bool(os.environ.get('SERVER_TIMING'))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# Seconds to cache logged-in users' profile rows in process (0 = off)
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 0))
+
+# bcrypt work factor for new password hashes, and the number of processes
+# hashing them per web worker (0 = hash on the request thread; by default
+# the host's cores are split between the WEB_CONCURRENCY web workers; see
+# passwords.py)
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', passwords.default_workers()))
+
+# Login/signup attempts allowed per client IP, and failed logins allowed
+# per username: a burst, then so many per minute (0 = just the burst). Set
+# LOGIN_RATE_LIMIT_DB to a file path to share the counts between the
+# workers on a host (see ratelimit.py).
+app.config['LOGIN_IP_BURST'] = int(os.environ.get('LOGIN_IP_BURST', 20))
+app.config['LOGIN_IP_PER_MINUTE'] = int(
+    os.environ.get('LOGIN_IP_PER_MINUTE', 10))
+app.config['LOGIN_USER_BURST'] = int(os.environ.get('LOGIN_USER_BURST', 10))
+app.config['LOGIN_USER_PER_MINUTE'] = int(
+    os.environ.get('LOGIN_USER_PER_MINUTE', 5))
+app.config['LOGIN_RATE_LIMIT_DB'] = os.environ.get('LOGIN_RATE_LIMIT_DB')
+
+# Proxies in front of the app that append the client's address to
+# X-Forwarded-For (Heroku's router is one). Client IPs are read from the
+# entry the outermost of them added, since anything before it is up to
+# the client; 0 uses the connection's address (no proxy).
+app.config['TRUSTED_PROXY_HOPS'] = int(
+    os.environ.get('TRUSTED_PROXY_HOPS', 1))
+
+# Rendered message list items kept per process, and optionally in a SQLite
+# file shared by the workers on a host (see fragments.py)
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_DB'] = os.environ.get('FRAGMENT_CACHE_DB')
+
+# The in-memory follow graph behind "who to follow" (see graph.py): built
+# in the background at startup if FOLLOW_GRAPH_PRELOAD is set (else on
+# first use), and rebuilt every FOLLOW_GRAPH_TTL seconds
+app.config['FOLLOW_GRAPH_PRELOAD'] = bool(
+    os.environ.get('FOLLOW_GRAPH_PRELOAD'))
+app.config['FOLLOW_GRAPH_TTL'] = int(os.environ.get('FOLLOW_GRAPH_TTL', 3600))
+
+# Background jobs (see jobs.py): worker threads per process (0 = run each
+# job on the request thread), and the most jobs waiting. Queued jobs are
+# kept in the JOB_QUEUE_DB file across restarts, shared by the workers on
+# a host; set it empty to keep them in process memory instead.
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_QUEUE_SIZE'] = int(os.environ.get('JOB_QUEUE_SIZE', 10000))
+app.config['JOB_QUEUE_DB'] = os.environ.get('JOB_QUEUE_DB', 'jobs.db')
+
+# Deleted accounts are purged in batches of PURGE_BATCH_SIZE rows, at most
+# PURGE_ROWS_PER_SECOND (see deletion.py)
+app.config['PURGE_BATCH_SIZE'] = int(os.environ.get('PURGE_BATCH_SIZE', 1000))
+app.config['PURGE_ROWS_PER_SECOND'] = int(
+    os.environ.get('PURGE_ROWS_PER_SECOND', 20000))
+
+# Live homepage updates (see live.py): streams open at once per process
+# (each holds a worker thread), and seconds before a stream is ended and
+# the client reconnects. Set LIVE_SOCKET_DIR to a directory to relay new
+# messages between the worker processes on a host.
+app.config['LIVE_MAX_STREAMS'] = int(os.environ.get('LIVE_MAX_STREAMS', 48))
+app.config['LIVE_STREAM_TIMEOUT'] = int(
+    os.environ.get('LIVE_STREAM_TIMEOUT', live.STREAM_TIMEOUT))
+app.config['LIVE_SOCKET_DIR'] = os.environ.get('LIVE_SOCKET_DIR')
+
+# Users suggested in the homepage's "who to follow"
+SUGGESTIONS = 5
+
+# Hashtags and warbles shown on /trending
+TRENDING_HASHTAGS = 10
+TRENDING_MESSAGES = 10
+
 toolbar = DebugToolbarExtension(app)
+app.jinja_env.globals['static_url'] = http_cache.static_url
+app.register_blueprint(api)
+instrumentation = Instrumentation(app)
 
 connect_db(app)
 
+if app.config['FOLLOW_GRAPH_PRELOAD']:
+    graph.refresh_in_background(app)
+
+user_cache = UserCache(ttl=app.config['USER_CACHE_TTL'])
+
+login_limiter = RateLimiter(
+    SqliteBackend(app.config['LOGIN_RATE_LIMIT_DB'])
+    if app.config['LOGIN_RATE_LIMIT_DB'] else MemoryBackend())
+failed_logins = FailedLoginCache(app.config['SECRET_KEY'])
+
+message_fragments = FragmentCache(
+    'messages/_item.html',
+    maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+    store=(SqliteFragmentStore(app.config['FRAGMENT_CACHE_DB'])
+           if app.config['FRAGMENT_CACHE_DB'] else None))
+
+live_updates = live.Broker(relay_dir=app.config['LIVE_SOCKET_DIR'])
+
+background_jobs = JobRunner(
+    app,
+    SqliteQueue(app.config['JOB_QUEUE_DB'])
+    if app.config['JOB_QUEUE_DB'] else MemoryQueue())
+
+# Start the job workers once a (forked) worker process starts serving, to
+# run jobs left queued before a restart; gunicorn.conf.py starts them as
+# soon as each gunicorn worker has loaded the app
+app.before_first_request(background_jobs.start)
+
 
 def serialize_message(message):
     """Serialize a message SQLAlchemy obj to dictionary."""
@@ -38,21 +176,124 @@ def serialize_message(message):
     }
 
 
+def serialize_page(messages):
+    """Serialize a page of messages, plus the ids of those the logged-in
+    user likes and the cursor for the next page.
+    """
+
+    return {
+        "messages": [serialize_message(message) for message in messages],
+        "liked": sorted(liked_ids_among(messages)),
+        "next": next_cursor(messages),
+    }
+
+
 ##############################################################################
 # User signup/login/logout
 
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    The user is only loaded the first time `g.user` is used, so requests
+    that never look at it don't pay for the query.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = LocalProxy(load_curr_user)
 
     else:
         g.user = None
 
 
+def load_curr_user():
+    """Load the logged-in user (once per request), or None if deleted."""
+
+    if '_curr_user' not in g:
+        user = user_cache.get(int(session[CURR_USER_KEY]))
+        g._curr_user = user if user and user.deleted_at is None else None
+
+    return g._curr_user
+
+
+def following_ids_among(users):
+    """Ids of those `users` the logged-in user follows (one query)."""
+
+    if not g.user:
+        return set()
+
+    return g.user.following_ids_among(user.id for user in users)
+
+
+def liked_ids_among(messages):
+    """Ids of those `messages` the logged-in user likes (one query)."""
+
+    if not g.user:
+        return set()
+
+    return g.user.liked_ids_among(message.id for message in messages)
+
+
+def client_ip():
+    """The client's address, as seen by the trusted proxies, if any."""
+
+    hops = app.config['TRUSTED_PROXY_HOPS']
+    forwarded = [address.strip() for address
+                 in request.headers.get('X-Forwarded-For', '').split(',')
+                 if address.strip()]
+
+    # not (or not all the way) through the proxies: use the connection's
+    if not hops or len(forwarded) < hops:
+        return request.remote_addr
+
+    return forwarded[-hops]
+
+
+def take_ip_attempt(action):
+    """Take a login/signup attempt from the client IP's bucket."""
+
+    return login_limiter.take(f"{action}-ip:{client_ip()}",
+                              rate=app.config['LOGIN_IP_PER_MINUTE'] / 60,
+                              burst=app.config['LOGIN_IP_BURST'])
+
+
+def username_attempts_left(username, failed=False):
+    """Has `username` failed logins to spare? `failed` uses one up."""
+
+    return login_limiter.take(f"login-user:{username}",
+                              rate=app.config['LOGIN_USER_PER_MINUTE'] / 60,
+                              burst=app.config['LOGIN_USER_BURST'],
+                              cost=1 if failed else 0)
+
+
+def check_password_attempt(username, password):
+    """Authenticate, unless the attempt can be refused without bcrypt.
+
+    Returns the user, False for wrong credentials, or None when too many
+    attempts were made.
+    """
+
+    if not username_attempts_left(username):
+        return None
+
+    if (username, password) in failed_logins:
+        return False
+
+    user = User.authenticate(username, password)
+    if not user:
+        failed_logins.add(username, password)
+        username_attempts_left(username, failed=True)
+
+    return user
+
+
+def too_many_attempts(template, form):
+    flash("Too many attempts. Please wait a minute and try again.",
+          'danger')
+    return render_template(template, form=form), 429, {'Retry-After': '60'}
+
+
 def do_login(user):
     """Log in user."""
 
@@ -81,6 +322,9 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        if not take_ip_attempt('signup'):
+            return too_many_attempts('users/signup.html', form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -89,6 +333,8 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            search.user_saved(user)
+            failed_logins.discard(user.username, form.password.data)
 
         except IntegrityError:
             flash("Username already taken", 'danger')
@@ -109,10 +355,18 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        # Refuse floods before spending any bcrypt time on them
+        if not take_ip_attempt('login'):
+            return too_many_attempts('users/login.html', form)
+
+        user = check_password_attempt(form.username.data,
+                                      form.password.data)
+        if user is None:
+            return too_many_attempts('users/login.html', form)
 
         if user:
+            # saves the password hash if authenticate() upgraded it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -139,34 +393,106 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and a
+    'page' param for further pages of results.
     """
 
-    search = request.args.get('q')
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = search.search_users(query, page)
+
+    return render_template('users/index.html',
+                           users=users,
+                           following_ids=following_ids_among(users),
+                           query=query,
+                           page=page,
+                           has_next_page=(len(users) == search.SEARCH_PAGE_SIZE
+                                          and page < search.MAX_SEARCH_PAGE))
+
+
+@app.route('/users/typeahead')
+def users_typeahead():
+    """JSON list of users whose username starts with the 'q' param."""
+
+    users = search.typeahead(request.args.get('q', '').strip())
 
-    return render_template('users/index.html', users=users)
+    return jsonify([{"id": user.id,
+                     "username": user.username,
+                     "image_url": user.image_url} for user in users])
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.get_active_or_404(user_id)
+
+    position = decode_cursor(request.args.get('before'))
+    response = http_cache.conditional(profile_etag(user, position))
+    if response is not None:
+        return response
+
+    messages = user_messages_page(user_id)
+
+    return render_template('users/show.html',
+                           user=user,
+                           messages=messages,
+                           fragments=message_fragments.render(messages),
+                           likes=liked_ids_among(messages),
+                           next_cursor=next_cursor(messages))
+
+
+@app.route('/users/<int:user_id>/messages')
+def users_messages(user_id):
+    """JSON page of a user's messages, older than the `before` cursor."""
+
+    User.get_active_or_404(user_id)
+    messages = user_messages_page(user_id)
+
+    return jsonify(serialize_page(messages))
+
+
+def viewer_etag_parts():
+    """What pages show of the logged-in user (in the navbar), for ETags."""
+
+    if not g.user:
+        return None
+
+    return (g.user.id, g.user.username, g.user.image_url)
+
+
+def profile_etag(user, position):
+    """ETag of `user`'s profile page at `position`, as the viewer sees it.
+
+    Messages can't be edited, so the page's messages are named by their
+    ids (from the index, without loading them); the profile, its counters
+    and what the viewer follows and likes make up the rest.
+    """
+
+    message_ids = [message_id for (message_id,)
+                   in queries.user_message_ids(user.id, position)]
+
+    following = liked = None
+    if g.user:
+        following = g.user.id != user.id and g.user.is_following(user)
+        liked = sorted(g.user.liked_ids_among(message_ids))
+
+    return http_cache.make_etag(
+        user.id, user.username, user.image_url, user.header_image_url,
+        user.bio, user.location, user.messages_count, user.following_count,
+        user.followers_count, user.likes_count,
+        message_ids, viewer_etag_parts(), following, liked)
+
+
+def user_messages_page(user_id):
+    """Get the page of `user_id`'s messages named by `?before=`."""
+
+    position = decode_cursor(request.args.get('before'))
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    return queries.author_messages(user_id, position).all()
 
 
 @app.route('/users/<int:user_id>/following')
@@ -177,8 +503,12 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.get_active_or_404(user_id)
+    users = queries.followed_users(user_id).all()
+    return render_template('users/following.html',
+                           user=user,
+                           users=users,
+                           following_ids=following_ids_among(users))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -189,8 +519,12 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.get_active_or_404(user_id)
+    users = queries.follower_users(user_id).all()
+    return render_template('users/followers.html',
+                           user=user,
+                           users=users,
+                           following_ids=following_ids_among(users))
 
 
 @app.route('/users/<int:user_id>/likes')
@@ -201,8 +535,14 @@ def users_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
+    user = User.get_active_or_404(user_id)
+    messages = queries.liked_messages(user_id).all()
+
+    return render_template('users/likes.html',
+                           user=user,
+                           messages=messages,
+                           fragments=message_fragments.render(messages),
+                           likes=liked_ids_among(messages))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -213,9 +553,13 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
+    followed_user = User.get_active_or_404(follow_id)
     g.user.following.append(followed_user)
+    counters.followed(g.user.id, followed_user.id)
     db.session.commit()
+    graph.followed(g.user.id, followed_user.id)
+    background_jobs.enqueue(sync_followee_timeline,
+                            g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -230,7 +574,11 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    counters.unfollowed(g.user.id, followed_user.id)
     db.session.commit()
+    graph.unfollowed(g.user.id, followed_user.id)
+    background_jobs.enqueue(sync_followee_timeline,
+                            g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -247,8 +595,10 @@ def profile():
     if form.validate_on_submit():
         password = form.password.data
 
-        auth = User.authenticate(user.username,
-                                 password)
+        auth = check_password_attempt(user.username, password)
+        if auth is None:
+            return too_many_attempts('users/edit.html', form)
+
         if auth:
             username = form.username.data
             email = form.email.data
@@ -262,6 +612,8 @@ def profile():
             user.header_image_url = header_image_url
             user.bio = bio
             db.session.commit()
+            user_cache.invalidate(user.id)
+            search.user_saved(user)
 
         else:
             flash('Wrong password')
@@ -274,7 +626,12 @@ def profile():
 
 @app.route('/users/delete', methods=["POST"])
 def delete_user():
-    """Delete user."""
+    """Delete user.
+
+    The account is marked deleted right away, and its rows are purged by
+    a background job, since deleting a large account's history takes a
+    while (see deletion.py).
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -282,8 +639,14 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user_id = g.user.id
+    deletion.soft_delete(user_id)
     db.session.commit()
+    user_cache.invalidate(user_id)
+    search.user_removed(user_id)
+    message_search.user_removed(user_id)
+    graph.user_removed(user_id)
+    background_jobs.enqueue(purge_account, user_id)
 
     return redirect("/signup")
 
@@ -306,7 +669,14 @@ def messages_add():
     if (response):
         msg = Message(text=response)
         g.user.messages.append(msg)
+        db.session.flush()
+        counters.message_added(msg)
+        timelines.push_to_author(msg)
         db.session.commit()
+        message_search.message_added(msg)
+        trending.message_added(msg)
+        background_jobs.enqueue(fan_out_message, msg.id)
+        live_updates.publish(msg.user_id, serialize_message(msg))
         print("\n\n\n\n MSG IS:", msg)
         return jsonify(serialize_message(msg))
 
@@ -326,17 +696,73 @@ def messages_add():
     # return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Page of messages matching the 'q' param, best match first.
+
+    Further pages are named by the `before` cursor.
+    """
+
+    query = request.args.get('q', '').strip()
+    messages, cursor = message_search.search_messages(
+        query, decode_rank_cursor(request.args.get('before')))
+
+    return render_template('messages/search.html',
+                           query=query,
+                           messages=messages,
+                           fragments=message_fragments.render(messages),
+                           likes=liked_ids_among(messages),
+                           next_cursor=cursor)
+
+
+@app.route('/messages/search/results')
+def messages_search_results():
+    """JSON page of messages matching 'q', after the `before` cursor."""
+
+    messages, cursor = message_search.search_messages(
+        request.args.get('q', '').strip(),
+        decode_rank_cursor(request.args.get('before')))
+
+    return jsonify({
+        "messages": [serialize_message(message) for message in messages],
+        "liked": sorted(liked_ids_among(messages)),
+        "next": cursor,
+    })
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
     try:
-        msg = Message.query.get(message_id)
+        msg = (queries.with_authors(Message.query)
+                      .filter(Message.id == message_id)
+                      .first())
+
+        if msg is not None:
+            response = http_cache.conditional(message_etag(msg))
+            if response is not None:
+                return response
+
         return render_template('messages/show.html', message=msg)
     except UndefinedError:
         flash("Message does not exist", 'danger')
         return redirect('/')
 
 
+def message_etag(msg):
+    """ETag of a message's page, as the viewer sees it."""
+
+    author = msg.user
+    following = None
+    if g.user and g.user.id != author.id:
+        following = g.user.is_following(author)
+
+    return http_cache.make_etag(
+        msg.id, msg.text, msg.timestamp,
+        author.id, author.username, author.image_url,
+        viewer_etag_parts(), following)
+
+
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
@@ -351,30 +777,110 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    counters.message_deleted(msg)
+    timelines.remove_message(msg)
     db.session.delete(msg)
     db.session.commit()
+    message_search.message_removed(message_id)
+    message_fragments.invalidate(message_id)
+    trending.message_removed(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 @app.route('/messages/<int:message_id>/like', methods=["POST"])
 def messages_like(message_id):
-    """Like a message."""
+    """Like or unlike a message.
+
+    JSON requests send {"liked": true} (or false) and get the change back
+    as JSON; form posts toggle the like and redirect to the user's likes.
+    """
+
     if not g.user:
+        if request.is_json:
+            return jsonify({"error": "Access unauthorized."}), 401
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    like = Likes.query.filter_by(message_id=message_id).first()
-    if bool(like):
-        db.session.delete(like)
+    Message.query.get_or_404(message_id)
 
-    else:
-        like = Likes(user_id=g.user.id, message_id=message_id)
-        db.session.add(like)
+    liked = (request.get_json(silent=True) or {}).get('liked')
+    if not isinstance(liked, bool):
+        liked = not message_likes.is_liked(g.user.id, message_id)
 
+    changed = message_likes.set_like(g.user.id, message_id, liked)
     db.session.commit()
+    if changed and liked:
+        trending.message_liked(message_id)
+
+    if request.is_json:
+        return jsonify(like_delta({message_id: changed}, {message_id: liked}))
+
     return redirect(f"/users/{g.user.id}/likes")
 
 
+@app.route('/messages/likes', methods=["POST"])
+def messages_likes():
+    """Like and unlike many messages, in one transaction.
+
+    Takes {"likes": [{"message_id": 1, "liked": true}, ...]} (later
+    entries for a message win), and returns the changes as JSON.
+    """
+
+    if not g.user:
+        return jsonify({"error": "Access unauthorized."}), 401
+
+    entries = (request.get_json(silent=True) or {}).get('likes')
+    if not isinstance(entries, list) or len(entries) > message_likes.MAX_BATCH:
+        return jsonify({"error": "Expected a list of up to "
+                                 f"{message_likes.MAX_BATCH} likes."}), 400
+
+    wanted = {}
+    for entry in entries:
+        if not (isinstance(entry, dict)
+                and type(entry.get('message_id')) is int
+                and isinstance(entry.get('liked'), bool)):
+            return jsonify({"error": "Each like needs an integer message_id "
+                                     "and a boolean liked."}), 400
+        wanted[entry['message_id']] = entry['liked']
+
+    changed = message_likes.set_likes(g.user.id, wanted)
+    db.session.commit()
+    for message_id, was_changed in changed.items():
+        if was_changed and wanted[message_id]:
+            trending.message_liked(message_id)
+
+    return jsonify(like_delta(changed, wanted))
+
+
+def like_delta(changed, wanted):
+    """JSON for like changes: each message's state, and the new count."""
+
+    likes_count = (db.session.query(User.likes_count)
+                             .filter(User.id == g.user.id)
+                             .scalar())
+
+    return {
+        "likes": [{"message_id": message_id,
+                   "liked": wanted[message_id],
+                   "changed": was_changed}
+                  for message_id, was_changed in changed.items()],
+        "likes_count": likes_count,
+    }
+
+
+@app.route('/trending')
+def trending_page():
+    """Show the trending hashtags and warbles (see trending.py)."""
+
+    messages = trending.top_messages(TRENDING_MESSAGES)
+
+    return render_template('trending.html',
+                           hashtags=trending.top_hashtags(TRENDING_HASHTAGS),
+                           messages=messages,
+                           fragments=message_fragments.render(messages),
+                           likes=liked_ids_among(messages))
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -384,45 +890,228 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
+      (older pages are named by the `before` cursor)
+
+    Messages come from the user's precomputed timeline (see timelines.py).
     """
     if g.user:
-        user = User.query.get_or_404(g.user.id)
-
-        relevant_warbles = [s.id for s in user.following] + [g.user.id]
+        user = g.user
 
-        messages = (Message.query
-                           .filter(Message.user_id.in_(relevant_warbles))
-                           .order_by(Message.timestamp.desc())
-                           .limit(100)
-                           .all())
-        likes = {l.id for l in user.likes}
+        position = decode_cursor(request.args.get('before'))
+        messages = timelines.read_timeline(user.id, position=position)
+        likes = liked_ids_among(messages)
 
-        return render_template('home.html', messages=messages, likes=likes)
+        return render_template('home.html',
+                               messages=messages,
+                               fragments=message_fragments.render(messages),
+                               likes=likes,
+                               live=position is None,
+                               next_cursor=next_cursor(messages),
+                               suggestions=graph.suggestions(user.id,
+                                                             SUGGESTIONS))
 
     else:
         return render_template('home-anon.html')
 
 
+@app.route('/timeline')
+def timeline():
+    """JSON page of the logged-in user's timeline, older than `before`."""
+
+    if not g.user:
+        return jsonify({"error": "Access unauthorized."}), 401
+
+    position = decode_cursor(request.args.get('before'))
+    messages = timelines.read_timeline(g.user.id, position=position)
+
+    return jsonify(serialize_page(messages))
+
+
+##############################################################################
+# Background jobs (see jobs.py). Each runs in its own transaction, after
+# the request that queued it has committed, and may run more than once.
+
+
+@background_jobs.job
+def fan_out_message(message_id):
+    """Deliver a new message to its author's followers' timelines."""
+
+    msg = Message.query.get(message_id)
+    if msg is not None:
+        timelines.push_to_followers(msg)
+
+
+@background_jobs.job
+def sync_followee_timeline(user_id, followee_id):
+    """Add or drop a followee's messages in a timeline, per the follow.
+
+    Checking the follow when the job runs keeps the timeline right when a
+    follow and unfollow are run out of order. Then the followee is
+    switched between pushed and pulled, if their followers crossed the
+    threshold (see timelines.py).
+    """
+
+    following = (db.session.query(Follows)
+                           .filter_by(user_following_id=user_id,
+                                      user_being_followed_id=followee_id)
+                           .first()) is not None
+
+    if following:
+        timelines.add_followee(user_id, followee_id)
+    else:
+        timelines.remove_followee(user_id, followee_id)
+    db.session.commit()
+
+    timelines.followers_changed(followee_id)
+
+
+# Seconds between progress reports while purging an account
+PURGE_REPORT_EVERY = 10
+
+
+def report_purge(user_id, report):
+    """Purge deleted `user_id`, passing progress to `report` now and then.
+
+    Reports the end of every stage, and progress within a stage at most
+    every PURGE_REPORT_EVERY seconds.
+    """
+
+    reported = time.monotonic()
+    for progress in deletion.purge(user_id):
+        now = time.monotonic()
+        if (progress.deleted >= progress.total
+                or now - reported > PURGE_REPORT_EVERY):
+            report(progress)
+            reported = now
+
+
+@background_jobs.job
+def purge_account(user_id):
+    """Delete a deleted user's rows, in batches."""
+
+    def report(progress):
+        # a large account can take longer than a job's lease
+        background_jobs.renew_lease()
+        app.logger.info("Purging user %d: %s %d/%d", user_id, *progress)
+
+    report_purge(user_id, report)
+
+
+@app.cli.command('purge-deleted-users')
+def purge_deleted_users():
+    """Purge every deleted account not purged yet (e.g. after a restart)."""
+
+    for user_id in deletion.deleted_user_ids():
+        report_purge(user_id, lambda progress: print(
+            f"User {user_id}: {progress.stage} "
+            f"{progress.deleted}/{progress.total}"))
+
+
+@app.cli.command('retry-failed-jobs')
+def retry_failed_jobs():
+    """Queue again the background jobs that failed every attempt.
+
+    Only jobs kept in JOB_QUEUE_DB can be seen from here.
+    """
+
+    for job_id, name, args, error in background_jobs.queue.failed():
+        print(f"{job_id}: {name}{tuple(args)}: {error}")
+
+    print(f"Queued {background_jobs.queue.retry_failed()} jobs.")
+
+
+@app.route('/timeline/stream')
+def timeline_stream():
+    """Server-sent events of new messages from the users g.user follows.
+
+    A reconnecting client's Last-Event-ID (the id of the last message it
+    got) is answered with the newer messages it missed first.
+    """
+
+    if not g.user:
+        return jsonify({"error": "Access unauthorized."}), 401
+
+    if live_updates.subscription_count() >= app.config['LIVE_MAX_STREAMS']:
+        return Response(live.busy_stream(), mimetype='text/event-stream')
+
+    user_id = g.user.id
+    followed_ids = [followed_id for (followed_id,) in
+                    db.session.query(Follows.user_being_followed_id)
+                              .filter(Follows.user_following_id == user_id)]
+    subscription = live_updates.subscribe(followed_ids)
+
+    missed = []
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is not None:
+        missed = [serialize_message(msg)
+                  for msg in reversed(timelines.read_timeline(user_id))
+                  if msg.id > last_id and msg.user_id != user_id]
+
+    response = Response(
+        live.event_stream(subscription, missed,
+                          timeout=app.config['LIVE_STREAM_TIMEOUT']),
+        mimetype='text/event-stream',
+        headers={'X-Accel-Buffering': 'no'})
+    # also when the stream is dropped before it starts
+    response.call_on_close(subscription.close)
+    return response
+
+
+@app.cli.command('backfill-timelines')
+def backfill_timelines():
+    """Rebuild every home timeline from existing follows and messages."""
+
+    count = timelines.rebuild_timelines()
+    db.session.commit()
+    print(f"Wrote {count} timeline entries.")
+
+
+@app.cli.command('create-indexes')
+def create_indexes():
+    """Add indexes declared on the models to an existing database."""
+
+    # likes became unique; older databases may have duplicates
+    removed = message_likes.remove_duplicate_likes()
+    db.session.commit()
+    if removed:
+        print(f"Removed {removed} duplicate likes "
+              "(run `flask reconcile-counters` to fix like counts).")
+
+    for name in create_missing_indexes():
+        print(f"Created index {name}")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Recompute drifted message/follow/like counters on users."""
+
+    fixed = counters.reconcile_counters()
+    db.session.commit()
+    print(f"Repaired counters for {fixed} users.")
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     # note that we set the 404 status explicitly
     return render_template('404.html'), 404
 
 
+@app.errorhandler(passwords.PasswordPoolBusy)
+def password_pool_busy(e):
+    """Too many logins/signups at once: ask the client to retry shortly."""
+
+    return "Too many logins right now, please try again.", 503, {
+        'Retry-After': '1'}
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Caching policy, per route (see http_cache.py): fingerprinted static files
+# are cached for good, profiles and messages revalidate by ETag, and
+# nothing else is cached.
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(response):
+    """Add caching headers for the route to every response."""
+
+    return http_cache.apply_policy(response)
@@ -0,0 +1,153 @@
+"""Time deleting a heavy account: batched purge vs one cascading DELETE.
+
+Run from the project root like:
+
+    python benchmarks/bench_deletion.py --messages 1000000
+
+Seeds one account with --messages messages (each on the author's own
+timeline), --followers followers, and --likes likes of its messages
+from those followers, then times the soft delete (what the request
+waits for) and the purge of it all, batch by batch. The longest batch
+is the longest any rows are held locked. --baseline seeds the account
+again and times deleting the user row in one statement instead, letting
+ON DELETE CASCADE do the rest in a single transaction.
+
+By default this uses (and wipes!) the `warbler-bench` database; set
+BENCH_DATABASE_URL to point it somewhere else.
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from random import Random
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', 'postgresql:///warbler-bench')
+
+from app import app  # noqa: E402
+from models import (db, User, Message, Follows, Likes,  # noqa: E402
+                    TimelineEntry)
+from counters import reconcile_counters  # noqa: E402
+import deletion  # noqa: E402
+
+CHUNK = 10000
+
+
+def percentile(samples, pct):
+    """Return the `pct` percentile of `samples` (nearest rank)."""
+
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def insert_chunks(table, rows):
+    """Insert the dicts from `rows` into `table`, CHUNK at a time."""
+
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK:
+            db.session.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+
+
+def seed(args):
+    """Create the heavy account (user 1) and its followers; return its id."""
+
+    db.drop_all()
+    db.create_all()
+
+    insert_chunks(User.__table__, (
+        dict(id=i, email=f"user{i}@bench.test", username=f"user{i}",
+             password="x")
+        for i in range(1, args.followers + 2)))
+
+    insert_chunks(Follows.__table__, (
+        dict(user_being_followed_id=1, user_following_id=follower_id)
+        for follower_id in range(2, args.followers + 2)))
+
+    start = datetime.utcnow()
+    insert_chunks(Message.__table__, (
+        dict(id=i, text=f"message {i}", user_id=1,
+             timestamp=start - timedelta(seconds=i))
+        for i in range(1, args.messages + 1)))
+
+    insert_chunks(TimelineEntry.__table__, (
+        dict(user_id=1, message_id=i,
+             timestamp=start - timedelta(seconds=i))
+        for i in range(1, args.messages + 1)))
+
+    rng = Random(args.seed)
+    pairs = set()
+    while len(pairs) < min(args.likes, args.followers * args.messages):
+        pairs.add((rng.randint(2, args.followers + 1),
+                   rng.randint(1, args.messages)))
+    insert_chunks(Likes.__table__, (
+        dict(user_id=user_id, message_id=message_id)
+        for user_id, message_id in sorted(pairs)))
+
+    reconcile_counters()
+    db.session.commit()
+    return 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--followers', type=int, default=10000)
+    parser.add_argument('--likes', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int,
+                        default=deletion.DEFAULT_BATCH_SIZE)
+    parser.add_argument('--baseline', action='store_true',
+                        help="also time one cascading DELETE")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with app.app_context():
+        start = time.perf_counter()
+        user_id = seed(args)
+        print(f"Seeded {args.messages} messages, {args.followers} followers "
+              f"and {args.likes} likes in {time.perf_counter() - start:.0f}s")
+
+        start = time.perf_counter()
+        deletion.soft_delete(user_id)
+        db.session.commit()
+        print(f"Soft delete: {(time.perf_counter() - start) * 1000:.1f}ms")
+
+        # unthrottled, to time the batches themselves
+        batches = {}
+        purge = deletion.purge(user_id, batch_size=args.batch_size,
+                               rows_per_second=0)
+        start = total_start = time.perf_counter()
+        for progress in purge:
+            now = time.perf_counter()
+            batches.setdefault(progress.stage, []).append(now - start)
+            start = now
+        total = time.perf_counter() - total_start
+
+        print(f"Purge: {total:.1f}s in batches of {args.batch_size} "
+              f"({args.messages / total:.0f} messages/s)")
+        for stage, samples in batches.items():
+            print(f"{stage:>10} | {len(samples):6} batches  "
+                  f"p50 {percentile(samples, 50) * 1000:8.1f}ms  "
+                  f"max {max(samples) * 1000:8.1f}ms")
+
+        if args.baseline:
+            user_id = seed(args)
+            start = time.perf_counter()
+            User.query.filter_by(id=user_id).delete(synchronize_session=False)
+            db.session.commit()
+            print(f"One cascading DELETE: {time.perf_counter() - start:.1f}s "
+                  "in a single transaction")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Measure the follow graph's size and query latency at scale.
+
+Run from the project root like:
+
+    python benchmarks/bench_graph.py --users 500000 --follows 10000000
+
+The graph is built from the same power-law follows the CSV generator
+writes (generated in memory, no database needed), then timed on follow
+checks between random users, mutuals, and "who to follow" suggestions
+for random users. --baseline also measures the obvious in-memory
+alternative, a dict of sets, for comparison.
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from random import Random
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'generator'))
+
+from graph import FollowGraph  # noqa: E402
+from helpers import get_power_law_follows  # noqa: E402
+
+
+def percentile(samples, pct):
+    """Return the `pct` percentile of `samples` (nearest rank)."""
+
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(name, samples):
+    """Print latency percentiles in microseconds."""
+
+    def us(pct):
+        return percentile(samples, pct) * 1e6
+
+    print(f"{name:>16} | p50 {us(50):9.1f}  p95 {us(95):9.1f}  "
+          f"p99 {us(99):9.1f}  max {us(100):9.1f}")
+
+
+def timed_each(func, args_list):
+    """Call func(*args) for each args; return the seconds each took."""
+
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def baseline_recommend(following, user_id, limit=5):
+    """Friends of friends from {user id: set of followed ids}."""
+
+    followed = following.get(user_id, set())
+    counts = Counter()
+    for followee_id in followed:
+        counts.update(following.get(followee_id, ()))
+    counts.pop(user_id, None)
+    for followee_id in followed:
+        counts.pop(followee_id, None)
+    return [user_id for user_id, _ in counts.most_common(limit)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=500000)
+    parser.add_argument('--follows', type=int, default=10000000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--baseline', action='store_true',
+                        help="also time a dict-of-sets graph")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # (followed, follower) rows come grouped by follower, sorted
+    start = time.perf_counter()
+    graph = FollowGraph.build(
+        ((follower, followed) for followed, follower
+         in get_power_law_follows(args.users, args.follows, seed=args.seed)),
+        args.users)
+    seconds = time.perf_counter() - start
+
+    edges = len(graph.following.targets)
+    print(f"Built a graph of {args.users} users and {edges} follows in "
+          f"{seconds:.1f}s: {graph.nbytes / 2**20:.0f}MB "
+          f"({graph.nbytes / edges:.1f} bytes per follow)")
+
+    rng = Random(args.seed)
+    users = [(rng.randint(1, args.users),) for _ in range(args.queries)]
+    pairs = [(rng.randint(1, args.users), rng.randint(1, args.users))
+             for _ in range(args.queries)]
+
+    print(f"{args.queries} queries each (microseconds)")
+    report('follows', timed_each(graph.follows, pairs))
+    report('mutuals', timed_each(graph.mutuals, users))
+    report('recommend', timed_each(graph.recommend, users))
+
+    for follower_id, followed_id in pairs[:1000]:
+        graph.add(follower_id, followed_id)
+    report('recommend +1k', timed_each(graph.recommend, users))
+
+    if args.baseline:
+        tracemalloc.start()
+        following = {}
+        for follower_id in range(args.users + 1):
+            followed = graph.following.neighbours(follower_id)
+            if followed:
+                following[follower_id] = set(followed)
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f"A dict of sets of the follows takes {size / 2**20:.0f}MB "
+              "(one direction)")
+        report('dict of sets', timed_each(
+            lambda user_id: baseline_recommend(following, user_id), users))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Measure login (bcrypt check) throughput, inline and on the pool.
+
+Run from the project root like:
+
+    python benchmarks/bench_passwords.py --logins 200 --concurrency 1 4 16
+
+For each concurrency level, that many threads check passwords as fast
+as they can, first on their own threads (as before passwords.py) and then
+on the password pool. Meanwhile the main thread times a small piece of
+Python work every 10ms, standing in for the other requests a worker is
+serving; its p99 shows how much the logins slow them down. Throughput is
+also given per core used (the pool size, or the concurrency inline).
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import app  # noqa: E402
+import passwords  # noqa: E402
+
+
+def percentile(samples, pct):
+    """Return the `pct` percentile of `samples` (nearest rank)."""
+
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def other_work():
+    """A few ms of pure-Python work, like rendering a small page."""
+
+    return sum(i * i for i in range(20000))
+
+
+def run(workers, concurrency, logins, password_hash):
+    """Check `logins` passwords; return (logins/s, other work p99 ms)."""
+
+    app.config['PASSWORD_HASH_WORKERS'] = workers
+    done = threading.Event()
+    latencies = []
+
+    def login(_):
+        with app.app_context():
+            assert passwords.check_password(password_hash, 'secret')
+
+    with app.app_context():
+        # start the pool outside the timed part
+        passwords.check_password(password_hash, 'secret')
+
+    with ThreadPoolExecutor(concurrency) as threads:
+        start = time.perf_counter()
+        results = threads.map(login, range(logins))
+
+        def wait():
+            list(results)
+            done.set()
+
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+
+        while not done.is_set():
+            work_start = time.perf_counter()
+            other_work()
+            latencies.append(time.perf_counter() - work_start)
+            time.sleep(0.01)
+
+        waiter.join()
+        elapsed = time.perf_counter() - start
+
+    return logins / elapsed, percentile(latencies, 99) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 4, 16])
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="password pool processes")
+    args = parser.parse_args()
+
+    app.config['BCRYPT_LOG_ROUNDS'] = args.rounds
+    with app.app_context():
+        app.config['PASSWORD_HASH_WORKERS'] = 0
+        password_hash = passwords.hash_password('secret')
+
+    print(f"{args.logins} logins at cost {args.rounds}, "
+          f"{os.cpu_count()} cores, pool of {args.workers}")
+    print(f"{'mode':>8} {'threads':>8} {'logins/s':>10} "
+          f"{'per core':>10} {'other p99 ms':>14}")
+
+    for concurrency in args.concurrency:
+        for mode, workers in (('inline', 0), ('pool', args.workers)):
+            rate, other_p99 = run(workers, concurrency, args.logins,
+                                  password_hash)
+            cores = min(workers or concurrency, os.cpu_count())
+            print(f"{mode:>8} {concurrency:>8} {rate:>10.1f} "
+                  f"{rate / cores:>10.1f} {other_p99:>14.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Measure full-text message search latency on a seeded database.
+
+Seed a database with 1M messages from the CSV generator first:
+
+    python benchmarks/loadtest.py seed --scale 100k
+
+then run from the project root like:
+
+    python benchmarks/bench_search.py --queries 500
+
+Query words are sampled from the text of random messages, as one- and
+two-word queries, and each query reads its first page and the page after
+it. Pass --baseline to also time the unindexed ILIKE scan search would
+otherwise need. This only reads, using the `warbler-bench` database by
+default; set BENCH_DATABASE_URL to point it somewhere else.
+"""
+
+import argparse
+import os
+import sys
+import time
+from random import Random
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', 'postgresql:///warbler-bench')
+
+from app import app  # noqa: E402
+from models import db, Message  # noqa: E402
+from pagination import PAGE_SIZE, decode_rank_cursor  # noqa: E402
+import message_search  # noqa: E402
+
+
+def percentile(samples, pct):
+    """Return the `pct` percentile of `samples` (nearest rank)."""
+
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def sample_queries(count, rng):
+    """Build `count` one- and two-word queries from random messages."""
+
+    max_id = db.session.query(db.func.max(Message.id)).scalar()
+    if not max_id:
+        sys.exit("Seed the database first (see the docstring)")
+
+    queries = []
+    while len(queries) < count:
+        message = Message.query.get(rng.randint(1, max_id))
+        words = message and message_search.words(message.text)
+        if not words:
+            continue
+
+        size = min(len(words), rng.choice((1, 1, 2)))
+        start = rng.randint(0, len(words) - size)
+        queries.append(' '.join(words[start:start + size]))
+
+    return queries
+
+
+def timed(func, *args):
+    """Call `func`; return (its result, seconds taken)."""
+
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def baseline_search(query):
+    """Unindexed substring search, newest first."""
+
+    return (Message.query
+                   .filter(Message.text.ilike(f"%{query}%"))
+                   .order_by(Message.id.desc())
+                   .limit(PAGE_SIZE)
+                   .all())
+
+
+def report(name, samples):
+    """Print latency percentiles in milliseconds."""
+
+    def ms(pct):
+        return percentile(samples, pct) * 1000
+
+    print(f"{name:>12} | p50 {ms(50):8.2f}  p95 {ms(95):8.2f}  "
+          f"p99 {ms(99):8.2f}  max {ms(100):8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--baseline', action='store_true',
+                        help="also time an unindexed ILIKE search")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with app.app_context():
+        rng = Random(args.seed)
+        count = db.session.query(db.func.count(Message.id)).scalar()
+        queries = sample_queries(args.queries, rng)
+
+        if not message_search.uses_text_search_index():
+            _, seconds = timed(message_search.get_inverted_index)
+            print(f"Built the in-process index in {seconds:.1f}s")
+
+        first_pages, next_pages, baseline = [], [], []
+        for query in queries:
+            (_, cursor), seconds = timed(message_search.search_messages,
+                                         query)
+            first_pages.append(seconds)
+
+            if cursor:
+                _, seconds = timed(message_search.search_messages,
+                                   query, decode_rank_cursor(cursor))
+                next_pages.append(seconds)
+
+            if args.baseline:
+                _, seconds = timed(baseline_search, query)
+                baseline.append(seconds)
+
+            db.session.rollback()
+
+        print(f"{count} messages, {len(queries)} queries "
+              f"({db.engine.dialect.name}, ms)")
+        report('first page', first_pages)
+        if next_pages:
+            report('next page', next_pages)
+        if baseline:
+            report('ILIKE scan', baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""Compare pull, push and hybrid home timelines on a skewed follow graph.
+
+Run from the project root like:
+
+    python benchmarks/bench_timelines.py --users 2000 --follows 50000
+
+The follow graph comes from the power-law generator used by
+generator/create_csvs.py, so a few accounts have most of the followers.
+By default this uses (and wipes!) the `warbler-bench` database; set
+BENCH_DATABASE_URL to point it somewhere else.
+"""
+
+import argparse
+import os
+import sys
+import time
+from random import Random
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'generator'))
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', 'postgresql:///warbler-bench')
+
+from app import app  # noqa: E402
+from models import db, User, Message, Follows, TimelineEntry  # noqa: E402
+from helpers import get_power_law_follows  # noqa: E402
+from pagination import PAGE_SIZE  # noqa: E402
+from counters import reconcile_counters  # noqa: E402
+import timelines  # noqa: E402
+
+NO_FANOUT_LIMIT = 10 ** 12
+
+
+def percentile(samples, pct):
+    """Return the `pct` percentile of `samples` (nearest rank)."""
+
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def seed(num_users, num_follows, rng_seed):
+    """Create users and a power-law follow graph."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(User, (
+        dict(id=i, email=f"user{i}@bench.test", username=f"user{i}",
+             password="x")
+        for i in range(1, num_users + 1)))
+
+    db.session.bulk_insert_mappings(Follows, (
+        dict(user_being_followed_id=followed, user_following_id=follower)
+        for followed, follower in get_power_law_follows(
+            num_users, num_follows, seed=rng_seed)))
+
+    reconcile_counters()
+    db.session.commit()
+
+
+def pull_read(user_id, limit=PAGE_SIZE):
+    """The original homepage query: scan followed users' messages."""
+
+    followed = (db.session.query(Follows.user_being_followed_id)
+                          .filter(Follows.user_following_id == user_id))
+    return (Message.query
+                   .filter(db.or_(Message.user_id.in_(followed),
+                                  Message.user_id == user_id))
+                   .order_by(Message.timestamp.desc())
+                   .limit(limit)
+                   .all())
+
+
+def run_strategy(name, threshold, args):
+    """Post and read with one strategy; return write and read latencies."""
+
+    Message.query.delete()
+    TimelineEntry.query.delete()
+    db.session.commit()
+
+    app.config['TIMELINE_FANOUT_THRESHOLD'] = threshold
+    timelines._high_follower_cache['expires'] = 0
+
+    rng = Random(args.seed)
+    writes = []
+
+    for i in range(args.messages):
+        # popular (low id) users post more, like on real networks
+        author = min(rng.randint(1, args.users) for _ in range(2))
+
+        start = time.perf_counter()
+        msg = Message(text=f"message {i}", user_id=author)
+        db.session.add(msg)
+        db.session.flush()
+        if name != 'pull':
+            timelines.push_message(msg)
+        db.session.commit()
+        writes.append(time.perf_counter() - start)
+
+    reads = []
+    for _ in range(args.reads):
+        reader = rng.randint(1, args.users)
+
+        start = time.perf_counter()
+        if name == 'pull':
+            pull_read(reader)
+        else:
+            timelines.read_timeline(reader)
+        reads.append(time.perf_counter() - start)
+        db.session.rollback()
+
+    return writes, reads
+
+
+def report(name, writes, reads):
+    """Print latency percentiles in milliseconds."""
+
+    def ms(samples, pct):
+        return percentile(samples, pct) * 1000
+
+    print(f"{name:>7} | write p50 {ms(writes, 50):7.2f}  "
+          f"p99 {ms(writes, 99):8.2f}  max {ms(writes, 100):8.2f} | "
+          f"read p50 {ms(reads, 50):7.2f}  p99 {ms(reads, 99):8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--follows', type=int, default=50000)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--reads', type=int, default=500)
+    parser.add_argument('--threshold', type=int, default=200,
+                        help="follower count above which hybrid pulls")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with app.app_context():
+        seed(args.users, args.follows, args.seed)
+
+        strategies = [
+            ('pull', NO_FANOUT_LIMIT),
+            ('push', NO_FANOUT_LIMIT),
+            ('hybrid', args.threshold),
+        ]
+
+        print(f"{args.users} users, {args.follows} follows, "
+              f"{args.messages} messages, {args.reads} reads (ms)")
+
+        for name, threshold in strategies:
+            writes, reads = run_strategy(name, threshold, args)
+            report(name, writes, reads)
+
+
+if __name__ == '__main__':
+    main()
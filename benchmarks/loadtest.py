@@ -0,0 +1,320 @@
+"""Load test Warbler with a realistic mix of routes.
+
+Seed a benchmark database at one of a few scales, using the CSV generator
+and seed.py:
+
+    python benchmarks/loadtest.py seed --scale 1k
+
+then replay the route mix in benchmarks/workload.jsonl, either in process
+through Flask's test client or over HTTP against gunicorn:
+
+    python benchmarks/loadtest.py run --target client --requests 2000
+    python benchmarks/loadtest.py run --target gunicorn --workers 4 \\
+        --concurrency 16 --requests 20000
+
+Each run reports p50/p95/p99 latency and throughput per route; pass
+--output to save them as JSON and compare runs. The database defaults to
+`warbler-bench` (it is wiped by `seed`); set BENCH_DATABASE_URL to use
+another.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from random import Random
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DATABASE_URL = os.environ.get('BENCH_DATABASE_URL',
+                              'postgresql:///warbler-bench')
+os.environ['DATABASE_URL'] = DATABASE_URL
+
+# (users, messages, follows) for each --scale
+SCALES = {
+    '1k': (1000, 10000, 20000),
+    '100k': (100000, 1000000, 2000000),
+    '1m': (1000000, 10000000, 20000000),
+}
+
+WORKLOAD = os.path.join(ROOT, 'benchmarks', 'workload.jsonl')
+
+
+def seed(args):
+    """Generate CSVs at the requested scale and load them with seed.py."""
+
+    users, messages, follows = SCALES[args.scale]
+    env = dict(os.environ, DATABASE_URL=DATABASE_URL)
+
+    with tempfile.TemporaryDirectory() as csv_dir:
+        subprocess.run([sys.executable, 'generator/create_csvs.py',
+                        '--users', str(users),
+                        '--messages', str(messages),
+                        '--follows', str(follows),
+                        '--out', csv_dir],
+                       cwd=ROOT, env=env, check=True)
+        subprocess.run([sys.executable, 'seed.py', csv_dir],
+                       cwd=ROOT, env=env, check=True)
+
+
+##############################################################################
+# Building the request mix
+
+
+def load_workload(path):
+    """Read route specs (one JSON object per line)."""
+
+    with open(path) as workload:
+        return [json.loads(line) for line in workload if line.strip()]
+
+
+def plan_requests(specs, count, rng):
+    """Pick `count` (spec, path, user_id) requests, weighted by the specs."""
+
+    from app import app
+    from models import db, User, Message
+    from pagination import encode_cursor
+
+    with app.app_context():
+        num_users = db.session.query(db.func.max(User.id)).scalar()
+        num_messages = db.session.query(db.func.max(Message.id)).scalar()
+        usernames = [name for (name,) in
+                     db.session.query(User.username).limit(1000)]
+
+    weights = [spec.get('weight', 1) for spec in specs]
+    plan = []
+
+    for spec in rng.choices(specs, weights=weights, k=count):
+        cursor_time = datetime.utcnow() - timedelta(days=rng.randint(0, 700))
+        username = rng.choice(usernames)
+        start = rng.randint(0, max(0, len(username) - 3))
+
+        path = spec['path'].format(
+            user_id=rng.randint(1, num_users),
+            message_id=rng.randint(1, num_messages),
+            query=username[start:start + 3],
+            cursor=encode_cursor(cursor_time, 2 ** 31 - 1),
+        )
+        user_id = rng.randint(1, num_users) if spec.get('login') else None
+        plan.append((spec, path, user_id))
+
+    return plan
+
+
+##############################################################################
+# Running it
+
+
+def run_with_client(plan):
+    """Replay `plan` in process; return [(route, status, seconds)]."""
+
+    from app import app, CURR_USER_KEY
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['DEBUG_TB_ENABLED'] = False
+    client = app.test_client()
+    results = []
+
+    for spec, path, user_id in plan:
+        with client.session_transaction() as sess:
+            sess.clear()
+            if user_id:
+                sess[CURR_USER_KEY] = user_id
+
+        start = time.perf_counter()
+        resp = client.open(path, method=spec['method'], json=spec.get('json'))
+        results.append((spec['name'], resp.status_code,
+                        time.perf_counter() - start))
+
+    return results
+
+
+class NoRedirects(urllib.request.HTTPRedirectHandler):
+    """Report redirects as responses instead of following them."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def session_cookie(app, user_id):
+    """Forge a signed session cookie logging in `user_id`."""
+
+    from app import CURR_USER_KEY
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    value = serializer.dumps({CURR_USER_KEY: user_id})
+    return f"{app.config['SESSION_COOKIE_NAME']}={value}"
+
+
+def run_with_gunicorn(plan, args):
+    """Replay `plan` over HTTP against gunicorn; return [(route, status, s)]."""
+
+    from app import app
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(args.workers),
+         '--bind', f'127.0.0.1:{port}', 'app:app'],
+        cwd=ROOT, env=dict(os.environ, DATABASE_URL=DATABASE_URL))
+
+    base_url = f'http://127.0.0.1:{port}'
+    opener = urllib.request.build_opener(NoRedirects)
+
+    def send(request):
+        spec, path, user_id = request
+        body = spec.get('json')
+        http_request = urllib.request.Request(
+            base_url + path,
+            method=spec['method'],
+            data=json.dumps(body).encode() if body is not None else None,
+            headers={'Content-Type': 'application/json'})
+        if user_id:
+            http_request.add_header('Cookie', session_cookie(app, user_id))
+
+        start = time.perf_counter()
+        try:
+            with opener.open(http_request) as resp:
+                resp.read()
+                status = resp.status
+        except urllib.error.HTTPError as error:
+            status = error.code
+        return spec['name'], status, time.perf_counter() - start
+
+    try:
+        wait_for_port(port)
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            return list(pool.map(send, plan))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def wait_for_port(port, timeout=30):
+    """Block until something accepts connections on `port`."""
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+
+    raise RuntimeError(f"gunicorn didn't start listening on port {port}")
+
+
+##############################################################################
+# Reporting
+
+
+def percentile(samples, pct):
+    """Return the `pct` percentile of sorted `samples` (nearest rank)."""
+
+    index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+    return samples[index]
+
+
+def summarize(results, wall_seconds):
+    """Per-route latency percentiles (ms), error counts and throughput."""
+
+    by_route = defaultdict(list)
+    errors = defaultdict(int)
+    for route, status, seconds in results:
+        by_route[route].append(seconds)
+        if status >= 500:
+            errors[route] += 1
+
+    summary = {}
+    for route, samples in sorted(by_route.items()):
+        samples.sort()
+        summary[route] = {
+            'requests': len(samples),
+            'errors': errors[route],
+            'p50_ms': percentile(samples, 50) * 1000,
+            'p95_ms': percentile(samples, 95) * 1000,
+            'p99_ms': percentile(samples, 99) * 1000,
+            'rps': len(samples) / wall_seconds,
+        }
+
+    summary['total'] = {'requests': len(results),
+                        'errors': sum(errors.values()),
+                        'rps': len(results) / wall_seconds}
+    return summary
+
+
+def print_summary(summary):
+    print(f"{'route':<16}{'reqs':>8}{'errors':>8}{'p50 ms':>10}"
+          f"{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}")
+
+    for route, row in summary.items():
+        if route == 'total':
+            continue
+        print(f"{route:<16}{row['requests']:>8}{row['errors']:>8}"
+              f"{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+              f"{row['p99_ms']:>10.2f}{row['rps']:>10.1f}")
+
+    total = summary['total']
+    print(f"{'total':<16}{total['requests']:>8}{total['errors']:>8}"
+          f"{'':>30}{total['rps']:>10.1f}")
+
+
+def run(args):
+    rng = Random(args.seed)
+    plan = plan_requests(load_workload(args.workload), args.requests, rng)
+
+    start = time.perf_counter()
+    if args.target == 'client':
+        results = run_with_client(plan)
+    else:
+        results = run_with_gunicorn(plan, args)
+    wall_seconds = time.perf_counter() - start
+
+    summary = summarize(results, wall_seconds)
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(summary, output, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    seed_parser = commands.add_parser('seed', help="load a dataset")
+    seed_parser.add_argument('--scale', choices=SCALES, default='1k')
+    seed_parser.set_defaults(func=seed)
+
+    run_parser = commands.add_parser('run', help="replay the route mix")
+    run_parser.add_argument('--target', choices=('client', 'gunicorn'),
+                            default='client')
+    run_parser.add_argument('--requests', type=int, default=2000)
+    run_parser.add_argument('--workers', type=int, default=4,
+                            help="gunicorn worker processes")
+    run_parser.add_argument('--concurrency', type=int, default=16,
+                            help="concurrent HTTP requests (gunicorn only)")
+    run_parser.add_argument('--workload', default=WORKLOAD)
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--output', help="save the summary as JSON")
+    run_parser.set_defaults(func=run)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Denormalized per-user counters (messages, following, followers, likes).
+
+Each change is a single relative UPDATE (`count = count + 1`) issued in the
+same transaction as the change it counts, so concurrent requests can't lose
+increments. `reconcile_counters()` recomputes everything from the source
+tables to repair any drift.
+"""
+
+from collections import defaultdict
+
+from sqlalchemy import select, func, or_
+
+from models import db, User, Message, Follows, Likes
+
+COUNTERS = ('messages_count', 'following_count', 'followers_count',
+            'likes_count')
+
+
+def adjust(user_ids, **deltas):
+    """Add `deltas` (e.g. likes_count=-1) to the counters of `user_ids`.
+
+    `user_ids` is a user id, a list of ids or a subquery selecting ids.
+    """
+
+    if isinstance(user_ids, int):
+        condition = User.id == user_ids
+    else:
+        condition = User.id.in_(user_ids)
+
+    values = {getattr(User, name): getattr(User, name) + delta
+              for name, delta in deltas.items()}
+
+    User.query.filter(condition).update(values, synchronize_session=False)
+
+
+def followed(follower_id, followed_id):
+    """Count a new follow."""
+
+    adjust(follower_id, following_count=1)
+    adjust(followed_id, followers_count=1)
+
+
+def unfollowed(follower_id, followed_id):
+    """Count a removed follow."""
+
+    adjust(follower_id, following_count=-1)
+    adjust(followed_id, followers_count=-1)
+
+
+def message_added(message):
+    """Count a new message."""
+
+    adjust(message.user_id, messages_count=1)
+
+
+def message_deleted(message):
+    """Count a message about to be deleted, along with its likes."""
+
+    adjust(message.user_id, messages_count=-1)
+
+    likers = (db.session.query(Likes.user_id)
+                        .filter(Likes.message_id == message.id))
+    adjust(likers.subquery(), likes_count=-1)
+
+
+def liked(user_id):
+    """Count a new like."""
+
+    adjust(user_id, likes_count=1)
+
+
+def unliked(user_id):
+    """Count a removed like."""
+
+    adjust(user_id, likes_count=-1)
+
+
+def messages_deleted(author_id, message_ids):
+    """Count a batch of `author_id`'s messages about to be deleted.
+
+    Only their likers' counts change: the author is being deleted too.
+    """
+
+    # a user can like many of the messages, so count per liker, then adjust
+    # everyone who lost the same number of likes in one UPDATE
+    likes_lost = (db.session.query(Likes.user_id, func.count())
+                            .filter(Likes.message_id.in_(message_ids),
+                                    Likes.user_id != author_id)
+                            .group_by(Likes.user_id))
+
+    likers_by_lost = defaultdict(list)
+    for liker_id, lost in likes_lost:
+        likers_by_lost[lost].append(liker_id)
+
+    for lost, liker_ids in likers_by_lost.items():
+        adjust(liker_ids, likes_count=-lost)
+
+
+def _actual_counts():
+    """Correlated subqueries computing each counter from source tables."""
+
+    return {
+        'messages_count': select([func.count(Message.id)])
+        .where(Message.user_id == User.id).as_scalar(),
+
+        'following_count': select([func.count()])
+        .where(Follows.user_following_id == User.id).as_scalar(),
+
+        'followers_count': select([func.count()])
+        .where(Follows.user_being_followed_id == User.id).as_scalar(),
+
+        'likes_count': select([func.count(Likes.id)])
+        .where(Likes.user_id == User.id).as_scalar(),
+    }
+
+
+def reconcile_counters():
+    """Recompute every drifted counter; return how many users were fixed."""
+
+    actual = _actual_counts()
+    drifted = or_(*(getattr(User, name) != count
+                    for name, count in actual.items()))
+
+    fixed = User.query.filter(drifted).count()
+    if fixed:
+        (User.query
+             .filter(drifted)
+             .update({getattr(User, name): count
+                      for name, count in actual.items()},
+                     synchronize_session=False))
+
+    return fixed
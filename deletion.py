@@ -0,0 +1,215 @@
+"""Account deletion: a soft delete now, and a purge in batches later.
+
+Deleting a user through the ORM loads every message, follow and like of
+theirs into the session before deleting any, and one DELETE of it all
+holds locks on every one of those rows until it commits: seconds, for a
+large account. So deletion happens in two steps:
+
+1. `soft_delete` stamps the user's `deleted_at`, on the request. From
+   then on they can't log in, and their profile, listings and messages
+   are gone (message lists skip deleted authors; see queries.py).
+2. `purge` deletes their rows in batches of PURGE_BATCH_SIZE, stage by
+   stage (see `STAGES`), each batch in a short transaction of its own.
+   Only ids are read, never whole rows; a batch of messages takes its
+   likes and timeline entries with it (ON DELETE CASCADE). Between
+   batches it sleeps as needed to stay under PURGE_ROWS_PER_SECOND, so
+   other queries keep up. Other users' counters are adjusted along with
+   each batch, for just the rows it deleted: the batch's rows are locked
+   first, so a purge running twice at once (or run again) can't count a
+   row twice.
+
+`purge` yields a `Progress` after each batch. It can be stopped at any
+point and run again: it carries on with whatever rows are left.
+
+Configuration (app.config, from the environment in app.py):
+
+- PURGE_BATCH_SIZE: rows deleted per transaction (default 1000).
+- PURGE_ROWS_PER_SECOND: most rows deleted a second (default 20000;
+  0 for no limit).
+"""
+
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from flask import current_app, has_app_context
+
+import counters
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_ROWS_PER_SECOND = 20000
+
+Progress = namedtuple('Progress', 'stage deleted total')
+
+
+def _config(name, default):
+    if has_app_context():
+        return current_app.config.get(name, default)
+    return default
+
+
+def soft_delete(user_id):
+    """Mark `user_id` deleted, to be purged. The caller commits."""
+
+    (User.query
+         .filter_by(id=user_id)
+         .update({User.deleted_at: datetime.utcnow()},
+                 synchronize_session=False))
+
+
+def deleted_user_ids():
+    """Ids of the soft-deleted users not purged yet."""
+
+    return [user_id for (user_id,) in
+            db.session.query(User.id).filter(User.deleted_at.isnot(None))]
+
+
+##############################################################################
+# Stages: for each, a query of the keys of a user's rows, and a function
+# deleting the rows with some of those keys (returning how many)
+
+
+def _locked(query, key, keys):
+    """Those of `keys` still in `query`, locked until the transaction ends.
+
+    A concurrent purge waits here, then finds the rows gone.
+    """
+
+    return [value for (value,) in
+            query.filter(key.in_(keys)).with_for_update()]
+
+
+def _following(user_id):
+    return (db.session.query(Follows.user_being_followed_id)
+                      .filter(Follows.user_following_id == user_id))
+
+
+def _delete_following(user_id, followed_ids):
+    followed_ids = _locked(_following(user_id),
+                           Follows.user_being_followed_id, followed_ids)
+    if not followed_ids:
+        return 0
+
+    counters.adjust(followed_ids, followers_count=-1)
+    return (Follows.query
+                   .filter(Follows.user_following_id == user_id,
+                           Follows.user_being_followed_id.in_(followed_ids))
+                   .delete(synchronize_session=False))
+
+
+def _followers(user_id):
+    return (db.session.query(Follows.user_following_id)
+                      .filter(Follows.user_being_followed_id == user_id))
+
+
+def _delete_followers(user_id, follower_ids):
+    follower_ids = _locked(_followers(user_id),
+                           Follows.user_following_id, follower_ids)
+    if not follower_ids:
+        return 0
+
+    counters.adjust(follower_ids, following_count=-1)
+    return (Follows.query
+                   .filter(Follows.user_being_followed_id == user_id,
+                           Follows.user_following_id.in_(follower_ids))
+                   .delete(synchronize_session=False))
+
+
+def _messages(user_id):
+    return db.session.query(Message.id).filter(Message.user_id == user_id)
+
+
+def _delete_messages(user_id, message_ids):
+    message_ids = _locked(_messages(user_id), Message.id, message_ids)
+    if not message_ids:
+        return 0
+
+    counters.messages_deleted(user_id, message_ids)
+    return (Message.query
+                   .filter(Message.id.in_(message_ids))
+                   .delete(synchronize_session=False))
+
+
+def _likes(user_id):
+    return db.session.query(Likes.id).filter(Likes.user_id == user_id)
+
+
+def _delete_likes(user_id, like_ids):
+    return (Likes.query
+                 .filter(Likes.id.in_(like_ids))
+                 .delete(synchronize_session=False))
+
+
+def _timeline(user_id):
+    return (db.session.query(TimelineEntry.message_id)
+                      .filter(TimelineEntry.user_id == user_id))
+
+
+def _delete_timeline(user_id, message_ids):
+    return (TimelineEntry.query
+                         .filter(TimelineEntry.user_id == user_id,
+                                 TimelineEntry.message_id.in_(message_ids))
+                         .delete(synchronize_session=False))
+
+
+# Follows go first, so the account drops out of other users' lists (and
+# their counts) soonest, then its messages
+STAGES = (
+    ('following', _following, _delete_following),
+    ('followers', _followers, _delete_followers),
+    ('messages', _messages, _delete_messages),
+    ('likes', _likes, _delete_likes),
+    ('timeline', _timeline, _delete_timeline),
+)
+
+
+##############################################################################
+# Purging
+
+
+def purge(user_id, batch_size=None, rows_per_second=None):
+    """Delete soft-deleted `user_id` and all their rows, in batches.
+
+    Yields a Progress(stage, deleted, total) after each batch, and a last
+    one for the user row itself. Commits as it goes.
+    """
+
+    if batch_size is None:
+        batch_size = _config('PURGE_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    if rows_per_second is None:
+        rows_per_second = _config('PURGE_ROWS_PER_SECOND',
+                                  DEFAULT_ROWS_PER_SECOND)
+
+    deleted_at = (db.session.query(User.deleted_at)
+                            .filter(User.id == user_id)
+                            .first())
+    if deleted_at is None:
+        # purged already
+        return
+    if deleted_at[0] is None:
+        raise ValueError(f"User {user_id} isn't deleted.")
+
+    for stage, keys, delete in STAGES:
+        query = keys(user_id)
+        total = query.count()
+        deleted = 0
+
+        while True:
+            started = time.monotonic()
+            batch = [key for (key,) in query.limit(batch_size)]
+            if not batch:
+                break
+
+            deleted += delete(user_id, batch)
+            db.session.commit()
+            yield Progress(stage, deleted, total)
+
+            if rows_per_second:
+                time.sleep(max(0, len(batch) / rows_per_second
+                               - (time.monotonic() - started)))
+
+    # anything added since its stage ran goes with the user row
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
+    db.session.commit()
+    yield Progress('user', 1, 1)
@@ -0,0 +1,184 @@
+"""Cache of rendered message list items.
+
+Message lists (home, profiles, likes, search) render the same markup for
+a message for every viewer on every request. `FragmentCache` renders each
+message's markup once and keeps it, keyed by message id, and pages only
+render the per-viewer like button live around it.
+
+A cached fragment carries a version derived from everything it shows: the
+message's text and time, and its author's id, username and image. When
+an author changes their profile, the old fragments no longer match and
+are re-rendered on next use, as are stale fragments of a reused message
+id (after the database is reset, say). Deleted messages are dropped
+with `invalidate`.
+
+Fragments are kept in an in-process LRU, and optionally also in a
+`SqliteFragmentStore` shared by the workers on a host, so a fragment one
+worker renders is a hit for the others.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+
+# Bump when the fragment template changes, so stored fragments go stale
+FRAGMENT_VERSION = 1
+
+
+def fragment_version(message):
+    """Version of `message`'s fragment: changes with what it displays."""
+
+    author = message.user
+    key = '\0'.join(str(part) for part in (
+        FRAGMENT_VERSION, message.text, message.timestamp,
+        author.id, author.username, author.image_url))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+class SqliteFragmentStore:
+    """Fragments in a local SQLite file, shared by processes on a host."""
+
+    # Trim the oldest fragments beyond `maxsize` every this many writes
+    TRIM_EVERY = 1000
+
+    def __init__(self, path, maxsize=100000):
+        self.path = path
+        self.maxsize = maxsize
+        self._local = threading.local()
+        self._writes = 0
+
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS fragments ("
+                "message_id INTEGER PRIMARY KEY, version TEXT, html TEXT)")
+
+    def _connect(self):
+        # a connection per thread (and per process, after a fork)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get_many(self, message_ids):
+        """Return {message id: (version, html)} for the stored ones."""
+
+        message_ids = list(message_ids)
+        placeholders = ', '.join('?' * len(message_ids))
+        rows = self._connect().execute(
+            f"SELECT message_id, version, html FROM fragments "
+            f"WHERE message_id IN ({placeholders})", message_ids)
+        return {message_id: (version, html)
+                for message_id, version, html in rows}
+
+    def set_many(self, fragments):
+        """Store {message id: (version, html)}."""
+
+        with self._connect() as connection:
+            # REPLACE deletes and reinserts, so the rowid order is the
+            # order fragments were last written in
+            connection.executemany(
+                "REPLACE INTO fragments VALUES (?, ?, ?)",
+                [(message_id, version, html)
+                 for message_id, (version, html) in fragments.items()])
+
+            self._writes += len(fragments)
+            if self._writes >= self.TRIM_EVERY:
+                self._writes = 0
+                connection.execute(
+                    "DELETE FROM fragments WHERE rowid <= "
+                    "(SELECT MAX(rowid) FROM fragments) - ?",
+                    (self.maxsize,))
+
+    def delete(self, message_id):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM fragments WHERE message_id = ?",
+                               (message_id,))
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM fragments")
+
+
+class FragmentCache:
+    """LRU cache of a template rendered for each message."""
+
+    def __init__(self, template, maxsize=10000, store=None):
+        self.template = template
+        self.maxsize = maxsize
+        self.store = store
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, messages):
+        """Return {message id: markup} for `messages`, rendering misses.
+
+        The messages' authors should be loaded (see queries.with_authors).
+        """
+
+        versions = {message.id: fragment_version(message)
+                    for message in messages}
+        html = {}
+
+        with self._lock:
+            for message_id, version in versions.items():
+                cached = self._fragments.get(message_id)
+                if cached is not None and cached[0] == version:
+                    self._fragments.move_to_end(message_id)
+                    html[message_id] = cached[1]
+
+        missing = [message_id for message_id in versions
+                   if message_id not in html]
+
+        found = {}
+        if missing and self.store is not None:
+            found = {message_id: fragment
+                     for message_id, fragment
+                     in self.store.get_many(missing).items()
+                     if fragment[0] == versions[message_id]}
+
+        rendered = {}
+        if len(found) < len(missing):
+            template = current_app.jinja_env.get_template(self.template)
+            for message in messages:
+                if message.id in missing and message.id not in found:
+                    rendered[message.id] = (versions[message.id],
+                                            template.render(msg=message))
+
+            if self.store is not None:
+                self.store.set_many(rendered)
+
+        new = {**found, **rendered}
+        with self._lock:
+            for message_id, fragment in new.items():
+                self._fragments[message_id] = fragment
+                self._fragments.move_to_end(message_id)
+            while len(self._fragments) > self.maxsize:
+                self._fragments.popitem(last=False)
+
+        html.update((message_id, fragment[1])
+                    for message_id, fragment in new.items())
+        return {message_id: Markup(fragment)
+                for message_id, fragment in html.items()}
+
+    def invalidate(self, message_id):
+        """Forget a message's fragment (after it's deleted)."""
+
+        with self._lock:
+            self._fragments.pop(message_id, None)
+
+        if self.store is not None:
+            self.store.delete(message_id)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+
+        if self.store is not None:
+            self.store.clear()
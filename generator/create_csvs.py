@@ -2,17 +2,25 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows:
+
+    python generator/create_csvs.py --users 1000 --messages 10000 --out DIR
+
+Data is generated offline and streamed to the files a chunk at a time, by
+--workers processes, so memory use stays bounded at any size (10M users
+and 100M follows work fine). Follower counts and user activity follow
+power laws, and messages are posted in bursts. The same --seed and --end
+always produce exactly the same files, whatever the number of workers.
 """
 
-import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import argparse
+import os
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
 
-MAX_WARBLER_LENGTH = 140
+from helpers import (CHUNK_SIZE, user_rows, message_rows, follow_rows,
+                     to_csv, parse_end)
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
@@ -22,56 +30,100 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# Messages are posted in the DAYS days before --end
+DAYS = 730
+DEFAULT_END = '2021-01-01'
+
+
+def chunks(total, chunk_size):
+    """Yield (index, start, stop) ranges covering 0..total."""
+
+    for index, start in enumerate(range(0, total, chunk_size)):
+        yield index, start, min(start + chunk_size, total)
+
+
+def generate_users(task, seed):
+    index, start, stop = task
+    return to_csv(user_rows(seed, index, start, stop))
+
+
+def generate_messages(task, seed, num_users, end):
+    index, start, stop = task
+    return to_csv(message_rows(seed, index, stop - start, num_users, end,
+                               DAYS))
+
+
+def generate_follows(task, seed, num_users, mean_follows):
+    index, start, stop = task
+    return to_csv(follow_rows(seed, index, start, stop, num_users,
+                              mean_follows))
+
+
+def write_csv(pool, path, headers, generate, tasks, workers):
+    """Write the chunks `generate` makes for `tasks` to `path`, in order.
+
+    At most two chunks per worker are in flight, so memory stays bounded
+    even if the disk is slower than the workers.
+    """
+
+    rows = 0
+    pending = deque()
 
-# Generate random profile image URLs to use for users
+    def write_oldest():
+        nonlocal rows
+        text = pending.popleft().get()
+        csv_file.write(text)
+        rows += text.count('\n')
 
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
+    with open(path, 'w', newline='') as csv_file:
+        csv_file.write(','.join(headers) + '\n')
 
-# Generate random header image URLs to use for users
+        # Chunks are written in task order, so the file comes out the
+        # same however many workers there are
+        for task in tasks:
+            pending.append(pool.apply_async(generate, (task,)))
+            if len(pending) >= 2 * workers:
+                write_oldest()
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+        while pending:
+            write_oldest()
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
+    print(f"Wrote {rows:,} rows to {path}")
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
+def main():
+    parser = argparse.ArgumentParser(description="Generate Warbler CSVs.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS,
+                        help="about how many follows to generate")
+    parser.add_argument('--out', default='generator',
+                        help="directory to write the CSVs to")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--end', type=parse_end, default=DEFAULT_END,
+                        help="date (YYYY-MM-DD) the newest messages precede")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
+    with Pool(args.workers) as pool:
+        write_csv(pool, os.path.join(args.out, 'users.csv'),
+                  USERS_CSV_HEADERS,
+                  partial(generate_users, seed=args.seed),
+                  chunks(args.users, CHUNK_SIZE), args.workers)
 
-# Generate follows.csv from random pairings of users
+        write_csv(pool, os.path.join(args.out, 'messages.csv'),
+                  MESSAGES_CSV_HEADERS,
+                  partial(generate_messages, seed=args.seed,
+                          num_users=args.users, end=args.end),
+                  chunks(args.messages, CHUNK_SIZE), args.workers)
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+        write_csv(pool, os.path.join(args.out, 'follows.csv'),
+                  FOLLOWS_CSV_HEADERS,
+                  partial(generate_follows, seed=args.seed,
+                          num_users=args.users,
+                          mean_follows=args.follows / args.users),
+                  chunks(args.users, CHUNK_SIZE), args.workers)
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
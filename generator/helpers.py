@@ -1,14 +1,257 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+Everything here is generated offline from a seeded Random, in independent
+chunks: chunk `index` of a file only depends on the seed and `index`, so
+chunks can be generated in any order, by any number of processes, and
+still produce exactly the same files.
+"""
 
+import csv
+import io
+from datetime import datetime, timedelta
+from itertools import accumulate
+from random import Random
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+# Popularity (followers) and activity (messages) of users by id follow
+# Zipf-like laws: user 1 is the most followed and the most active.
+FOLLOW_EXPONENT = 1.1
+ACTIVITY_EXPONENT = 0.9
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+# Message words are drawn from VOCABULARY with Zipf frequencies, like
+# natural text: a few words are everywhere, most are rare.
+WORD_EXPONENT = 1.05
 
-    return datetime.fromtimestamp(random_timestamp)
+# Chance that a message continues its author's current burst of posting,
+# and the mean gap (seconds) between messages in a burst
+BURST_CONTINUE = 0.6
+BURST_GAP = 90
+
+# Relative chance of a burst starting in each hour of the day (UTC)
+HOUR_WEIGHTS = (3, 2, 1, 1, 1, 1, 2, 4, 6, 7, 7, 7,
+                8, 8, 7, 7, 7, 8, 9, 10, 10, 9, 7, 5)
+HOUR_CUM_WEIGHTS = list(accumulate(HOUR_WEIGHTS))
+
+MAX_WARBLER_LENGTH = 140
+
+# Rows (users, messages, or followers' follows) per chunk of work
+CHUNK_SIZE = 20000
+
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
+
+HEADER_IMAGE_URL = '/static/images/warbler-hero.jpg'
+
+ADJECTIVES = """
+    able bold brave bright calm clever cool cosmic curious daring eager
+    fancy fuzzy gentle giant happy hidden jolly kind lazy little lucky
+    mellow mighty misty noble odd plucky proud quick quiet rapid rusty
+    shiny silent sleepy snowy solar swift tidy wild witty young
+""".split()
+
+NOUNS = """
+    badger bear bee canyon cedar comet coyote crane dragon eagle falcon
+    fern finch fox gecko heron lake lark lion lynx maple meadow moose
+    moth otter owl panda pine raven river robin sparrow storm tiger
+    tulip walrus willow wolf wren yak zebra
+""".split()
+
+COMMON_WORDS = """
+    the be to of and a in that have i it for not on with he as you do at
+    this but his by from they we say her she or an will my one all would
+    there their what so up out if about who get which go me when make can
+    like time no just him know take people into year your good some could
+    them see other than then now look only come its over think also back
+    after use two how our work first well way even new want because any
+    these give day most us coffee today morning night weekend music movie
+    game team city weather rain sun beach book friends family dog cat
+    food pizza lunch dinner code bug deploy python flask database warble
+""".split()
+
+SYLLABLES = """
+    ba be bi bo bu ka ke ki ko ku la le li lo lu ma me mi mo mu na ne ni
+    no nu ra re ri ro ru sa se si so su ta te ti to tu va ve vi vo vu za
+""".split()
+
+CITIES = """
+    Springfield Riverside Fairview Franklin Greenville Bristol Clinton
+    Salem Madison Georgetown Arlington Ashland Burlington Manchester
+    Oxford Milton Newport Dayton Lexington Winchester Clayton Jackson
+""".split()
+
+
+def _pseudo_words(count):
+    """Deterministic made-up words (bavi, kesolu, ...) for a long tail."""
+
+    words = []
+    base = len(SYLLABLES)
+    for i in range(count):
+        syllables = [SYLLABLES[i % base]]
+        i //= base
+        while i:
+            syllables.append(SYLLABLES[i % base])
+            i //= base
+        syllables.append(SYLLABLES[len(syllables) * 7 % base])
+        words.append(''.join(syllables))
+    return words
+
+
+VOCABULARY = COMMON_WORDS + _pseudo_words(20000)
+
+
+def zipf_rank(rng, n, exponent):
+    """Draw a rank in 1..n with probability about proportional to
+    1 / rank ** exponent, in constant time and memory (inverse CDF of
+    the continuous power law)."""
+
+    power = 1 - exponent
+    top = (n + 1) ** power
+    return min(n, int(((top - 1) * rng.random() + 1) ** (1 / power)))
+
+
+def chunk_rng(seed, kind, index):
+    """The Random for chunk `index` of file `kind`.
+
+    String seeds are hashed with SHA-512, so this is the same in every
+    process and run (unlike hash() of a tuple).
+    """
+
+    return Random(f"{seed}:{kind}:{index}")
+
+
+def to_csv(rows):
+    """Format rows (tuples) as CSV text."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(rows)
+    return buffer.getvalue()
+
+
+def sentence(rng, max_length):
+    """A made-up sentence of Zipf-distributed words, up to `max_length`."""
+
+    words = []
+    length = -1
+    while True:
+        word = VOCABULARY[zipf_rank(rng, len(VOCABULARY), WORD_EXPONENT) - 1]
+        if rng.random() < 0.03:
+            word = '#' + word
+        if length + len(word) + 2 > max_length:
+            break
+        words.append(word)
+        length += len(word) + 1
+
+    text = ' '.join(words or ['hello'])
+    return text[0].upper() + text[1:] + '.'
+
+
+##############################################################################
+# Chunks of each file
+
+
+def user_rows(seed, index, start, stop):
+    """Users with ids start + 1 .. stop, as users.csv rows."""
+
+    rng = chunk_rng(seed, 'users', index)
+    rows = []
+
+    for user_id in range(start + 1, stop + 1):
+        username = f"{rng.choice(ADJECTIVES)}_{rng.choice(NOUNS)}{user_id}"
+        rows.append((
+            f"{username}@example.com",
+            username,
+            rng.choice(IMAGE_URLS),
+            PASSWORD_HASH,
+            sentence(rng, rng.randint(20, 100)),
+            HEADER_IMAGE_URL,
+            rng.choice(CITIES),
+        ))
+
+    return rows
+
+
+def message_rows(seed, index, count, num_users, end, days):
+    """`count` messages as messages.csv rows, posted in bursts.
+
+    Each burst starts at a random time in the `days` before `end` (more
+    likely in the evening) by a user picked by activity; each following
+    message continues the burst with probability BURST_CONTINUE, a short
+    random gap later.
+    """
+
+    rng = chunk_rng(seed, 'messages', index)
+    rows = []
+    timestamp = author = None
+
+    for _ in range(count):
+        if author is None or rng.random() >= BURST_CONTINUE:
+            author = zipf_rank(rng, num_users, ACTIVITY_EXPONENT)
+            day = end - timedelta(days=rng.randint(1, days))
+            hour = rng.choices(range(24), cum_weights=HOUR_CUM_WEIGHTS)[0]
+            timestamp = day + timedelta(hours=hour,
+                                        seconds=rng.uniform(0, 3600))
+        else:
+            timestamp += timedelta(seconds=rng.expovariate(1 / BURST_GAP))
+
+        rows.append((sentence(rng, rng.randint(20, MAX_WARBLER_LENGTH - 1)),
+                     timestamp.isoformat(' '),
+                     author))
+
+    return rows
+
+
+def follow_rows(seed, index, start, stop, num_users, mean_follows,
+                exponent=FOLLOW_EXPONENT):
+    """Follows by users start + 1 .. stop, as follows.csv rows.
+
+    Each follower follows a heavy-tailed number of users (averaging
+    `mean_follows`), picked by popularity, so a handful of users collect
+    most of the followers, as on real social networks. Pairs are unique
+    and nobody follows themselves.
+    """
+
+    rng = chunk_rng(seed, 'follows', index)
+    rows = []
+
+    # Pareto(2) has mean 2, and a long tail of very active followers
+    scale = mean_follows / 2
+    max_follows = (num_users - 1) // 2
+
+    for follower in range(start + 1, stop + 1):
+        wanted = min(max_follows, round(scale * rng.paretovariate(2)))
+        followed = set()
+
+        while len(followed) < wanted:
+            user_id = zipf_rank(rng, num_users, exponent)
+            if user_id != follower:
+                followed.add(user_id)
+
+        rows += [(user_id, follower) for user_id in sorted(followed)]
+
+    return rows
+
+
+def get_power_law_follows(num_users, num_follows, exponent=FOLLOW_EXPONENT,
+                          seed=None, chunk_size=CHUNK_SIZE):
+    """Yield about `num_follows` (followed_id, follower_id) pairs.
+
+    The same pairs create_csvs.py writes to follows.csv, generated one
+    chunk of followers at a time, in bounded memory.
+    """
+
+    mean_follows = num_follows / num_users
+
+    for index, start in enumerate(range(0, num_users, chunk_size)):
+        stop = min(start + chunk_size, num_users)
+        yield from follow_rows(seed, index, start, stop, num_users,
+                               mean_follows, exponent)
+
+
+def parse_end(text):
+    """Parse a --end date (YYYY-MM-DD)."""
+
+    return datetime.strptime(text, '%Y-%m-%d')
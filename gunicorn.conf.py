@@ -0,0 +1,13 @@
+"""gunicorn settings, read by `gunicorn app:app` (see the Procfile)."""
+
+
+def post_worker_init(worker):
+    """Start the background job workers in each forked web worker.
+
+    Jobs left queued from before a restart or deploy are run straight
+    away, not only once the worker gets its first request.
+    """
+
+    from app import background_jobs
+
+    background_jobs.start()
@@ -0,0 +1,133 @@
+"""HTTP caching policy: immutable static files and conditional pages.
+
+Static files are linked through `static_url`, which adds a fingerprint
+of the file's contents (`?v=...`). A request with the current
+fingerprint can be cached for good, since a changed file gets a new URL;
+one without (or with a stale one) has to revalidate.
+
+Pages that are expensive to render and cheap to validate (profiles,
+single messages) compute an ETag from what they show, and answer
+If-None-Match with 304 Not Modified before rendering anything:
+
+    response = http_cache.conditional(http_cache.make_etag(...))
+    if response is not None:
+        return response
+
+Those pages differ per viewer, so they're only cached by the browser
+(`private`), and always revalidated. Everything else isn't cached.
+"""
+
+import hashlib
+import os
+
+from flask import current_app, g, request, session, url_for
+from werkzeug.security import safe_join
+
+# Seconds to keep fingerprinted static files (the most browsers honor)
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+_fingerprints = {}
+_release = None
+
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+def fingerprint(filename):
+    """Fingerprint of static file `filename` (recomputed when it changes)."""
+
+    path = safe_join(current_app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime
+    except (OSError, TypeError):
+        # no such file, or a path outside the static folder (None)
+        return None
+
+    cached = _fingerprints.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as file:
+            cached = _fingerprints[path] = (mtime, _digest(file.read()))
+
+    return cached[1]
+
+
+def static_url(filename):
+    """URL of static file `filename`, with its fingerprint."""
+
+    return url_for('static', filename=filename, v=fingerprint(filename))
+
+
+def release():
+    """Fingerprint of the templates and static files this process serves.
+
+    Part of every ETag, so pages cached before a deploy that changed
+    their markup (or the static files they link) don't validate after it.
+    """
+
+    global _release
+
+    if _release is None:
+        digest = hashlib.sha1()
+        folders = [current_app.static_folder,
+                   os.path.join(current_app.root_path,
+                                current_app.template_folder)]
+        for folder in folders:
+            for root, dirs, files in sorted(os.walk(folder)):
+                dirs.sort()
+                for name in sorted(files):
+                    with open(os.path.join(root, name), 'rb') as file:
+                        digest.update(name.encode('utf-8'))
+                        digest.update(file.read())
+        _release = digest.hexdigest()[:16]
+
+    return _release
+
+
+def make_etag(*parts):
+    """An ETag for a page showing `parts` (reprs must be stable)."""
+
+    return _digest(repr((release(),) + parts).encode('utf-8'))
+
+
+def conditional(etag):
+    """Return a 304 response if the client has `etag`, else None.
+
+    When None, the view renders as usual and the response gets `etag`.
+    Pages with flashed messages to show are never cached, since the
+    flashes would be lost.
+    """
+
+    if '_flashes' in session:
+        return None
+
+    g.etag = etag
+    if request.if_none_match.contains_weak(etag):
+        return current_app.response_class(status=304)
+
+    return None
+
+
+def apply_policy(response):
+    """Set the caching headers of `response` for the current route."""
+
+    if request.endpoint == 'static':
+        version = request.args.get('v')
+        if version and version == fingerprint(request.view_args['filename']):
+            response.headers['Cache-Control'] = (
+                f'public, max-age={STATIC_MAX_AGE}, immutable')
+        else:
+            response.headers['Cache-Control'] = 'public, no-cache'
+
+    elif 'etag' in g and response.status_code in (200, 304):
+        response.set_etag(g.etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+
+    else:
+        response.headers['Cache-Control'] = (
+            'no-cache, no-store, must-revalidate')
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
+
+    return response
@@ -0,0 +1,213 @@
+"""Lightweight per-route request instrumentation.
+
+For every request this records the number of SQL statements, time spent in
+the database, time spent rendering templates and total handler time, and
+aggregates them per route. The totals are served in Prometheus text format
+from /internal/metrics, and (optionally) per response in a Server-Timing
+header that browser dev tools display.
+
+The bookkeeping is a few perf_counter() calls and dict updates per request,
+so it's cheap enough to leave on in production. Each worker process keeps
+its own totals; Prometheus sums them when scraping several workers.
+
+Configuration:
+
+- SERVER_TIMING: add Server-Timing headers to responses (default False)
+- METRICS_TOKEN: if set, /internal/metrics requires
+  "Authorization: Bearer <token>"; if not, it only answers requests
+  from this host (loopback)
+"""
+
+import hmac
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+from flask import (g, request, current_app, has_request_context, abort,
+                   before_render_template, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds (seconds) of the handler time histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Addresses allowed to read the metrics when no METRICS_TOKEN is set
+LOOPBACK = ('127.0.0.1', '::1')
+
+# (Prometheus counter name, RouteStats attribute)
+COUNTERS = (
+    ('warbler_requests_total', 'requests'),
+    ('warbler_request_errors_total', 'errors'),
+    ('warbler_db_queries_total', 'queries'),
+    ('warbler_db_seconds_total', 'db_seconds'),
+    ('warbler_template_seconds_total', 'template_seconds'),
+)
+
+
+class RouteStats:
+    """Running totals for one route."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.handler_seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, timings, handler_seconds, error):
+        self.requests += 1
+        self.errors += error
+        self.queries += timings['queries']
+        self.db_seconds += timings['db']
+        self.template_seconds += timings['template']
+        self.handler_seconds += handler_seconds
+        self.buckets[bisect_left(LATENCY_BUCKETS, handler_seconds)] += 1
+
+
+class Instrumentation:
+    """Flask extension collecting per-route query and latency metrics."""
+
+    def __init__(self, app=None):
+        self.routes = {}
+        self.lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SERVER_TIMING', False)
+        app.config.setdefault('METRICS_TOKEN', None)
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.record_request)
+
+        before_render_template.connect(self.start_render, app)
+        template_rendered.connect(self.finish_render, app)
+
+        event.listen(Engine, 'before_cursor_execute', self.start_query)
+        event.listen(Engine, 'after_cursor_execute', self.finish_query)
+
+        app.add_url_rule('/internal/metrics', 'internal_metrics',
+                         self.metrics_view)
+
+    ##########################################################################
+    # Per-request timing
+
+    def start_request(self):
+        g.timings = {'started': perf_counter(), 'queries': 0,
+                     'db': 0.0, 'template': 0.0}
+
+    def start_query(self, conn, cursor, statement, parameters, context,
+                    executemany):
+        if has_request_context() and 'timings' in g:
+            g.timings['query_started'] = perf_counter()
+
+    def finish_query(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        if has_request_context() and 'timings' in g:
+            timings = g.timings
+            timings['queries'] += 1
+            timings['db'] += perf_counter() - timings.pop('query_started',
+                                                          perf_counter())
+
+    def start_render(self, app, template, context):
+        if 'timings' in g:
+            g.timings['render_started'] = perf_counter()
+
+    def finish_render(self, app, template, context):
+        if 'timings' in g:
+            timings = g.timings
+            timings['template'] += perf_counter() - timings.pop(
+                'render_started', perf_counter())
+
+    def finish_request(self, response):
+        timings = g.get('timings')
+        if timings is None:
+            return response
+
+        handler_seconds = perf_counter() - timings['started']
+        timings['handler'] = handler_seconds
+        timings['status'] = response.status_code
+
+        if current_app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = (
+                f'db;dur={timings["db"] * 1000:.2f};'
+                f'desc="{timings["queries"]} queries", '
+                f'tpl;dur={timings["template"] * 1000:.2f}, '
+                f'app;dur={handler_seconds * 1000:.2f}')
+
+        return response
+
+    def record_request(self, exc):
+        """Add the request to its route's totals.
+
+        Done on teardown, which (unlike after_request) runs for requests
+        that raised too, so those are counted, as errors.
+        """
+
+        timings = g.pop('timings', None)
+        if timings is None:
+            return
+
+        handler_seconds = timings.get('handler',
+                                      perf_counter() - timings['started'])
+        error = exc is not None or timings.get('status', 500) >= 500
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+
+        with self.lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = RouteStats()
+            stats.add(timings, handler_seconds, error)
+
+    ##########################################################################
+    # Export
+
+    def metrics_view(self):
+        """Serve the per-route totals in Prometheus text format."""
+
+        token = current_app.config['METRICS_TOKEN']
+        if token:
+            given = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(given.encode('utf-8'),
+                                       f'Bearer {token}'.encode('utf-8')):
+                abort(403)
+        elif request.remote_addr not in LOOPBACK:
+            abort(403)
+
+        return (self.render_metrics(), 200,
+                {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    def render_metrics(self):
+        """Return all per-route totals as Prometheus exposition text."""
+
+        with self.lock:
+            routes = [(f'route="{route}"', stats)
+                      for route, stats in sorted(self.routes.items())]
+
+            lines = []
+            for name, attribute in COUNTERS:
+                lines.append(f'# TYPE {name} counter')
+                lines += [f'{name}{{{label}}} {getattr(stats, attribute)}'
+                          for label, stats in routes]
+
+            name = 'warbler_request_seconds'
+            bounds = [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+            lines.append(f'# TYPE {name} histogram')
+
+            for label, stats in routes:
+                cumulative = 0
+                for bound, count in zip(bounds, stats.buckets):
+                    cumulative += count
+                    lines.append(
+                        f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+
+                lines += [
+                    f'{name}_sum{{{label}}} {stats.handler_seconds}',
+                    f'{name}_count{{{label}}} {stats.requests}',
+                ]
+
+        return '\n'.join(lines) + '\n'
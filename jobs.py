@@ -0,0 +1,390 @@
+"""Background jobs, to take slow side effects off the request path.
+
+Work that doesn't have to be done before the response, like delivering a
+new message to every follower's timeline or deleting an account with its
+whole history, is queued once the request has committed and run by a
+pool of worker threads, each job in an app context with a transaction
+of its own.
+
+Jobs are functions registered with `JobRunner.job`, queued with
+JSON-able arguments: ids, not objects, since a job may run after the
+objects have changed, or in another process. Jobs must be safe to run
+again. A job that raises is retried up to MAX_ATTEMPTS times, with
+exponential backoff, and is then kept as failed (`flask
+retry-failed-jobs` queues those again). A job whose worker died is run
+again once its lease runs out; jobs that may run longer than LEASE call
+`JobRunner.renew_lease` as they go, so no other worker takes them over.
+
+Jobs wait in a local SQLite file (`SqliteQueue`, at JOB_QUEUE_DB),
+which survives restarts and is shared by all the workers on a host (any
+of them may run a job). Workers are started as each process starts (see
+`start`), so jobs left queued by a restart are run without waiting for
+new ones. `MemoryQueue` keeps jobs in process instead, losing any still
+waiting when the process exits.
+
+At most JOB_QUEUE_SIZE jobs wait at a time. When the queue is full,
+`enqueue` runs the job on the calling thread instead, so a backlog slows
+requests down rather than growing without bound.
+
+Configuration (app.config, from the environment in app.py):
+
+- JOB_WORKERS: worker threads per process (default 2); 0 runs each job
+  on the calling thread as it's queued, e.g. for tests.
+- JOB_QUEUE_SIZE: most jobs waiting (default 10000).
+- JOB_QUEUE_DB: the queue's SQLite file (default jobs.db); empty for a
+  MemoryQueue.
+"""
+
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from models import db
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 10000
+
+# Runs of a job before it's given up on, and the wait before the first
+# retry (doubling after each failure)
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 2
+
+# Seconds a worker has to finish a job before another may take it over
+LEASE = 600
+
+# Seconds idle workers wait between checks for jobs queued elsewhere
+POLL_INTERVAL = 1
+
+
+class MemoryQueue:
+    """Jobs in an in-process heap, by when they're due."""
+
+    def __init__(self):
+        self._due = []
+        self._jobs = {}
+        self._failed = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def put(self, name, args, delay=0, maxsize=None):
+        """Queue a job; return its id, or None if `maxsize` are waiting."""
+
+        with self._lock:
+            if maxsize is not None and len(self._jobs) >= maxsize:
+                return None
+
+            job_id = next(self._ids)
+            self._jobs[job_id] = (name, args, 0)
+            heapq.heappush(self._due, (time.time() + delay, job_id))
+            return job_id
+
+    def claim(self, lease=LEASE):
+        """Take the next due job: (id, name, args, attempts), or None."""
+
+        with self._lock:
+            if not self._due or self._due[0][0] > time.time():
+                return None
+
+            _, job_id = heapq.heappop(self._due)
+            return (job_id,) + self._jobs[job_id]
+
+    def renew(self, job_id, lease=LEASE):
+        """Extend a claimed job's lease (here, claimed jobs are never
+        taken over, so there's nothing to do)."""
+
+    def done(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def retry(self, job_id, delay, error):
+        with self._lock:
+            name, args, attempts = self._jobs[job_id]
+            self._jobs[job_id] = (name, args, attempts + 1)
+            heapq.heappush(self._due, (time.time() + delay, job_id))
+
+    def fail(self, job_id, error):
+        with self._lock:
+            name, args, attempts = self._jobs.pop(job_id)
+            self._failed[job_id] = (name, args, error)
+
+    def size(self):
+        """Number of jobs waiting or running."""
+
+        with self._lock:
+            return len(self._jobs)
+
+    def failed(self):
+        """[(id, name, args, error)] of the jobs given up on."""
+
+        with self._lock:
+            return [(job_id,) + job for job_id, job in self._failed.items()]
+
+    def retry_failed(self):
+        """Queue the failed jobs again; return how many."""
+
+        with self._lock:
+            failed, self._failed = self._failed, {}
+
+        for name, args, _ in failed.values():
+            self.put(name, args)
+        return len(failed)
+
+
+class SqliteQueue:
+    """Jobs in a SQLite file, shared by processes on the same host."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        connection = self._connect()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY, name TEXT, args TEXT, "
+            "attempts INTEGER DEFAULT 0, due REAL, "
+            "leased_until REAL DEFAULT 0, failed INTEGER DEFAULT 0, "
+            "error TEXT)")
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_jobs_failed_due "
+            "ON jobs (failed, due)")
+
+    def _connect(self):
+        # a connection per thread (and per process, after a fork)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def put(self, name, args, delay=0, maxsize=None):
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if maxsize is not None and self._count(connection) >= maxsize:
+                job_id = None
+            else:
+                job_id = connection.execute(
+                    "INSERT INTO jobs (name, args, due) VALUES (?, ?, ?)",
+                    (name, json.dumps(args), time.time() + delay)).lastrowid
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        return job_id
+
+    def claim(self, lease=LEASE):
+        connection = self._connect()
+        now = time.time()
+
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT id, name, args, attempts FROM jobs "
+                "WHERE failed = 0 AND due <= ? AND leased_until < ? "
+                "ORDER BY due LIMIT 1", (now, now)).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE jobs SET leased_until = ? WHERE id = ?",
+                    (now + lease, row[0]))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+
+        job_id, name, args, attempts = row
+        return job_id, name, json.loads(args), attempts
+
+    def renew(self, job_id, lease=LEASE):
+        self._connect().execute(
+            "UPDATE jobs SET leased_until = ? WHERE id = ? AND failed = 0",
+            (time.time() + lease, job_id))
+
+    def done(self, job_id):
+        self._connect().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def retry(self, job_id, delay, error):
+        self._connect().execute(
+            "UPDATE jobs SET attempts = attempts + 1, due = ?, "
+            "leased_until = 0, error = ? WHERE id = ?",
+            (time.time() + delay, error, job_id))
+
+    def fail(self, job_id, error):
+        self._connect().execute(
+            "UPDATE jobs SET attempts = attempts + 1, failed = 1, "
+            "error = ? WHERE id = ?", (error, job_id))
+
+    def _count(self, connection):
+        return connection.execute(
+            "SELECT COUNT(*) FROM jobs WHERE failed = 0").fetchone()[0]
+
+    def size(self):
+        return self._count(self._connect())
+
+    def failed(self):
+        rows = self._connect().execute(
+            "SELECT id, name, args, error FROM jobs WHERE failed = 1 "
+            "ORDER BY id")
+        return [(job_id, name, json.loads(args), error)
+                for job_id, name, args, error in rows]
+
+    def retry_failed(self):
+        return self._connect().execute(
+            "UPDATE jobs SET failed = 0, attempts = 0, due = ?, "
+            "leased_until = 0 WHERE failed = 1", (time.time(),)).rowcount
+
+
+class JobRunner:
+    """Runs registered jobs from `queue` on worker threads of `app`."""
+
+    def __init__(self, app, queue=None):
+        self.app = app
+        self.queue = queue or MemoryQueue()
+        self.jobs = {}
+
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        # the id of the job each worker thread is running
+        self._running = threading.local()
+        # released once per job queued, to wake an idle worker
+        self._wakeups = threading.Semaphore(0)
+
+    def job(self, func):
+        """Register `func` as a job (a decorator)."""
+
+        self.jobs[func.__name__] = func
+        return func
+
+    def enqueue(self, func, *args):
+        """Queue a call of the job `func` with `args`.
+
+        Call it after committing whatever the job will read.
+        """
+
+        name = func.__name__
+        if self.jobs.get(name) is not func:
+            raise ValueError(f"{name} isn't a registered job.")
+
+        workers = self.app.config.get('JOB_WORKERS', DEFAULT_WORKERS)
+        if not workers:
+            self._call(name, args)
+            return
+
+        maxsize = self.app.config.get('JOB_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)
+        if self.queue.put(name, list(args), maxsize=maxsize) is None:
+            self._run_here(name, list(args))
+            return
+
+        self._start(workers)
+        self._wakeups.release()
+
+    def start(self):
+        """Start this process's worker threads, if they aren't yet.
+
+        Call it once the process is serving (after any fork), so jobs
+        already queued get run; `enqueue` starts them too.
+        """
+
+        workers = self.app.config.get('JOB_WORKERS', DEFAULT_WORKERS)
+        if workers:
+            self._start(workers)
+
+    def _call(self, name, args):
+        self.jobs[name](*args)
+        db.session.commit()
+
+    def _run_here(self, name, args):
+        """Run a job the full queue had no room for, on this thread."""
+
+        try:
+            self._call(name, args)
+        except Exception:
+            db.session.rollback()
+            self.app.logger.exception("Job %s%r failed; queued to retry.",
+                                      name, tuple(args))
+            self.queue.put(name, args, delay=RETRY_DELAY)
+
+    def _start(self, workers):
+        """Start the worker threads, in this process, if they aren't yet."""
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._threads = [
+                threading.Thread(target=self._work, daemon=True,
+                                 name=f"job-worker-{number}")
+                for number in range(workers)]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def _work(self):
+        while True:
+            try:
+                claimed = self.queue.claim(LEASE)
+                if claimed is None:
+                    self._wakeups.acquire(timeout=POLL_INTERVAL)
+                    continue
+
+                with self.app.app_context():
+                    self.run(*claimed)
+            except Exception:
+                # e.g. the queue file locked by other processes for too
+                # long: a job left claimed is run again once its lease
+                # runs out
+                self.app.logger.exception("Job worker error; carrying on.")
+                time.sleep(POLL_INTERVAL)
+
+    def run(self, job_id, name, args, attempts):
+        """Run a claimed job, then mark it done, or to retry, or failed."""
+
+        self._running.job_id = job_id
+        try:
+            if name not in self.jobs:
+                raise LookupError(f"Unknown job {name}.")
+            self._call(name, args)
+        except Exception as error:
+            db.session.rollback()
+            self.app.logger.exception("Job %s%r failed (attempt %d).",
+                                      name, tuple(args), attempts + 1)
+
+            if attempts + 1 >= MAX_ATTEMPTS:
+                self.queue.fail(job_id, repr(error))
+            else:
+                self.queue.retry(job_id, RETRY_DELAY * 2 ** attempts,
+                                 repr(error))
+        else:
+            self.queue.done(job_id)
+        finally:
+            self._running.job_id = None
+
+    def renew_lease(self):
+        """Give the job running on this thread another LEASE seconds.
+
+        Long jobs call it now and then; elsewhere it does nothing.
+        """
+
+        job_id = getattr(self._running, 'job_id', None)
+        if job_id is not None:
+            self.queue.renew(job_id, LEASE)
+
+    def join(self, timeout=10):
+        """Wait until no jobs are waiting or running; return whether so."""
+
+        deadline = time.monotonic() + timeout
+        while self.queue.size():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
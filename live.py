@@ -0,0 +1,241 @@
+"""Live timeline updates, as server-sent events.
+
+A homepage holds an EventSource open on /timeline/stream, and each
+message posted by someone the user follows is pushed down it as it's
+posted, so nobody has to reload the page (and rebuild the whole
+timeline) to see what's new.
+
+`Broker` is the in-process pub/sub between them: each stream subscribes
+to the channels of the users it follows (channels are author ids), and
+`messages_add` publishes each new message to its author's channel. Each
+subscription buffers at most SUBSCRIPTION_QUEUE_SIZE events; one whose
+client can't keep up is ended, and the client reconnects.
+
+With several worker processes, the poster and a follower's stream are
+usually in different processes. Given a `relay_dir`, the broker also
+relays every event to the other processes on the host, as datagrams to
+a Unix socket each process binds in that directory.
+
+Streams end after STREAM_TIMEOUT seconds, and EventSource reconnects by
+itself, sending the id of the last event it got (`Last-Event-ID`): the
+view replays what was missed from the timeline. A comment is sent every
+HEARTBEAT seconds, so connections whose client has gone are noticed and
+closed. Each open stream holds a worker thread, so run the app with
+threaded (or gevent) workers; past LIVE_MAX_STREAMS streams per
+process (see app.py), clients are told to retry later.
+"""
+
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from collections import defaultdict
+
+SUBSCRIPTION_QUEUE_SIZE = 100
+
+STREAM_TIMEOUT = 300
+HEARTBEAT = 15
+
+# Milliseconds clients wait to reconnect: after a stream ends, and when
+# there's no room for another stream
+RECONNECT_DELAY = 1000
+BUSY_RECONNECT_DELAY = 30000
+
+# Largest event relayed between processes
+MAX_DATAGRAM = 65536
+
+
+class Subscription:
+    """Events published on some channels, queued for one stream."""
+
+    def __init__(self, broker, channels, maxsize=SUBSCRIPTION_QUEUE_SIZE):
+        self.broker = broker
+        self.channels = frozenset(channels)
+        self.overflowed = False
+        self.closed = False
+        self._events = queue.Queue(maxsize)
+
+    def put(self, event):
+        try:
+            self._events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """The next event, waiting up to `timeout` seconds; else None."""
+
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.broker.unsubscribe(self)
+
+
+class Broker:
+    """In-process pub/sub, optionally relayed between processes."""
+
+    def __init__(self, relay_dir=None):
+        self.relay_dir = relay_dir
+        self._subscriptions = defaultdict(set)
+        self._count = 0
+        self._lock = threading.Lock()
+
+        self._socket = None
+        self._socket_path = None
+        self._pid = None
+
+    def subscribe(self, channels):
+        self._start_relay()
+
+        subscription = Subscription(self, channels)
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions[channel].add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribed = self._subscriptions[channel]
+                subscribed.discard(subscription)
+                if not subscribed:
+                    del self._subscriptions[channel]
+            self._count -= 1
+
+    def subscription_count(self):
+        return self._count
+
+    def publish(self, channel, event):
+        """Send `event` (JSON-able) to the subscribers of `channel`."""
+
+        self.deliver(channel, event)
+        if self.relay_dir:
+            self._relay(channel, event)
+
+    def deliver(self, channel, event):
+        """Send `event` to this process's subscribers of `channel`."""
+
+        with self._lock:
+            subscribed = list(self._subscriptions.get(channel, ()))
+
+        for subscription in subscribed:
+            subscription.put(event)
+
+    ##########################################################################
+    # Relaying between processes
+
+    def _start_relay(self):
+        """Bind this process's socket, if relaying and not yet bound.
+
+        Done again after a fork, since a worker can't use its master's.
+        """
+
+        if not self.relay_dir:
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            os.makedirs(self.relay_dir, exist_ok=True)
+            path = os.path.join(self.relay_dir,
+                                f"{os.getpid()}.{id(self)}.sock")
+            if os.path.exists(path):
+                os.unlink(path)
+
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            listener.bind(path)
+            threading.Thread(target=self._listen, args=(listener,),
+                             daemon=True, name="live-relay").start()
+
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+            self._socket_path = path
+            self._pid = os.getpid()
+
+    def _listen(self, listener):
+        while True:
+            data = listener.recv(MAX_DATAGRAM)
+            channel, event = json.loads(data)
+            self.deliver(channel, event)
+
+    def _relay(self, channel, event):
+        """Send `event` to every other process's socket in `relay_dir`."""
+
+        self._start_relay()
+
+        data = json.dumps([channel, event]).encode('utf-8')
+        if len(data) > MAX_DATAGRAM:
+            return
+
+        for name in os.listdir(self.relay_dir):
+            path = os.path.join(self.relay_dir, name)
+            if path == self._socket_path or not name.endswith('.sock'):
+                continue
+
+            try:
+                self._socket.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # its process is gone
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                # its buffer is full: it's falling behind, so skip it
+                pass
+
+
+##############################################################################
+# Server-sent events
+
+
+def format_event(event):
+    """An event (with an id) as a server-sent event."""
+
+    return f"id: {event['id']}\ndata: {json.dumps(event)}\n\n"
+
+
+def event_stream(subscription, missed=(), timeout=STREAM_TIMEOUT,
+                 heartbeat=HEARTBEAT):
+    """Server-sent events: `missed`, then what `subscription` gets.
+
+    Ends after `timeout` seconds, or once an overflowed subscription's
+    queue is sent, and closes the subscription.
+    """
+
+    try:
+        yield f"retry: {RECONNECT_DELAY}\n\n"
+        for event in missed:
+            yield format_event(event)
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            # once overflowed, send what's queued and end
+            event = subscription.get(0 if subscription.overflowed
+                                     else min(heartbeat, remaining))
+            if event is not None:
+                yield format_event(event)
+            elif subscription.overflowed:
+                break
+            else:
+                yield ": keepalive\n\n"
+    finally:
+        subscription.close()
+
+
+def busy_stream():
+    """A stream telling the client to come back later."""
+
+    yield f"retry: {BUSY_RECONNECT_DELAY}\n\n"
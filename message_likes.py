@@ -0,0 +1,104 @@
+"""Liking and unliking messages, idempotently.
+
+A like is a (user, message) pair, unique in the likes table. Likes are
+set to a state rather than toggled: liking a message that's already
+liked, or unliking one that isn't, changes nothing (and leaves the
+counters alone), so retried and duplicated requests are harmless.
+
+`set_likes` applies many changes in one transaction, for clients that
+batch up clicks.
+"""
+
+from sqlalchemy.dialects import postgresql
+
+import counters
+from models import db, Likes, Message
+
+# Most like changes taken in one batch
+MAX_BATCH = 100
+
+
+def is_liked(user_id, message_id):
+    query = Likes.query.filter_by(user_id=user_id, message_id=message_id)
+    return db.session.query(query.exists()).scalar()
+
+
+def _insert(user_id, message_id):
+    """Insert a like unless it exists; return whether it was inserted."""
+
+    values = {'user_id': user_id, 'message_id': message_id}
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        statement = (postgresql.insert(Likes.__table__)
+                               .values(**values)
+                               .on_conflict_do_nothing(
+                                   index_elements=['user_id', 'message_id']))
+    elif dialect == 'sqlite':
+        statement = (Likes.__table__.insert()
+                                    .prefix_with('OR IGNORE')
+                                    .values(**values))
+    else:
+        if is_liked(user_id, message_id):
+            return False
+        statement = Likes.__table__.insert().values(**values)
+
+    return db.session.execute(statement).rowcount == 1
+
+
+def _delete(user_id, message_id):
+    """Delete a like if it exists; return whether it was deleted."""
+
+    deleted = (Likes.query
+                    .filter_by(user_id=user_id, message_id=message_id)
+                    .delete(synchronize_session=False))
+    return deleted > 0
+
+
+def set_like(user_id, message_id, liked):
+    """Make `user_id` like `message_id` (or not); return whether it changed.
+
+    The caller commits.
+    """
+
+    if liked:
+        changed = _insert(user_id, message_id)
+        if changed:
+            counters.liked(user_id)
+    else:
+        changed = _delete(user_id, message_id)
+        if changed:
+            counters.unliked(user_id)
+
+    return changed
+
+
+def set_likes(user_id, changes):
+    """Apply {message id: liked} changes for `user_id`.
+
+    Returns {message id: changed} for the messages that exist; others
+    are skipped. The caller commits, so the changes all happen or none.
+    """
+
+    existing = {message_id for (message_id,)
+                in db.session.query(Message.id)
+                             .filter(Message.id.in_(list(changes)))}
+
+    # in id order, so concurrent batches lock rows in the same order
+    return {message_id: set_like(user_id, message_id, changes[message_id])
+            for message_id in sorted(existing)}
+
+
+def remove_duplicate_likes():
+    """Delete all but the first of any duplicate likes; return how many.
+
+    Databases from before likes were unique may have duplicates, which
+    have to go before the unique index can be created.
+    """
+
+    first_likes = (db.session.query(db.func.min(Likes.id))
+                             .group_by(Likes.user_id, Likes.message_id))
+
+    return (Likes.query
+                 .filter(~Likes.id.in_(first_likes))
+                 .delete(synchronize_session=False))
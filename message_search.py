@@ -0,0 +1,252 @@
+"""Full-text search over message text.
+
+On PostgreSQL, messages are matched with `to_tsvector('english', text)
+@@ plainto_tsquery(...)`, answered by a GIN expression index over that
+tsvector (created with the messages table or by `flask create-indexes`;
+see models.py), and ranked with ts_rank_cd. The index stays current by
+itself, so new and deleted messages show up in results immediately.
+
+Other databases (SQLite for local runs) use `InvertedIndex`, an
+in-process index of every message's words scored with BM25. Like the
+username index in search.py, it's built on first use and kept current
+from the message and account routes, in each worker process.
+
+Both backends match messages containing every word of the query, best
+first, and page through them with (rank, id) cursors.
+"""
+
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from decimal import Decimal
+
+from sqlalchemy import cast, func, literal_column, tuple_
+
+from models import db, Message
+from pagination import PAGE_SIZE, encode_rank_cursor
+import queries
+
+SEARCH_CONFIG = literal_column("'english'::regconfig")
+
+# Ranks are compared exactly between pages, so they're rounded to this
+# many decimal places (PostgreSQL's ranks are single precision anyway).
+RANK_PLACES = 6
+
+
+def uses_text_search_index():
+    """Is the database PostgreSQL, with its tsvector index?"""
+
+    return db.engine.dialect.name == 'postgresql'
+
+
+def search_messages(query, position=None, limit=PAGE_SIZE):
+    """Return (messages, next cursor) for a page of messages matching `query`.
+
+    `position` is a decoded rank cursor; None means start from the best
+    match. The cursor is None after the last page.
+    """
+
+    if not query:
+        return [], None
+
+    if uses_text_search_index():
+        rows = database_search_query(query, position, limit).all()
+        messages = [message for message, _ in rows]
+        ranked = [(message.id, rank) for message, rank in rows]
+    else:
+        ranked = get_inverted_index().search(query, limit, position)
+        messages = _messages_in_order([message_id for message_id, _ in ranked])
+
+    cursor = None
+    if len(ranked) == limit:
+        message_id, rank = ranked[-1]
+        cursor = encode_rank_cursor(rank, message_id)
+
+    return messages, cursor
+
+
+def database_search_query(query, position=None, limit=PAGE_SIZE):
+    """Query (message, rank) rows matching `query`, using the tsvector index."""
+
+    document = func.to_tsvector(SEARCH_CONFIG, Message.text)
+    tsquery = func.plainto_tsquery(SEARCH_CONFIG, query)
+    rank = cast(func.ts_rank_cd(document, tsquery),
+                db.Numeric(12, RANK_PLACES))
+
+    results = (queries.with_authors(Message.query)
+                      .add_columns(rank.label('rank'))
+                      .filter(document.op('@@')(tsquery)))
+
+    if position is not None:
+        results = results.filter(tuple_(rank, Message.id) < position)
+
+    return results.order_by(rank.desc(), Message.id.desc()).limit(limit)
+
+
+def _messages_in_order(ids):
+    """Load messages (and authors) by id, keeping the order of `ids`."""
+
+    if not ids:
+        return []
+
+    messages = {message.id: message for message in
+                queries.with_authors(Message.query)
+                       .filter(Message.id.in_(ids))}
+    return [messages[message_id] for message_id in ids
+            if message_id in messages]
+
+
+##############################################################################
+# In-process fallback index
+
+
+STOP_WORDS = frozenset(
+    "a an and are as at be but by for from has have i in is it its me my "
+    "of on or so that the this to was we were with you your".split())
+
+WORD_RE = re.compile(r"\w+")
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def words(text):
+    """The indexable words of `text`: lowercased, without stop words."""
+
+    return [word for word in WORD_RE.findall(text.lower())
+            if word not in STOP_WORDS]
+
+
+class InvertedIndex:
+    """Word -> {message id: term frequency} index of message text."""
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        self.total_length = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def build(cls, rows):
+        """Build an index from (message_id, user_id, text) rows."""
+
+        index = cls()
+        for message_id, user_id, text in rows:
+            index._add(message_id, user_id, text)
+        return index
+
+    def add(self, message_id, user_id, text):
+        with self.lock:
+            self._remove(message_id)
+            self._add(message_id, user_id, text)
+
+    def remove(self, message_id):
+        with self.lock:
+            self._remove(message_id)
+
+    def remove_user(self, user_id):
+        """Drop every message by `user_id`."""
+
+        with self.lock:
+            for message_id in [message_id for message_id, document
+                               in self.documents.items()
+                               if document[0] == user_id]:
+                self._remove(message_id)
+
+    def _add(self, message_id, user_id, text):
+        counts = Counter(words(text))
+        for word, count in counts.items():
+            self.postings[word][message_id] = count
+
+        length = sum(counts.values())
+        self.documents[message_id] = (user_id, length, tuple(counts))
+        self.total_length += length
+
+    def _remove(self, message_id):
+        document = self.documents.pop(message_id, None)
+        if document is None:
+            return
+
+        _, length, document_words = document
+        for word in document_words:
+            self.postings[word].pop(message_id, None)
+        self.total_length -= length
+
+    def search(self, query, limit, position=None):
+        """Return up to `limit` (message id, rank) pairs, best first.
+
+        Only messages containing every word of `query` match. `position`
+        is a (rank, id) cursor; results start after it.
+        """
+
+        query_words = set(words(query))
+        if not query_words:
+            return []
+
+        with self.lock:
+            postings = sorted((self.postings.get(word, {})
+                               for word in query_words), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+            if not candidates:
+                return []
+
+            num_documents = len(self.documents)
+            average_length = self.total_length / num_documents or 1
+            weights = [math.log(1 + (num_documents - len(posting) + 0.5)
+                                / (len(posting) + 0.5))
+                       for posting in postings]
+
+            ranked = []
+            for message_id in candidates:
+                length = self.documents[message_id][1]
+                norm = K1 * (1 - B + B * length / average_length)
+                score = sum(weight * posting[message_id] * (K1 + 1)
+                            / (posting[message_id] + norm)
+                            for weight, posting in zip(weights, postings))
+                rank = round(Decimal(score), RANK_PLACES)
+                if position is None or (rank, message_id) < position:
+                    ranked.append((rank, message_id))
+
+        ranked.sort(reverse=True)
+        return [(message_id, rank) for rank, message_id in ranked[:limit]]
+
+
+_inverted_index = None
+_inverted_index_lock = threading.Lock()
+
+
+def get_inverted_index():
+    """Return the in-process index, building it from the database once."""
+
+    global _inverted_index
+
+    with _inverted_index_lock:
+        if _inverted_index is None:
+            _inverted_index = InvertedIndex.build(
+                db.session.query(Message.id, Message.user_id, Message.text)
+                          .yield_per(10000))
+
+    return _inverted_index
+
+
+def message_added(message):
+    """Index a new message in the in-process index."""
+
+    if _inverted_index is not None:
+        _inverted_index.add(message.id, message.user_id, message.text)
+
+
+def message_removed(message_id):
+    """Drop a deleted message from the in-process index."""
+
+    if _inverted_index is not None:
+        _inverted_index.remove(message_id)
+
+
+def user_removed(user_id):
+    """Drop a deleted user's messages from the in-process index."""
+
+    if _inverted_index is not None:
+        _inverted_index.remove_user(user_id)
@@ -2,12 +2,34 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, event, DDL
+
+import passwords
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# PostgreSQL extensions some indexes depend on
+POSTGRESQL_EXTENSIONS = ('pg_trgm',)
+
+# PostgreSQL expression indexes, which can't be declared portably on the
+# models: {index name: (table name, CREATE INDEX statement)}
+POSTGRESQL_INDEXES = {
+    # Full-text search over messages (see message_search.py)
+    'ix_messages_text_search': (
+        'messages',
+        "CREATE INDEX ix_messages_text_search ON messages "
+        "USING gin (to_tsvector('english'::regconfig, text))"),
+
+    # Case-insensitive typeahead (see search.py): the lowercased username
+    # in byte ("C") order, for LIKE 'q%' range scans already in the order
+    # the typeahead lists them
+    'ix_users_username_lower_c': (
+        'users',
+        "CREATE INDEX ix_users_username_lower_c ON users "
+        "((lower(username) COLLATE \"C\"), id)"),
+}
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -26,6 +48,20 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key covers "who follows X"; this covers "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? (a primary key lookup)"""
+
+        query = cls.query.filter_by(user_following_id=follower_id,
+                                    user_being_followed_id=followed_id)
+        return db.session.query(query.exists()).scalar()
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -47,6 +83,13 @@ class Likes(db.Model):
         db.ForeignKey('messages.id', ondelete='cascade')
     )
 
+    # A user likes a message at most once (see message_likes.py); the
+    # unique index also answers "has X liked these messages?"
+    __table_args__ = (
+        db.Index('uq_likes_user_id_message_id', 'user_id', 'message_id',
+                 unique=True),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
 
 
 class User(db.Model):
@@ -94,6 +137,62 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized relationship sizes, kept current by counters.py so pages
+    # don't load whole collections just to count them
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set when the user deletes their account; its rows are purged later
+    # (see deletion.py)
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # Set while the user's messages are pulled into followers' timelines
+    # rather than pushed: since when (see timelines.py)
+    pulled_since = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        # Find the high-follower users, and those whose messages timelines
+        # pull on read (see timelines.py)
+        db.Index('ix_users_followers_count', 'followers_count'),
+        db.Index('ix_users_pulled_since', 'pulled_since'),
+
+        # Username search (see search.py): trigrams for ILIKE '%q%'; the
+        # typeahead's index is in POSTGRESQL_INDEXES
+        db.Index('ix_users_username_trgm', 'username',
+                 postgresql_using='gin',
+                 postgresql_ops={'username': 'gin_trgm_ops'}),
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -121,23 +220,55 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(other_user.id, self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(self.id, other_user.id)
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        Answers `is_following` for a whole page of users with one query;
+        returns a set of ids.
+        """
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        rows = (db.session.query(Follows.user_being_followed_id)
+                          .filter(Follows.user_following_id == self.id,
+                                  Follows.user_being_followed_id.in_(user_ids)))
+        return {user_id for (user_id,) in rows}
+
+    def liked_ids_among(self, message_ids):
+        """Which of `message_ids` has this user liked? (one query)"""
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        rows = (db.session.query(Likes.message_id)
+                          .filter(Likes.user_id == self.id,
+                                  Likes.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in rows}
+
+    @classmethod
+    def get_active_or_404(cls, user_id):
+        """The user with `user_id`; 404 if there's none, or it's deleted."""
+
+        return cls.query.filter_by(id=user_id, deleted_at=None).first_or_404()
 
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
 
-        Hashes password and adds user to system.
+        Hashes password (on the password pool) and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash_password(password)
 
         user = User(
             username=username,
@@ -158,15 +289,25 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A hash made with an outdated work factor is replaced with a new one;
+        the caller should commit.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check_password(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash_password(password)
                 return user
 
+        else:
+            # Take as long as a real check, so that response times don't
+            # reveal which usernames exist.
+            passwords.check_password(passwords.dummy_hash(), password)
+
         return False
 
 
@@ -188,7 +329,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,6 +340,48 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # A user's messages, newest first (profile pages and timeline pulls)
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp',
+                 'user_id', 'timestamp', 'id'),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's home timeline.
+
+    Rows are written when a message is posted (fan-out on write), so the
+    homepage reads a user's feed straight from here instead of scanning
+    the messages of everyone they follow.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        # Finds a message's entries when it's deleted (by ON DELETE
+        # CASCADE, too), which would otherwise scan every timeline
+        db.Index('ix_timeline_entries_message_id', 'message_id'),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -208,3 +391,86 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+
+
+def create_extensions(target=None, bind=None, **kwargs):
+    """Create the PostgreSQL extensions our indexes need, if missing."""
+
+    bind = bind or db.engine
+    if bind.dialect.name == 'postgresql':
+        for extension in POSTGRESQL_EXTENSIONS:
+            bind.execute(DDL(f'CREATE EXTENSION IF NOT EXISTS {extension}'))
+
+
+event.listen(db.Model.metadata, 'before_create', create_extensions)
+
+for _table, _statement in POSTGRESQL_INDEXES.values():
+    event.listen(db.Model.metadata.tables[_table], 'after_create',
+                 DDL(_statement).execute_if(dialect='postgresql'))
+
+
+def create_missing_indexes():
+    """Create any declared index that doesn't exist in the database yet.
+
+    `db.create_all()` only creates indexes along with new tables, so this
+    adds indexes declared after a table was first created. Returns the
+    names of the indexes created.
+    """
+
+    create_extensions()
+
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                created.append(index.name)
+
+    if db.engine.dialect.name == 'postgresql':
+        for name, (table, statement) in POSTGRESQL_INDEXES.items():
+            exists = db.engine.execute("SELECT to_regclass(%(name)s)",
+                                       {'name': name}).scalar()
+            if table in tables and exists is None:
+                db.engine.execute(DDL(statement))
+                created.append(name)
+
+    return created
+
+
+def drop_indexes():
+    """Drop the declared secondary indexes, e.g. before a bulk load.
+
+    Loading rows and then building each index once is much faster than
+    updating every index row by row. `create_missing_indexes()` puts them
+    back. Returns the names of the indexes dropped.
+    """
+
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    dropped = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                index.drop(bind=db.engine)
+                dropped.append(index.name)
+
+    if db.engine.dialect.name == 'postgresql':
+        for name in POSTGRESQL_INDEXES:
+            if db.engine.execute("SELECT to_regclass(%(name)s)",
+                                 {'name': name}).scalar() is not None:
+                db.engine.execute(DDL(f'DROP INDEX {name}'))
+                dropped.append(name)
+
+    return dropped
@@ -0,0 +1,89 @@
+"""Keyset (cursor) pagination for message lists.
+
+Pages are ordered newest first by (timestamp, id). A cursor names the last
+row of the previous page, and the next page is everything strictly older:
+
+    WHERE (timestamp, id) < (:timestamp, :id)
+    ORDER BY timestamp DESC, id DESC
+    LIMIT :page_size
+
+With an index ending in (timestamp, id) this is an index range scan at any
+depth, unlike OFFSET, which has to walk past every skipped row.
+
+Search results are ordered by relevance instead, so their cursors name a
+(rank, id) position; ranks are fixed-point decimals so they compare
+exactly after a round trip through the URL.
+"""
+
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import tuple_
+
+PAGE_SIZE = 20
+
+CURSOR_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(timestamp, row_id):
+    """Return an opaque, URL-safe cursor for a (timestamp, id) position."""
+
+    return f"{timestamp.strftime(CURSOR_TIMESTAMP_FORMAT)}-{row_id}"
+
+
+def decode_cursor(cursor):
+    """Return the (timestamp, id) a cursor names, or None if it's invalid."""
+
+    if not cursor:
+        return None
+
+    try:
+        timestamp, row_id = cursor.split('-')
+        return (datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT),
+                int(row_id))
+    except ValueError:
+        return None
+
+
+def encode_rank_cursor(rank, row_id):
+    """Return an opaque, URL-safe cursor for a (rank, id) position."""
+
+    return f"{rank}-{row_id}"
+
+
+def decode_rank_cursor(cursor):
+    """Return the (rank, id) a rank cursor names, or None if it's invalid."""
+
+    if not cursor:
+        return None
+
+    try:
+        rank, row_id = cursor.split('-')
+        rank = Decimal(rank)
+        row_id = int(row_id)
+    except (ValueError, InvalidOperation):
+        return None
+
+    return (rank, row_id) if rank.is_finite() else None
+
+
+def next_cursor(messages, page_size=PAGE_SIZE):
+    """Return the cursor for the page after `messages`, or None if last."""
+
+    if len(messages) < page_size:
+        return None
+
+    last = messages[-1]
+    return encode_cursor(last.timestamp, last.id)
+
+
+def before(query, timestamp_col, id_col, position):
+    """Restrict `query` to rows older than `position` and order newest first.
+
+    `position` is a decoded cursor; None means start from the newest row.
+    """
+
+    if position is not None:
+        query = query.filter(tuple_(timestamp_col, id_col) < position)
+
+    return query.order_by(timestamp_col.desc(), id_col.desc())
@@ -0,0 +1,197 @@
+"""Password hashing on a bounded pool of worker processes.
+
+bcrypt is deliberately slow: at the default work factor a hash or check
+costs about 250ms of CPU. Run on the request thread, that's 250ms for
+which the worker's core is busy hashing, and with gevent workers the
+whole event loop stalls. Here the work runs in a process pool instead:
+the request just waits on a future, so threaded and gevent workers keep
+serving other requests meanwhile, and the pool size caps how many cores
+hashing can take, however many logins arrive at once. (A sync worker
+would still be tied up for the whole hash, which is why the Procfile
+runs gunicorn with threads.)
+
+At most PASSWORD_QUEUE_SIZE hashes wait or run at a time, per process;
+beyond that, callers wait up to PASSWORD_QUEUE_TIMEOUT seconds for a
+slot and then get `PasswordPoolBusy`.
+
+`hash_password` and `check_password` block until the result is ready;
+`hash_password_async` and `check_password_async` are awaitable versions
+for asyncio code.
+
+Configuration (app.config, from the environment in app.py):
+
+- BCRYPT_LOG_ROUNDS: work factor for new hashes (default 12). Hashes
+  with another work factor are upgraded when their user logs in.
+- PASSWORD_HASH_WORKERS: pool processes per web worker (default: the
+  host's cores split between its WEB_CONCURRENCY web workers, so all
+  the pools together have a process per core); 0 runs bcrypt inline on
+  the calling thread, e.g. for tests.
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import bcrypt
+from flask import current_app, has_app_context
+
+DEFAULT_ROUNDS = 12
+
+PASSWORD_QUEUE_SIZE = int(os.environ.get('PASSWORD_QUEUE_SIZE', 64))
+PASSWORD_QUEUE_TIMEOUT = float(os.environ.get('PASSWORD_QUEUE_TIMEOUT', 5))
+
+
+class PasswordPoolBusy(Exception):
+    """Too many password hashes are already waiting."""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(password_hash, password):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'),
+                              password_hash.encode('utf-8'))
+    except ValueError:
+        # not a bcrypt hash at all
+        return False
+
+
+##############################################################################
+# The pool
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(PASSWORD_QUEUE_SIZE)
+
+
+def _config(name, default):
+    if has_app_context():
+        return current_app.config.get(name, default)
+    return default
+
+
+def default_workers():
+    """Pool processes per web worker: the host's cores, shared out."""
+
+    web_workers = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+    return max(1, (os.cpu_count() or 1) // web_workers)
+
+
+def get_pool():
+    """Return this process's pool, or None to hash inline.
+
+    The pool is started on first use, and again after a fork (a gunicorn
+    worker can't use its master's pool).
+    """
+
+    global _pool, _pool_pid
+
+    workers = _config('PASSWORD_HASH_WORKERS', default_workers())
+    if not workers:
+        return None
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_pid = os.getpid()
+
+    return _pool
+
+
+def submit(func, *args, timeout=PASSWORD_QUEUE_TIMEOUT):
+    """Run `func(*args)` on the pool; return a concurrent Future.
+
+    Waits up to `timeout` seconds for a free slot in the queue.
+    """
+
+    pool = get_pool()
+    if pool is None:
+        future = Future()
+        future.set_result(func(*args))
+        return future
+
+    if not _slots.acquire(timeout=timeout):
+        raise PasswordPoolBusy()
+
+    try:
+        future = pool.submit(func, *args)
+    except Exception:
+        _slots.release()
+        raise
+
+    future.add_done_callback(lambda future: _slots.release())
+    return future
+
+
+##############################################################################
+# Hashing and checking
+
+
+def rounds():
+    """The work factor for new hashes."""
+
+    return _config('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS)
+
+
+def needs_rehash(password_hash):
+    """Was `password_hash` made with a work factor other than the current?"""
+
+    try:
+        return int(password_hash.split('$')[2]) != rounds()
+    except (IndexError, ValueError):
+        return True
+
+
+_dummy_hashes = {}
+
+
+def dummy_hash():
+    """A hash (at the current work factor) that no password matches.
+
+    Checking a password against it takes as long as checking a real one,
+    so logins for unknown usernames aren't measurably faster.
+    """
+
+    work_factor = rounds()
+    if work_factor not in _dummy_hashes:
+        _dummy_hashes[work_factor] = _hash(os.urandom(16).hex(), work_factor)
+
+    return _dummy_hashes[work_factor]
+
+
+def hash_password(password):
+    """Return a bcrypt hash of `password` (a str)."""
+
+    if not password:
+        raise ValueError("Password must be non-empty.")
+
+    return submit(_hash, password, rounds()).result()
+
+
+def check_password(password_hash, password):
+    """Does `password` match `password_hash`?"""
+
+    return submit(_check, password_hash, password).result()
+
+
+# The async versions don't wait for a slot, since that would block the
+# event loop; they raise PasswordPoolBusy straight away instead.
+
+
+async def hash_password_async(password):
+    if not password:
+        raise ValueError("Password must be non-empty.")
+
+    return await asyncio.wrap_future(
+        submit(_hash, password, rounds(), timeout=0))
+
+
+async def check_password_async(password_hash, password):
+    return await asyncio.wrap_future(
+        submit(_check, password_hash, password, timeout=0))
@@ -0,0 +1,101 @@
+"""Query builders for lists of messages and users.
+
+Templates that render message lists read `msg.user.username` and
+`msg.user.image_url` for every message. Loading `Message.user` lazily
+costs one query per message, so these builders join each message's
+author in the same query, and only load the columns the lists display.
+The join also leaves out the messages of deleted accounts, which stay
+in the tables until they're purged (see deletion.py).
+"""
+
+from sqlalchemy.orm import contains_eager, load_only
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from pagination import PAGE_SIZE, before
+
+MESSAGE_COLUMNS = ('id', 'text', 'timestamp', 'user_id')
+AUTHOR_COLUMNS = ('id', 'username', 'image_url')
+
+
+def with_authors(query):
+    """Load each message's author along with it, in a single query.
+
+    Messages by deleted users are left out. Apply it before any LIMIT.
+    """
+
+    return (query.join(Message.user)
+                 .filter(User.deleted_at.is_(None))
+                 .options(load_only(*MESSAGE_COLUMNS),
+                          contains_eager(Message.user)
+                          .load_only(*AUTHOR_COLUMNS)))
+
+
+def user_messages(user_id, position=None, limit=PAGE_SIZE):
+    """Query a page of `user_id`'s own messages, newest first."""
+
+    query = (Message.query
+                    .options(load_only(*MESSAGE_COLUMNS))
+                    .filter(Message.user_id == user_id))
+
+    return before(query, Message.timestamp, Message.id, position).limit(limit)
+
+
+def user_message_ids(user_id, position=None, limit=PAGE_SIZE):
+    """Query just the ids of a page of `user_id`'s messages (index only)."""
+
+    query = db.session.query(Message.id).filter(Message.user_id == user_id)
+
+    return before(query, Message.timestamp, Message.id, position).limit(limit)
+
+
+def author_messages(user_id, position=None, limit=PAGE_SIZE):
+    """Like `user_messages`, but also loading the (shared) author."""
+
+    query = with_authors(Message.query).filter(Message.user_id == user_id)
+
+    return before(query, Message.timestamp, Message.id, position).limit(limit)
+
+
+def timeline_messages(user_id, position=None, limit=PAGE_SIZE):
+    """Query a page of messages pushed to `user_id`'s timeline."""
+
+    query = (with_authors(Message.query)
+                 .join(TimelineEntry,
+                       TimelineEntry.message_id == Message.id)
+                 .filter(TimelineEntry.user_id == user_id))
+
+    return before(query,
+                  TimelineEntry.timestamp,
+                  TimelineEntry.message_id,
+                  position).limit(limit)
+
+
+def liked_messages(user_id):
+    """Query the messages `user_id` has liked, most recently liked first."""
+
+    query = (Message.query
+                    .join(Likes, Likes.message_id == Message.id)
+                    .filter(Likes.user_id == user_id)
+                    .order_by(Likes.id.desc()))
+
+    return with_authors(query)
+
+
+def followed_users(user_id):
+    """Query the users `user_id` follows, leaving out deleted accounts."""
+
+    return (User.query
+                .join(Follows, Follows.user_being_followed_id == User.id)
+                .filter(Follows.user_following_id == user_id,
+                        User.deleted_at.is_(None))
+                .order_by(User.id))
+
+
+def follower_users(user_id):
+    """Query the users following `user_id`, leaving out deleted accounts."""
+
+    return (User.query
+                .join(Follows, Follows.user_following_id == User.id)
+                .filter(Follows.user_being_followed_id == user_id,
+                        User.deleted_at.is_(None))
+                .order_by(User.id))
@@ -0,0 +1,192 @@
+"""Token-bucket rate limiting, and a cache of recent failed logins.
+
+Every bcrypt check costs about 250ms of CPU, so an unthrottled /login is
+the cheapest way to exhaust our CPU. Login attempts are limited by
+token buckets (per client IP, and per username) that are checked before
+any password hashing, and a wrong password that was just tried for the
+same username is rejected straight from `FailedLoginCache`.
+
+Each bucket holds up to `burst` tokens and refills at `rate` tokens per
+second; an attempt takes a token, and is refused when there are none.
+
+Buckets are kept in process by default (`MemoryBackend`), so each
+worker counts separately. `SqliteBackend` keeps them in a local SQLite
+file instead, shared by all the workers on a host.
+"""
+
+import hashlib
+import hmac
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryBackend:
+    """Buckets in a bounded in-process dict (least recently used go)."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def update(self, key, func, expires):
+        """Replace the state of `key` with func(state)[0] (atomically).
+
+        State is None for a new key. Returns func(state)[1]. The key can
+        be forgotten after `expires` (by when its bucket is full again);
+        here it's forgotten when least recently used instead.
+        """
+
+        with self._lock:
+            state, result = func(self._buckets.get(key))
+            self._buckets[key] = state
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SqliteBackend:
+    """Buckets in a SQLite file, shared by processes on the same host."""
+
+    # Delete expired buckets every this many updates
+    PURGE_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._updates = 0
+
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL, updated REAL, "
+                "expires REAL)")
+
+    def _connect(self):
+        # a connection per thread (and per process, after a fork)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def update(self, key, func, expires):
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?",
+                (key,)).fetchone()
+            (tokens, updated), result = func(row)
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                (key, tokens, updated, expires))
+
+            self._updates += 1
+            if self._updates % self.PURGE_EVERY == 0:
+                connection.execute("DELETE FROM buckets WHERE expires < ?",
+                                   (updated,))
+
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        return result
+
+    def clear(self):
+        self._connect().execute("DELETE FROM buckets")
+
+
+class RateLimiter:
+    """Token buckets, by key, in a backend."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+
+    def take(self, key, rate, burst, cost=1):
+        """Take `cost` tokens from the bucket for `key`, if it has them.
+
+        The bucket refills at `rate` tokens/second up to `burst` (a rate
+        of 0 never refills it). Returns whether there were enough tokens;
+        with a cost of 0, just checks there's at least one.
+        """
+
+        now = time.time()
+        rate = max(rate, 0)
+
+        def refill_and_take(state):
+            if state is None:
+                tokens = burst
+            else:
+                tokens, updated = state
+                tokens = min(burst, tokens + (now - updated) * rate)
+
+            allowed = tokens >= max(cost, 1)
+            if allowed:
+                tokens -= cost
+
+            return (tokens, now), allowed
+
+        if rate:
+            expires = now + burst / rate
+        else:
+            # Never full again, so never forgotten
+            expires = float('inf')
+
+        return self.backend.update(key, refill_and_take, expires=expires)
+
+
+class FailedLoginCache:
+    """Remembers (username, password) pairs that just failed to log in.
+
+    A retry of the same wrong password is rejected without bcrypt. Pairs
+    are stored as keyed HMACs, never in plain text, and forgotten after
+    `ttl` seconds. Usernames are matched exactly, as `User.authenticate`
+    looks them up: "Alice" and "alice" are different accounts.
+    """
+
+    def __init__(self, secret, ttl=600, maxsize=10000):
+        self.secret = secret.encode('utf-8')
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._failures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, username, password):
+        message = f"{username}\0{password}".encode('utf-8')
+        return hmac.new(self.secret, message, hashlib.sha256).digest()
+
+    def __contains__(self, attempt):
+        digest = self._digest(*attempt)
+        with self._lock:
+            expires = self._failures.get(digest)
+            return expires is not None and expires > time.monotonic()
+
+    def add(self, username, password):
+        digest = self._digest(username, password)
+        with self._lock:
+            self._failures[digest] = time.monotonic() + self.ttl
+            self._failures.move_to_end(digest)
+            while len(self._failures) > self.maxsize:
+                self._failures.popitem(last=False)
+
+    def discard(self, username, password):
+        """Forget a failure, e.g. when `username` signs up with `password`."""
+
+        with self._lock:
+            self._failures.pop(self._digest(username, password), None)
+
+    def clear(self):
+        with self._lock:
+            self._failures.clear()
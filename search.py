@@ -0,0 +1,273 @@
+"""Username search for /users and the search box typeahead.
+
+On PostgreSQL, substring search is answered by a pg_trgm GIN index on
+`users.username` (which supports ILIKE '%q%'), and typeahead prefix
+search by a B-tree index on `lower(username)` in the "C" collation: a
+range scan for lower(username) LIKE 'q%' that also yields matches in
+the order listed, so only the first few are read. Both ignore case.
+
+Other databases (SQLite for local runs) use `NgramIndex`, an in-process
+trigram index of every username, built on first use and kept current
+from signup, profile edits and account deletion. It lives in each worker
+process, so it's meant for local development rather than production.
+
+Results are ranked: exact match, then prefix matches, then other matches,
+with closer (shorter) usernames first within each group.
+"""
+
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+from sqlalchemy import case, func, literal_column
+
+from models import db, User
+
+SEARCH_PAGE_SIZE = 24
+TYPEAHEAD_LIMIT = 8
+
+# Deep pages of a ranked search are rarely wanted and cost an OFFSET scan
+MAX_SEARCH_PAGE = 20
+
+
+def uses_trigram_index():
+    """Is the database PostgreSQL, with its pg_trgm username index?"""
+
+    return db.engine.dialect.name == 'postgresql'
+
+
+def escape_like(text):
+    """Escape LIKE wildcards so `text` only matches itself."""
+
+    return (text.replace('\\', '\\\\')
+                .replace('%', '\\%')
+                .replace('_', '\\_'))
+
+
+def search_users(query, page=1):
+    """Return a page of users whose username contains `query`, best first."""
+
+    page = max(1, min(page, MAX_SEARCH_PAGE))
+    offset = (page - 1) * SEARCH_PAGE_SIZE
+
+    if not query:
+        return (active_users()
+                    .order_by(User.id)
+                    .offset(offset)
+                    .limit(SEARCH_PAGE_SIZE)
+                    .all())
+
+    if uses_trigram_index():
+        return (database_search_query(query)
+                .offset(offset)
+                .limit(SEARCH_PAGE_SIZE)
+                .all())
+
+    ids = get_ngram_index().search(query, SEARCH_PAGE_SIZE, offset)
+    return _users_in_order(ids)
+
+
+def typeahead(query, limit=TYPEAHEAD_LIMIT):
+    """Return up to `limit` users whose username starts with `query`."""
+
+    if not query:
+        return []
+
+    if uses_trigram_index():
+        return database_typeahead_query(query).limit(limit).all()
+
+    return _users_in_order(get_ngram_index().prefix(query, limit))
+
+
+def database_search_query(query):
+    """Query users matching `query`, ranked, using the trigram index."""
+
+    pattern = escape_like(query)
+    rank = case([(func.lower(User.username) == query.lower(), 0),
+                 (User.username.ilike(f"{pattern}%", escape='\\'), 1)],
+                else_=2)
+
+    return (active_users()
+                .filter(User.username.ilike(f"%{pattern}%", escape='\\'))
+                .order_by(rank,
+                          func.length(User.username),
+                          User.username))
+
+
+def database_typeahead_query(query):
+    """Query users whose username starts with `query` (in any case)."""
+
+    username = by_bytes(func.lower(User.username))
+
+    return (active_users()
+                .filter(username.like(f"{escape_like(query.lower())}%",
+                                      escape='\\'))
+                .order_by(username, User.id))
+
+
+def by_bytes(expression):
+    """`expression` compared byte by byte, as its typeahead index sorts it.
+
+    On PostgreSQL that's the "C" collation (written out, since older
+    SQLAlchemy versions don't quote collation names); SQLite compares
+    bytes by default.
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        return expression.op('COLLATE')(literal_column('"C"'))
+    return expression
+
+
+def active_users():
+    """Query the users that haven't deleted their accounts."""
+
+    return User.query.filter(User.deleted_at.is_(None))
+
+
+def _users_in_order(ids):
+    """Load users by id, keeping the order of `ids`."""
+
+    if not ids:
+        return []
+
+    users = {user.id: user
+             for user in active_users().filter(User.id.in_(ids))}
+    return [users[user_id] for user_id in ids if user_id in users]
+
+
+##############################################################################
+# In-process fallback index
+
+
+def trigrams(text):
+    """The set of 3-character substrings of `text` (lowercased)."""
+
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class NgramIndex:
+    """Trigram inverted index over usernames, plus a sorted prefix list."""
+
+    def __init__(self):
+        self.usernames = {}
+        self.postings = defaultdict(set)
+        self.sorted_names = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def build(cls, rows):
+        """Build an index from (user_id, username) rows in one pass."""
+
+        index = cls()
+        for user_id, username in rows:
+            index.usernames[user_id] = username
+            for gram in trigrams(username):
+                index.postings[gram].add(user_id)
+
+        index.sorted_names = sorted((username.lower(), user_id)
+                                    for user_id, username
+                                    in index.usernames.items())
+        return index
+
+    def add(self, user_id, username):
+        with self.lock:
+            self._remove(user_id)
+            self.usernames[user_id] = username
+            for gram in trigrams(username):
+                self.postings[gram].add(user_id)
+
+            key = (username.lower(), user_id)
+            self.sorted_names.insert(bisect_left(self.sorted_names, key), key)
+
+    def remove(self, user_id):
+        with self.lock:
+            self._remove(user_id)
+
+    def _remove(self, user_id):
+        username = self.usernames.pop(user_id, None)
+        if username is None:
+            return
+
+        for gram in trigrams(username):
+            self.postings[gram].discard(user_id)
+
+        key = (username.lower(), user_id)
+        index = bisect_left(self.sorted_names, key)
+        if index < len(self.sorted_names) and self.sorted_names[index] == key:
+            del self.sorted_names[index]
+
+    def search(self, query, limit, offset=0):
+        """Return ranked ids of users whose username contains `query`."""
+
+        query = query.lower()
+
+        with self.lock:
+            grams = trigrams(query)
+            if grams:
+                # Only ids having every trigram of the query can match;
+                # intersect starting from the rarest trigram.
+                postings = sorted((self.postings.get(gram, set())
+                                   for gram in grams), key=len)
+                candidates = set(postings[0]).intersection(*postings[1:])
+            else:
+                candidates = self.usernames
+
+            matches = [(self.usernames[user_id].lower(), user_id)
+                       for user_id in candidates
+                       if query in self.usernames[user_id].lower()]
+
+        def rank(match):
+            name, user_id = match
+            group = 0 if name == query else 1 if name.startswith(query) else 2
+            return (group, len(name), name)
+
+        matches.sort(key=rank)
+        return [user_id for _, user_id in matches[offset:offset + limit]]
+
+    def prefix(self, query, limit):
+        """Return ids of the first `limit` usernames starting with `query`."""
+
+        query = query.lower()
+
+        with self.lock:
+            start = bisect_left(self.sorted_names, (query,))
+            ids = []
+            for name, user_id in self.sorted_names[start:start + limit]:
+                if not name.startswith(query):
+                    break
+                ids.append(user_id)
+
+        return ids
+
+
+_ngram_index = None
+_ngram_index_lock = threading.Lock()
+
+
+def get_ngram_index():
+    """Return the in-process index, building it from the database once."""
+
+    global _ngram_index
+
+    with _ngram_index_lock:
+        if _ngram_index is None:
+            _ngram_index = NgramIndex.build(
+                db.session.query(User.id, User.username)
+                          .filter(User.deleted_at.is_(None)))
+
+    return _ngram_index
+
+
+def user_saved(user):
+    """Keep the in-process index current after a signup or profile edit."""
+
+    if _ngram_index is not None:
+        _ngram_index.add(user.id, user.username)
+
+
+def user_removed(user_id):
+    """Drop a deleted user from the in-process index."""
+
+    if _ngram_index is not None:
+        _ngram_index.remove(user_id)
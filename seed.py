@@ -1,20 +1,213 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+    python seed.py [CSV_DIR] [--chunk-size ROWS] [--resume]
 
+CSV_DIR defaults to generator/, where create_csvs.py writes its files.
 
-db.drop_all()
-db.create_all()
+The CSVs are streamed in chunks of --chunk-size rows, each loaded and
+committed on its own, so memory use stays flat however big the files
+are. On PostgreSQL (with psycopg2) chunks are loaded with COPY; other
+databases get executemany batches. Secondary indexes are dropped first
+and built once the rows are in, before counters are reconciled and
+timelines rebuilt (both read through those indexes). Progress is
+reported as it goes.
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+Without --resume the database is wiped first. With --resume, rows that
+an interrupted run already committed are skipped, and loading carries
+on from there.
+"""
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+import argparse
+import csv
+import io
+import os
+import time
+from datetime import datetime
+from itertools import islice
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+from sqlalchemy import func, select, text
 
-db.session.commit()
+from app import app, db
+from models import User, Message, Follows, drop_indexes, create_missing_indexes
+from counters import reconcile_counters
+from timelines import rebuild_timelines
+
+# (CSV file, model) in load order
+CSV_FILES = (
+    ('users.csv', User),
+    ('messages.csv', Message),
+    ('follows.csv', Follows),
+)
+
+DEFAULT_CHUNK_SIZE = 50000
+
+
+def uses_copy():
+    """Can we load with PostgreSQL's COPY?"""
+
+    return (db.engine.dialect.name == 'postgresql'
+            and db.engine.dialect.driver == 'psycopg2')
+
+
+def read_chunks(path, table, skip, chunk_size):
+    """Yield lists of up to `chunk_size` rows (dicts) from a CSV file.
+
+    Rows of tables with an `id` column are numbered from 1 in file order
+    (as their foreign keys in the other files assume), so a resumed load
+    gives them the same ids. The first `skip` rows are skipped.
+    """
+
+    with open(path, newline='') as csv_file:
+        reader = csv.DictReader(csv_file)
+        numbered = 'id' in table.c and 'id' not in reader.fieldnames
+        chunk = []
+
+        for row_id, row in enumerate(islice(reader, skip, None), skip + 1):
+            if numbered:
+                row['id'] = row_id
+            chunk.append(row)
+
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+
+def typed(table, rows):
+    """Convert CSV strings to the Python values of `table`'s columns."""
+
+    converters = {}
+    for name in rows[0]:
+        python_type = table.c[name].type.python_type
+        if python_type is datetime:
+            converters[name] = datetime.fromisoformat
+        elif python_type is not str:
+            converters[name] = python_type
+
+    for row in rows:
+        for name, convert in converters.items():
+            value = row[name]
+            row[name] = convert(value) if value != '' else None
+
+    return rows
+
+
+def copy_chunk(table, rows):
+    """Load rows with COPY ... FROM STDIN, in one transaction."""
+
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    csv.DictWriter(buffer, columns).writerows(rows)
+    buffer.seek(0)
+
+    # Unquoted empty fields are NULL to COPY; keep empty text as ''
+    # like the INSERT path does.
+    text_columns = [name for name in columns
+                    if table.c[name].type.python_type is str]
+    options = 'FORMAT csv'
+    if text_columns:
+        options += f", FORCE_NOT_NULL ({', '.join(text_columns)})"
+
+    connection = db.engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {table.name} ({', '.join(columns)}) "
+                f"FROM STDIN WITH ({options})", buffer)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def insert_chunk(table, rows):
+    """Load rows with an executemany INSERT, in one transaction."""
+
+    with db.engine.begin() as connection:
+        connection.execute(table.insert(), typed(table, rows))
+
+
+def load_csv(path, model, chunk_size, resume):
+    """Stream one CSV file into `model`'s table; return the rows loaded."""
+
+    table = model.__table__
+    load_chunk = copy_chunk if uses_copy() else insert_chunk
+
+    # Every chunk commits on its own, so the rows already in the table
+    # are exactly the first rows of the file.
+    skip = 0
+    if resume:
+        skip = db.engine.execute(
+            select([func.count()]).select_from(table)).scalar()
+    if skip:
+        print(f"{table.name}: resuming after {skip:,} rows")
+
+    loaded = 0
+    start = time.perf_counter()
+
+    for chunk in read_chunks(path, table, skip, chunk_size):
+        load_chunk(table, chunk)
+        loaded += len(chunk)
+
+        rate = loaded / (time.perf_counter() - start)
+        print(f"{table.name}: {skip + loaded:,} rows ({rate:,.0f} rows/s)",
+              flush=True)
+
+    return loaded
+
+
+def reset_sequences():
+    """Move id sequences past the explicit ids the load inserted."""
+
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    for _, model in CSV_FILES:
+        table = model.__table__
+        if 'id' in table.c:
+            db.engine.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"COALESCE(MAX(id), 0) + 1, false) FROM {table.name}"
+            ).execution_options(autocommit=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('csv_dir', nargs='?', default='generator')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted load")
+    args = parser.parse_args()
+
+    if not args.resume:
+        db.drop_all()
+        db.create_all()
+
+    for name in drop_indexes():
+        print(f"Dropped index {name} for the load")
+
+    for filename, model in CSV_FILES:
+        load_csv(os.path.join(args.csv_dir, filename), model,
+                 args.chunk_size, args.resume)
+
+    reset_sequences()
+
+    # Counting each user's rows needs the indexes, so build them first
+    start = time.perf_counter()
+    for name in create_missing_indexes():
+        print(f"Created index {name}")
+    print(f"Built indexes in {time.perf_counter() - start:.1f}s")
+
+    with app.app_context():
+        print("Reconciling counters and rebuilding timelines")
+        reconcile_counters()
+        rebuild_timelines()
+        db.session.commit()
+
+    if db.engine.dialect.name == 'postgresql':
+        db.engine.execute(text("ANALYZE").execution_options(autocommit=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,56 +1,200 @@
 $(document).ready(function() {
   let messageList = $("body");
 
-  messageList.on("click", ".msg", async function(event) {
+  // Likes: a click flips the button straight away and queues the new
+  // state; the queue is sent as one batch once clicks pause, so rapid
+  // clicks on a button collapse into a single change (or none, if they
+  // cancel out). The server sets likes rather than toggling them, so a
+  // batch is safe to resend.
+  const LIKE_FLUSH_DELAY = 400;
+  let savedLikes = {}; // message id -> liked, as sent to the server
+  let pendingLikes = {}; // message id -> liked, not sent yet
+  let likeTimer = null;
+  let sendingLikes = false;
+
+  function likeButton(msgId) {
+    return $(`.msg[id="${msgId}"]`);
+  }
+
+  function showLiked(msgId, liked) {
+    likeButton(msgId)
+      .toggleClass("btn-primary", liked)
+      .toggleClass("btn-secondary", !liked);
+  }
+
+  messageList.on("click", ".msg", function(event) {
     event.preventDefault();
 
-    let msgClicked = event.target;
-    let $msgId = $(msgClicked).attr("id");
-    let response = await axios.post(`/messages/${$msgId}/like`);
+    let button = $(event.currentTarget);
+    let msgId = button.attr("id");
+    if (!(msgId in savedLikes)) {
+      savedLikes[msgId] = button.hasClass("btn-primary");
+    }
 
-    $(msgClicked).toggleClass("btn-secondary btn-primary");
+    let liked = !button.hasClass("btn-primary");
+    showLiked(msgId, liked);
 
-    let likeCount = $("#like-count");
-    if (likeCount) {
-      let currentCount = parseInt($(likeCount).text());
-      if ($(msgClicked).hasClass("btn-primary")) {
-        currentCount++; // after the toggle already happened
-      } else {
-        currentCount--;
-      }
-      $(likeCount).text(currentCount);
+    if (liked === savedLikes[msgId]) {
+      delete pendingLikes[msgId];
+    } else {
+      pendingLikes[msgId] = liked;
     }
+
+    clearTimeout(likeTimer);
+    likeTimer = setTimeout(sendLikes, LIKE_FLUSH_DELAY);
   });
 
+  async function sendLikes() {
+    if (sendingLikes) {
+      // one batch at a time, so they're applied in order
+      likeTimer = setTimeout(sendLikes, LIKE_FLUSH_DELAY);
+      return;
+    }
+
+    let batch = pendingLikes;
+    pendingLikes = {};
+    let likes = Object.keys(batch).map(msgId => ({
+      message_id: parseInt(msgId),
+      liked: batch[msgId]
+    }));
+    if (!likes.length) return;
+
+    // clicks from now on are compared with what this batch sets
+    let previous = {};
+    for (let msgId of Object.keys(batch)) {
+      previous[msgId] = savedLikes[msgId];
+      savedLikes[msgId] = batch[msgId];
+    }
+
+    sendingLikes = true;
+    try {
+      let response = await axios.post("/messages/likes", { likes });
+      $("#like-count[data-own-likes]").text(response.data.likes_count);
+    } catch (err) {
+      // put back what the server has, unless clicked again meanwhile
+      for (let msgId of Object.keys(previous)) {
+        savedLikes[msgId] = previous[msgId];
+        if (!(msgId in pendingLikes)) showLiked(msgId, previous[msgId]);
+      }
+    } finally {
+      sendingLikes = false;
+    }
+  }
+
   let newWarbleSubmit = $("#new-warble-submit");
   newWarbleSubmit.on("click", async function(event) {
     // event.preventDefault();
     let warble = $("#new-warble-text").val();
     console.log(warble);
     let msg = await axios.post("/messages/new", (data = { text: warble }));
-    let newMsg = generateMsgHTML(msg);
+    let newMsg = generateMsgHTML(msg.data);
     console.log(newMsg);
     $("#messages").prepend(newMsg);
     $("#new-warble-text").val("");
     $(".modal").modal("toggle");
   });
 
-  function generateMsgHTML(msg) {
-    let newMsg = `
-    <li class="list-group-item">
-    <!-- <a href="/messages/${msg.data.id}" class="message-link" /> -->
-    <a href="/users/${msg.data.user_id}">
-      <img src="${msg.data.user_image_url}" alt="" class="timeline-image" />
-    </a>
-    <div class="message-area">
-      <a href="/users/${msg.data.user_id}">@${msg.data.user_username}</a>
-      <span class="text-muted"
-        >${msg.data.timestamp}</span
-      >
-      <p>${msg.data.text}</p>
-    </div>
-  </li>
-  `;
-    return newMsg;
+  // Infinite scroll: fetch the page older than the list's cursor when
+  // the user nears the bottom. The "Older warbles" link is the no-JS
+  // fallback, so drop it once we're handling paging here.
+  let feed = $("#messages[data-feed-url]");
+  let loadingOlder = false;
+  $("#older-messages").remove();
+
+  async function loadOlderMessages() {
+    let cursor = feed.attr("data-next-cursor");
+    if (loadingOlder || !cursor) return;
+
+    loadingOlder = true;
+    try {
+      let response = await axios.get(feed.attr("data-feed-url"), {
+        params: { before: cursor }
+      });
+      let liked = new Set(response.data.liked || []);
+      for (let msg of response.data.messages) {
+        feed.append(generateMsgHTML(msg, liked.has(msg.id)));
+      }
+      feed.attr("data-next-cursor", response.data.next || "");
+    } finally {
+      loadingOlder = false;
+    }
+  }
+
+  $(window).on("scroll", function() {
+    let distanceToBottom =
+      $(document).height() - ($(window).scrollTop() + $(window).height());
+    if (feed.length && distanceToBottom < 400) {
+      loadOlderMessages();
+    }
+  });
+
+  // Live updates: new warbles from followed users arrive as server-sent
+  // events and go on top of the feed, instead of waiting for a reload.
+  // EventSource reconnects by itself, sending the id of the last warble
+  // it got, and the server replays any it missed meanwhile.
+  let liveFeed = $("#messages[data-live-url]");
+  if (liveFeed.length && window.EventSource) {
+    let updates = new EventSource(liveFeed.attr("data-live-url"));
+    updates.onmessage = function(event) {
+      liveFeed.prepend(generateMsgHTML(JSON.parse(event.data)));
+    };
+  }
+
+  // Username suggestions for the search box
+  let searchBox = $("#search");
+  let suggestions = $("#search-suggestions");
+
+  searchBox.on("input", async function() {
+    let q = searchBox.val().trim();
+    if (!q) return;
+
+    let response = await axios.get("/users/typeahead", { params: { q } });
+    if (searchBox.val().trim() !== q) return; // a newer keystroke won
+
+    suggestions.empty();
+    for (let user of response.data) {
+      suggestions.append($("<option>").attr("value", user.username));
+    }
+  });
+
+  // A message list item like messages/_item.html renders, with a like
+  // button unless the viewer wrote it. Fields go in with .text() and
+  // .attr(), never as markup, so a message can't inject HTML.
+  const viewerId = parseInt($("body").attr("data-user-id"));
+
+  function generateMsgHTML(msg, liked = false) {
+    let userUrl = `/users/${parseInt(msg.user_id)}`;
+
+    let item = $('<li class="list-group-item">').append(
+      $("<a>")
+        .attr("href", userUrl)
+        .append(
+          $('<img alt="user image" class="timeline-image">').attr(
+            "src",
+            msg.user_image_url
+          )
+        ),
+      $('<div class="message-area">').append(
+        $("<a>")
+          .attr("href", userUrl)
+          .text(`@${msg.user_username}`),
+        " ",
+        $('<span class="text-muted">').text(msg.timestamp),
+        $("<p>").text(msg.text)
+      )
+    );
+
+    if (viewerId && viewerId !== parseInt(msg.user_id)) {
+      item.append(
+        $('<form method="" action="" class="messages-like">').append(
+          $('<button class="btn btn-sm msg">')
+            .attr("id", parseInt(msg.id))
+            .addClass(liked ? "btn-primary" : "btn-secondary")
+            .append('<i class="fa fa-thumbs-up"></i>')
+        )
+      );
+    }
+
+    return item;
   }
 });
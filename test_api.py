@@ -0,0 +1,163 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from api import Serializer, ApiError
+from pagination import PAGE_SIZE
+
+db.create_all()
+
+
+class SerializerTestCase(TestCase):
+    """Test compiled serializers."""
+
+    def setUp(self):
+        self.serializer = Serializer({'a': "obj['a']", 'b': "obj['b'] * 2"})
+
+    def test_fields(self):
+        self.assertEqual(self.serializer.many([{'a': 1, 'b': 2}], ('b',)),
+                         [{'b': 4}])
+        self.assertEqual(self.serializer.names_from(None), ('a', 'b'))
+        self.assertEqual(self.serializer.names_from('b, a'), ('a', 'b'))
+
+    def test_compiled_once(self):
+        self.assertIs(self.serializer.compile(('a',)),
+                      self.serializer.compile(('a',)))
+
+    def test_same_set_same_names(self):
+        """do reorderings and repeats of a set of fields share a function?"""
+
+        for param in ['a,b', 'b,a', 'a,b,a', 'b,b,a,a']:
+            self.assertEqual(self.serializer.names_from(param), ('a', 'b'))
+
+        for param in ['a,b', 'b,a', 'b,a,b']:
+            self.serializer.compile(self.serializer.names_from(param))
+        self.assertEqual(len(self.serializer._compiled), 1)
+
+    def test_unknown_field(self):
+        with self.assertRaises(ApiError):
+            self.serializer.names_from('a,password')
+
+
+class ApiTestCase(TestCase):
+    """Test API endpoints."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.users = [User(email=f"user{i}@test.com", username=f"user{i}",
+                           password="HASHED_PASSWORD")
+                      for i in range(PAGE_SIZE + 5)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+        self.user = self.users[0]
+        start = datetime(2020, 1, 1)
+        for i, follower in enumerate(self.users[1:]):
+            db.session.add(Follows(user_being_followed_id=self.user.id,
+                                   user_following_id=follower.id))
+            message = Message(text=f"message {i}", user_id=self.user.id,
+                              timestamp=start + timedelta(minutes=i))
+            db.session.add(message)
+            db.session.flush()
+            db.session.add(Likes(user_id=follower.id, message_id=message.id))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, user):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+    def test_profile(self):
+        resp = self.client.get(f'/api/v1/users/{self.user.id}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['user']['username'], 'user0')
+        self.assertNotIn('email', resp.get_json()['user'])
+        self.assertNotIn('password', resp.get_json()['user'])
+
+        resp = self.client.get('/api/v1/users/9999')
+        self.assertEqual(resp.status_code, 404)
+        self.assertIn('error', resp.get_json())
+
+    def test_field_selection(self):
+        resp = self.client.get(f'/api/v1/users/{self.user.id}/messages'
+                               '?fields=id,text')
+        self.assertEqual(set(resp.get_json()['messages'][0]), {'id', 'text'})
+
+        resp = self.client.get(f'/api/v1/users/{self.user.id}/messages'
+                               '?fields=password')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_message_pages(self):
+        url = f'/api/v1/users/{self.user.id}/messages'
+        page = self.client.get(url).get_json()
+        self.assertEqual(len(page['messages']), PAGE_SIZE)
+        self.assertEqual(page['messages'][0]['text'],
+                         f"message {PAGE_SIZE + 3}")
+
+        page = self.client.get(url, query_string={
+            'cursor': page['next']}).get_json()
+        self.assertEqual([m['text'] for m in page['messages']],
+                         [f"message {i}" for i in range(3, -1, -1)])
+        self.assertIsNone(page['next'])
+
+    def test_followers_pages(self):
+        url = f'/api/v1/users/{self.user.id}/followers'
+        follower_ids = [user.id for user in self.users[1:]]
+        self.assertEqual(self.client.get(url).status_code, 401)
+
+        self.login(self.user)
+        ids = []
+        cursor = None
+        while True:
+            page = self.client.get(url, query_string={
+                'cursor': cursor or ''}).get_json()
+            ids += [user['id'] for user in page['users']]
+            cursor = page['next']
+            if cursor is None:
+                break
+
+        self.assertEqual(ids, follower_ids)
+
+    def test_follow_pages_skip_deleted(self):
+        user_id = self.user.id
+        deleted_id = self.users[1].id
+        next_id = self.users[2].id
+        self.users[1].deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        self.login(self.user)
+        followers = self.client.get(
+            f'/api/v1/users/{user_id}/followers').get_json()
+        self.assertNotIn(deleted_id,
+                         [user['id'] for user in followers['users']])
+        self.assertEqual(followers['users'][0]['id'], next_id)
+
+        following = self.client.get(
+            f'/api/v1/users/{deleted_id}/following')
+        self.assertEqual(following.status_code, 404)
+
+    def test_likes(self):
+        follower_id = self.users[1].id
+        self.login(self.users[1])
+
+        resp = self.client.get(f'/api/v1/users/{follower_id}/likes')
+        self.assertEqual([m['text'] for m in resp.get_json()['messages']],
+                         ["message 0"])
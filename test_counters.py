@@ -0,0 +1,140 @@
+"""Denormalized counter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_counters.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import counters
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['JOB_WORKERS'] = 0
+
+
+class CounterViewTestCase(TestCase):
+    """Test that views keep the counters on users current."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        users = [User(email=f"test{i}@test.com", username=f"testuser{i}",
+                      password="HASHED_PASSWORD") for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.ids = [user.id for user in users]
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def counts(self, user_id):
+        db.session.expire_all()
+        user = User.query.get(user_id)
+        return {name: getattr(user, name) for name in counters.COUNTERS}
+
+    def assertCounts(self, user_id, **expected):
+        counts = self.counts(user_id)
+        self.assertEqual({name: counts[name] for name in expected}, expected)
+
+    def test_follow_unfollow(self):
+        u, u2, _ = self.ids
+        self.login(u)
+
+        self.client.post(f'/users/follow/{u2}')
+        self.assertCounts(u, following_count=1, followers_count=0)
+        self.assertCounts(u2, following_count=0, followers_count=1)
+
+        self.client.post(f'/users/stop-following/{u2}')
+        self.assertCounts(u, following_count=0)
+        self.assertCounts(u2, followers_count=0)
+
+    def test_post_and_delete(self):
+        u, u2, _ = self.ids
+        self.login(u)
+
+        resp = self.client.post('/messages/new', json={'text': "hello"})
+        msg_id = resp.get_json()['id']
+        self.assertCounts(u, messages_count=1)
+
+        # a like of the message is uncounted when the message goes
+        self.login(u2)
+        self.client.post(f'/messages/{msg_id}/like', json={'liked': True})
+        self.assertCounts(u2, likes_count=1)
+
+        self.login(u)
+        self.client.post(f'/messages/{msg_id}/delete')
+        self.assertCounts(u, messages_count=0)
+        self.assertCounts(u2, likes_count=0)
+
+    def test_like_unlike(self):
+        u, u2, u3 = self.ids
+        msg = Message(text="likeable", user_id=u)
+        db.session.add(msg)
+        db.session.flush()
+        counters.message_added(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        self.login(u3)
+        self.client.post(f'/messages/{msg_id}/like', json={'liked': True})
+
+        self.login(u2)
+        for _ in range(2):
+            self.client.post(f'/messages/{msg_id}/like', json={'liked': True})
+        self.assertCounts(u2, likes_count=1)
+
+        # unliking changes only the unliker's count, once
+        for _ in range(2):
+            self.client.post(f'/messages/{msg_id}/like', json={'liked': False})
+        self.assertCounts(u2, likes_count=0)
+        self.assertCounts(u3, likes_count=1)
+        self.assertCounts(u, likes_count=0)
+
+        self.assertEqual(counters.reconcile_counters(), 0)
+
+    def test_reconcile(self):
+        """does reconciling repair drifted counters, and only those?"""
+
+        u, u2, _ = self.ids
+        msg = Message(text="counted", user_id=u)
+        db.session.add(msg)
+        db.session.flush()
+        db.session.add(Likes(user_id=u2, message_id=msg.id))
+        db.session.commit()
+
+        User.query.filter_by(id=u).update({'messages_count': 41,
+                                           'followers_count': -3})
+        db.session.commit()
+
+        self.assertEqual(counters.reconcile_counters(), 2)
+        db.session.commit()
+
+        self.assertCounts(u, messages_count=1, followers_count=0,
+                          likes_count=0)
+        self.assertCounts(u2, messages_count=0, likes_count=1)
+        self.assertEqual(counters.reconcile_counters(), 0)
@@ -0,0 +1,209 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_deletion.py
+
+
+import os
+from unittest import TestCase
+
+from werkzeug.exceptions import NotFound
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import counters
+import deletion
+import message_search
+import queries
+import search
+import timelines
+
+db.drop_all()
+db.create_all()
+
+
+class DeletionTestCase(TestCase):
+    """Test soft deletes and batched purges."""
+
+    def setUp(self):
+        """u (to be deleted) follows u2 and is followed by u3.
+
+        u has three messages, two of them liked by u2; u likes one of u2's.
+        """
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+
+        users = [User(email=f"test{i}@test.com", username=f"testuser{i}",
+                      password="HASHED_PASSWORD") for i in range(1, 4)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.u, self.u2, self.u3 = users
+
+        db.session.add_all([
+            Follows(user_following_id=self.u.id,
+                    user_being_followed_id=self.u2.id),
+            Follows(user_following_id=self.u3.id,
+                    user_being_followed_id=self.u.id),
+        ])
+
+        messages = [Message(text=f"message {i}", user_id=self.u.id)
+                    for i in range(3)]
+        other = Message(text="other", user_id=self.u2.id)
+        db.session.add_all(messages + [other])
+        db.session.flush()
+        for msg in messages + [other]:
+            timelines.push_message(msg)
+
+        db.session.add_all([
+            Likes(user_id=self.u2.id, message_id=messages[0].id),
+            Likes(user_id=self.u2.id, message_id=messages[1].id),
+            Likes(user_id=self.u.id, message_id=other.id),
+        ])
+        counters.reconcile_counters()
+        db.session.commit()
+
+        self.ids = self.u.id, self.u2.id, self.u3.id
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def test_soft_delete(self):
+        """is a deleted user gone from logins, profiles and searches?"""
+
+        user_id = self.u.id
+        deletion.soft_delete(user_id)
+        db.session.commit()
+
+        with self.assertRaises(NotFound):
+            User.get_active_or_404(user_id)
+        self.assertFalse(User.authenticate("testuser1", "HASHED_PASSWORD"))
+        self.assertNotIn(user_id,
+                         [user.id for user in search.search_users("")])
+        self.assertEqual(deletion.deleted_user_ids(), [user_id])
+
+        # nothing is purged yet
+        self.assertEqual(Message.query.filter_by(user_id=user_id).count(), 3)
+
+    def test_soft_delete_hides_messages(self):
+        """are a deleted user's messages gone from every list at once?"""
+
+        user_id, u2_id, u3_id = self.ids
+        message_ids = [msg_id for (msg_id,) in
+                       db.session.query(Message.id).filter_by(user_id=user_id)]
+
+        def listed(messages):
+            return [msg.id for msg in messages if msg.id in message_ids]
+
+        self.assertEqual(len(listed(timelines.read_timeline(u3_id))), 3)
+        self.assertEqual(
+            len(listed(message_search.search_messages("message")[0])), 3)
+
+        # only the flag: no hooks, no purge
+        deletion.soft_delete(user_id)
+        db.session.commit()
+        db.session.expunge_all()
+
+        self.assertEqual(listed(timelines.read_timeline(u3_id)), [])
+        self.assertEqual(listed(message_search.search_messages("message")[0]),
+                         [])
+        self.assertEqual(listed(queries.liked_messages(u2_id)), [])
+
+        resp = app.test_client().get(f'/messages/{message_ids[0]}')
+        self.assertEqual(resp.status_code, 302)
+
+    def test_purge(self):
+        """are a user's rows purged in batches, with counters kept right?"""
+
+        user_id, u2_id, u3_id = self.ids
+        deletion.soft_delete(user_id)
+        db.session.commit()
+
+        progress = list(deletion.purge(user_id, batch_size=2,
+                                       rows_per_second=0))
+
+        self.assertEqual(progress, [
+            ('following', 1, 1),
+            ('followers', 1, 1),
+            ('messages', 2, 3),
+            ('messages', 3, 3),
+            ('likes', 1, 1),
+            # u's own messages left u's timeline along with them
+            ('timeline', 1, 1),
+            ('user', 1, 1),
+        ])
+
+        self.assertIsNone(User.query.get(user_id))
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Likes.query.filter_by(user_id=user_id).count(), 0)
+
+        u2, u3 = User.query.get(u2_id), User.query.get(u3_id)
+        self.assertEqual(u2.followers_count, 0)
+        self.assertEqual(u2.likes_count, 0)
+        self.assertEqual(u3.following_count, 0)
+        self.assertEqual(counters.reconcile_counters(), 0)
+
+    def test_batch_counted_once(self):
+        """does deleting a batch again (as a concurrent purge would) leave
+        the counters alone?"""
+
+        user_id, u2_id, u3_id = self.ids
+        deletion.soft_delete(user_id)
+        db.session.commit()
+
+        for stage, keys, delete in deletion.STAGES:
+            batch = [key for (key,) in keys(user_id)]
+            self.assertEqual(delete(user_id, batch), len(batch))
+            self.assertEqual(delete(user_id, batch), 0)
+            db.session.commit()
+
+        User.query.filter_by(id=user_id).delete()
+        db.session.commit()
+
+        u2, u3 = User.query.get(u2_id), User.query.get(u3_id)
+        self.assertEqual(u2.followers_count, 0)
+        self.assertEqual(u2.likes_count, 0)
+        self.assertEqual(u3.following_count, 0)
+        self.assertEqual(counters.reconcile_counters(), 0)
+
+    def test_purge_resumes(self):
+        """does a stopped purge carry on where it left off?"""
+
+        user_id = self.u.id
+        deletion.soft_delete(user_id)
+        db.session.commit()
+
+        purge = deletion.purge(user_id, batch_size=1, rows_per_second=0)
+        for _ in range(3):
+            next(purge)
+        purge.close()
+
+        stages = [progress.stage for progress in deletion.purge(user_id)]
+        self.assertEqual(stages, ['messages', 'likes', 'timeline', 'user'])
+        self.assertIsNone(User.query.get(user_id))
+        self.assertEqual(list(deletion.purge(user_id)), [])
+
+    def test_purge_active_user(self):
+        """is an account that wasn't deleted left alone?"""
+
+        with self.assertRaises(ValueError):
+            list(deletion.purge(self.u.id))
+
+        self.assertEqual(Message.query.count(), 4)
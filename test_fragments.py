@@ -0,0 +1,72 @@
+"""Message fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+
+import os
+import tempfile
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from fragments import FragmentCache, SqliteFragmentStore
+
+
+def make_message(message_id, text, username='testuser'):
+    user = SimpleNamespace(id=1, username=username, image_url='/pic.png')
+    return SimpleNamespace(id=message_id, text=text, user=user,
+                           timestamp=datetime(2020, 1, 1))
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test rendering, reuse and invalidation of fragments."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = SqliteFragmentStore(
+            os.path.join(self.tmp.name, 'fragments.db'))
+        self.cache = FragmentCache('messages/_item.html', store=self.store)
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        self.tmp.cleanup()
+
+    def test_render(self):
+        html = self.cache.render([make_message(1, 'hello'),
+                                  make_message(2, 'world')])
+
+        self.assertIn('<p>hello</p>', html[1])
+        self.assertIn('<p>world</p>', html[2])
+        self.assertIn('@testuser', html[1])
+
+    def test_changes_rerender(self):
+        self.cache.render([make_message(1, 'hello')])
+
+        html = self.cache.render([make_message(1, 'hello', 'renamed')])
+        self.assertIn('@renamed', html[1])
+
+        # a reused id with new text isn't served the old fragment
+        html = self.cache.render([make_message(1, 'other', 'renamed')])
+        self.assertIn('<p>other</p>', html[1])
+
+    def test_shared_store(self):
+        self.cache.render([make_message(1, 'hello')])
+
+        other = FragmentCache('messages/_item.html', store=self.store)
+        self.assertEqual(
+            self.store.get_many([1])[1][1],
+            str(other.render([make_message(1, 'hello')])[1]))
+
+    def test_invalidate(self):
+        self.cache.render([make_message(1, 'hello')])
+        self.cache.invalidate(1)
+
+        self.assertEqual(self.store.get_many([1]), {})
+        self.assertEqual(self.cache._fragments, {})
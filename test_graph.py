@@ -0,0 +1,166 @@
+"""Follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_graph.py
+
+
+import threading
+from random import Random
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask
+
+import graph
+from graph import FollowGraph
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the CSR follow graph and its overlay of changes."""
+
+    def setUp(self):
+        # 1 follows 2 and 3; 2 and 3 follow 4; 3 follows 5; 4 follows 1
+        self.graph = FollowGraph.from_edges([
+            (1, 2), (1, 3), (2, 4), (3, 4), (3, 5), (4, 1), (2, 1)])
+
+    def test_reads(self):
+        self.assertTrue(self.graph.follows(1, 2))
+        self.assertFalse(self.graph.follows(2, 3))
+        self.assertFalse(self.graph.follows(99, 1))
+        self.assertEqual(self.graph.following_ids(1), {2, 3})
+        self.assertEqual(self.graph.follower_ids(1), {2, 4})
+        self.assertEqual(self.graph.mutuals(1), {2})
+
+    def test_recommend(self):
+        # 4 is followed by both of 1's followees, 5 by one of them
+        self.assertEqual(self.graph.recommend(1), [4, 5])
+        self.assertEqual(self.graph.recommend(1, limit=1), [4])
+        self.assertEqual(self.graph.recommend(5), [])
+
+    def test_changes(self):
+        self.graph.add(1, 4)
+        self.graph.remove(1, 2)
+        self.graph.add(6, 1)
+
+        self.assertTrue(self.graph.follows(1, 4))
+        self.assertFalse(self.graph.follows(1, 2))
+        self.assertEqual(self.graph.follower_ids(1), {2, 4, 6})
+        self.assertEqual(self.graph.mutuals(1), {4})
+        self.assertEqual(self.graph.recommend(1), [5])
+
+    def test_remove_user(self):
+        self.graph.remove_user(1)
+
+        self.assertEqual(self.graph.following_ids(1), set())
+        self.assertEqual(self.graph.follower_ids(1), set())
+        self.assertFalse(self.graph.follows(4, 1))
+
+    def test_compact(self):
+        rng = Random(1)
+        edges = {(rng.randint(1, 50), rng.randint(1, 50)) for _ in range(300)}
+        graph = FollowGraph.from_edges(edges)
+
+        for _ in range(200):
+            edge = (rng.randint(1, 60), rng.randint(1, 60))
+            if rng.random() < 0.5:
+                graph.add(*edge)
+                edges.add(edge)
+            else:
+                graph.remove(*edge)
+                edges.discard(edge)
+        graph.compact()
+
+        expected = FollowGraph.from_edges(edges)
+        for user_id in range(61):
+            self.assertEqual(graph.following_ids(user_id),
+                             expected.following_ids(user_id))
+            self.assertEqual(graph.follower_ids(user_id),
+                             expected.follower_ids(user_id))
+        self.assertEqual(graph._following_changes, {})
+        self.assertEqual(graph._follower_changes, {})
+
+    def test_failed_compact(self):
+        """does a failed compaction log, keep the overlay, and allow another?"""
+
+        class InlineThread:
+            def __init__(self, target, daemon):
+                self.target = target
+
+            def start(self):
+                self.target()
+
+        with patch.object(graph, 'COMPACT_THRESHOLD', 1), \
+                patch.object(graph.threading, 'Thread', InlineThread):
+            with patch.object(graph.CSR, 'from_sorted',
+                              side_effect=RuntimeError("out of memory")), \
+                    self.assertLogs('graph', 'ERROR'):
+                self.graph.add(5, 1)
+
+            self.assertFalse(self.graph._compacting)
+            self.assertTrue(self.graph.follows(5, 1))
+
+            self.graph.add(5, 2)
+
+        self.assertEqual(self.graph._following_changes, {})
+        self.assertEqual(self.graph.following_ids(5), {1, 2})
+
+
+class GraphBuildTestCase(TestCase):
+    """Test the process's graph is built once, off the hooks' lock."""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        graph._graph = None
+
+    def tearDown(self):
+        graph._graph = None
+
+    def test_single_build(self):
+        started = threading.Event()
+        release = threading.Event()
+        loads = []
+
+        def slow_load():
+            loads.append(1)
+            started.set()
+            release.wait(5)
+            return FollowGraph.from_edges([(1, 2)])
+
+        results = []
+
+        def get():
+            with self.app.app_context():
+                results.append(graph.get_follow_graph(wait=True))
+
+        with patch.object(graph, 'load_graph', slow_load):
+            waiters = [threading.Thread(target=get) for _ in range(2)]
+            for waiter in waiters:
+                waiter.start()
+            self.assertTrue(started.wait(5))
+
+            with self.app.app_context():
+                self.assertIsNone(graph.get_follow_graph(wait=False))
+
+            # follows go on meanwhile, and aren't lost
+            hook = threading.Thread(target=graph.followed, args=(3, 1))
+            hook.start()
+            hook.join(1)
+            self.assertFalse(hook.is_alive())
+
+            release.set()
+            for waiter in waiters:
+                waiter.join(5)
+
+        self.assertEqual(len(loads), 1)
+        self.assertIs(results[0], results[1])
+        self.assertTrue(results[0].follows(1, 2))
+        self.assertTrue(results[0].follows(3, 1))
+
+    def test_failed_build(self):
+        def broken_load():
+            raise RuntimeError("no database")
+
+        with patch.object(graph, 'load_graph', broken_load), \
+                self.app.app_context():
+            self.assertIsNone(graph.get_follow_graph(wait=True))
@@ -0,0 +1,136 @@
+"""HTTP caching policy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_http_cache.py
+
+
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message
+import http_cache
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['JOB_WORKERS'] = 0
+
+
+class StaticCachingTestCase(TestCase):
+    """Test caching of static files."""
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_fingerprinted_url_is_immutable(self):
+        with app.test_request_context():
+            url = http_cache.static_url('script.js')
+
+        self.assertRegex(url, r'^/static/script\.js\?v=[0-9a-f]{16}$')
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        resp.close()
+
+    def test_other_urls_revalidate(self):
+        for url in ['/static/script.js', '/static/script.js?v=stale']:
+            resp = self.client.get(url)
+            self.assertEqual(resp.headers['Cache-Control'], 'public, no-cache')
+            resp.close()
+
+    def test_pages_not_cached(self):
+        resp = self.client.get('/login')
+        self.assertIn('no-store', resp.headers['Cache-Control'])
+
+
+class EtagTestCase(TestCase):
+    """Test profile and message pages revalidate by ETag, per viewer."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        u2 = User(email="test2@test2.com", username="testuser2",
+                  password="HASHED_PASSWORD2")
+        db.session.add_all([u, u2])
+        db.session.commit()
+
+        msg = Message(text="cache me", user_id=u2.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.u_id, self.u2_id, self.msg_id = u.id, u2.id, msg.id
+        self.client = self.client_for(self.u_id)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def client_for(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def etag(self, url):
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('no-cache', resp.headers['Cache-Control'])
+        return resp.headers['ETag']
+
+    def revalidate(self, url, etag):
+        return self.client.get(url, headers={'If-None-Match': etag})
+
+    def test_repeat_request_not_modified(self):
+        for url in [f'/users/{self.u2_id}', f'/messages/{self.msg_id}']:
+            with self.subTest(url=url):
+                etag = self.etag(url)
+
+                resp = self.revalidate(url, etag)
+                self.assertEqual(resp.status_code, 304)
+                self.assertEqual(resp.get_data(), b'')
+                self.assertEqual(resp.headers['ETag'], etag)
+
+    def test_other_viewer_not_matched(self):
+        url = f'/users/{self.u2_id}'
+        etag = self.etag(url)
+
+        resp = app.test_client().get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_follow_changes_etags(self):
+        urls = [f'/users/{self.u2_id}', f'/messages/{self.msg_id}']
+        before = [self.etag(url) for url in urls]
+
+        self.client.post(f'/users/follow/{self.u2_id}')
+
+        for url, etag in zip(urls, before):
+            with self.subTest(url=url):
+                self.assertEqual(self.revalidate(url, etag).status_code, 200)
+                self.assertNotEqual(self.etag(url), etag)
+
+    def test_like_changes_etag(self):
+        url = f'/users/{self.u2_id}'
+        etag = self.etag(url)
+
+        self.client.post(f'/messages/{self.msg_id}/like', json={'liked': True})
+
+        self.assertEqual(self.revalidate(url, etag).status_code, 200)
+        self.assertNotEqual(self.etag(url), etag)
+
+    def test_new_message_changes_etag(self):
+        url = f'/users/{self.u2_id}'
+        etag = self.etag(url)
+
+        self.client_for(self.u2_id).post('/messages/new',
+                                          json={'text': "something new"})
+
+        self.assertEqual(self.revalidate(url, etag).status_code, 200)
+        self.assertNotEqual(self.etag(url), etag)
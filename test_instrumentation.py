@@ -0,0 +1,115 @@
+"""Request metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, instrumentation
+
+db.drop_all()
+db.create_all()
+
+
+class MetricsTestCase(TestCase):
+    """Test /internal/metrics and what it reports."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        db.session.add(u)
+        db.session.commit()
+        self.user_id = u.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['METRICS_TOKEN'] = None
+
+    def metrics(self, **kwargs):
+        resp = self.client.get('/internal/metrics', **kwargs)
+        return resp.status_code, resp.get_data(as_text=True)
+
+    def test_route_totals(self):
+        """are per-route query counts reported to Server-Timing and /internal/metrics?"""
+
+        app.config['SERVER_TIMING'] = True
+        try:
+            resp = self.client.get(f'/users/{self.user_id}')
+        finally:
+            app.config['SERVER_TIMING'] = False
+
+        self.assertIn('queries", tpl;dur=', resp.headers['Server-Timing'])
+
+        status, text = self.metrics()
+        self.assertEqual(status, 200)
+        self.assertIn('warbler_db_queries_total{route="/users/<int:user_id>"}',
+                      text)
+        self.assertIn('warbler_request_seconds_bucket'
+                      '{route="/users/<int:user_id>",le="+Inf"}', text)
+
+    def test_errors_counted(self):
+        """are requests that raise counted, as errors?"""
+
+        def broken():
+            raise RuntimeError("broken")
+
+        homepage = app.view_functions['homepage']
+        app.view_functions['homepage'] = broken
+        try:
+            resp = self.client.get('/')
+        finally:
+            app.view_functions['homepage'] = homepage
+
+        self.assertEqual(resp.status_code, 500)
+
+        stats = instrumentation.routes['/']
+        self.assertGreaterEqual(stats.errors, 1)
+        _, text = self.metrics()
+        self.assertIn(f'warbler_request_errors_total{{route="/"}} '
+                      f'{stats.errors}', text)
+
+    def test_loopback_only_without_token(self):
+        """without a token, are the metrics only served to this host?"""
+
+        status, _ = self.metrics(environ_base={'REMOTE_ADDR': '127.0.0.1'})
+        self.assertEqual(status, 200)
+
+        status, _ = self.metrics(environ_base={'REMOTE_ADDR': '203.0.113.9'})
+        self.assertEqual(status, 403)
+
+    def test_token(self):
+        """with a token, is it required (from anywhere)?"""
+
+        app.config['METRICS_TOKEN'] = "s3cret"
+        remote = {'REMOTE_ADDR': '203.0.113.9'}
+
+        status, _ = self.metrics(environ_base=remote)
+        self.assertEqual(status, 403)
+
+        status, _ = self.metrics(environ_base=remote,
+                                 headers={'Authorization': "Bearer wrong"})
+        self.assertEqual(status, 403)
+
+        status, _ = self.metrics(environ_base=remote,
+                                 headers={'Authorization': "Bearer s3cret"})
+        self.assertEqual(status, 200)
@@ -0,0 +1,230 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+import sqlite3
+import tempfile
+import threading
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import jobs
+from jobs import JobRunner, MemoryQueue, SqliteQueue
+
+
+class MemoryQueueTestCase(TestCase):
+    """Test the queue operations (SqliteQueue reruns these)."""
+
+    def make_queue(self):
+        return MemoryQueue()
+
+    def setUp(self):
+        self.queue = self.make_queue()
+
+    def test_claim_in_order(self):
+        first = self.queue.put('a', [1])
+        second = self.queue.put('b', [2])
+        self.queue.put('c', [3], delay=60)
+
+        self.assertEqual(self.queue.claim(), (first, 'a', [1], 0))
+        self.assertEqual(self.queue.claim(), (second, 'b', [2], 0))
+        self.assertIsNone(self.queue.claim())
+        self.assertEqual(self.queue.size(), 3)
+
+        self.queue.done(first)
+        self.assertEqual(self.queue.size(), 2)
+
+    def test_maxsize(self):
+        self.assertIsNotNone(self.queue.put('a', [], maxsize=1))
+        self.assertIsNone(self.queue.put('a', [], maxsize=1))
+        self.assertEqual(self.queue.size(), 1)
+
+    def test_retry_and_fail(self):
+        job_id = self.queue.put('a', [1])
+        self.queue.claim()
+
+        self.queue.retry(job_id, 0, "oops")
+        self.assertEqual(self.queue.claim(), (job_id, 'a', [1], 1))
+
+        self.queue.fail(job_id, "oops again")
+        self.assertIsNone(self.queue.claim())
+        self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(self.queue.failed(), [(job_id, 'a', [1], "oops again")])
+
+        self.assertEqual(self.queue.retry_failed(), 1)
+        self.assertEqual(self.queue.failed(), [])
+        self.assertEqual(self.queue.claim()[1:], ('a', [1], 0))
+
+
+class SqliteQueueTestCase(MemoryQueueTestCase):
+    def make_queue(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return SqliteQueue(os.path.join(directory.name, 'jobs.db'))
+
+    def test_lease(self):
+        job_id = self.queue.put('a', [1])
+        self.assertEqual(self.queue.claim(lease=-1)[0], job_id)
+
+        # the lease ran out: another worker takes it over
+        self.assertEqual(self.queue.claim()[0], job_id)
+        self.assertIsNone(self.queue.claim())
+
+    def test_renew(self):
+        job_id = self.queue.put('a', [1])
+        self.queue.claim(lease=-1)
+
+        # renewed before it ran out: nobody else takes it
+        self.queue.renew(job_id)
+        self.assertIsNone(self.queue.claim())
+
+
+class JobRunnerTestCase(TestCase):
+    """Test running jobs on worker threads."""
+
+    def setUp(self):
+        self.runner = JobRunner(app)
+        self.calls = []
+        self.lock = threading.Lock()
+
+        self.old_config = app.config['JOB_WORKERS'], app.config['JOB_QUEUE_SIZE']
+        app.config['JOB_WORKERS'] = 2
+        self.old_delay, jobs.RETRY_DELAY = jobs.RETRY_DELAY, 0
+        self.old_poll, jobs.POLL_INTERVAL = jobs.POLL_INTERVAL, 0.01
+
+    def tearDown(self):
+        app.config['JOB_WORKERS'], app.config['JOB_QUEUE_SIZE'] = self.old_config
+        jobs.RETRY_DELAY = self.old_delay
+        jobs.POLL_INTERVAL = self.old_poll
+
+    def test_runs_jobs(self):
+        @self.runner.job
+        def record(number):
+            with self.lock:
+                self.calls.append(number)
+
+        for number in range(20):
+            self.runner.enqueue(record, number)
+
+        self.assertTrue(self.runner.join())
+        self.assertEqual(sorted(self.calls), list(range(20)))
+
+    def test_retries(self):
+        @self.runner.job
+        def flaky():
+            self.calls.append(None)
+            if len(self.calls) < 3:
+                raise ValueError("not yet")
+
+        @self.runner.job
+        def broken():
+            raise ValueError("never")
+
+        with self.assertLogs(app.logger.name, 'ERROR'):
+            self.runner.enqueue(flaky)
+            self.runner.enqueue(broken)
+            self.assertTrue(self.runner.join())
+
+        self.assertEqual(len(self.calls), 3)
+        [(_, name, args, error)] = self.runner.queue.failed()
+        self.assertEqual(name, 'broken')
+        self.assertIn("never", error)
+
+    def test_backpressure(self):
+        """With the queue full, jobs run on the caller's thread."""
+
+        app.config['JOB_QUEUE_SIZE'] = 0
+
+        @self.runner.job
+        def record():
+            self.calls.append(threading.current_thread())
+
+        with app.app_context():
+            self.runner.enqueue(record)
+
+        self.assertEqual(self.calls, [threading.current_thread()])
+
+    def test_unregistered(self):
+        def stray():
+            pass
+
+        with self.assertRaises(ValueError):
+            self.runner.enqueue(stray)
+
+    def test_start_runs_queued_jobs(self):
+        """are jobs queued before a restart run once workers start?"""
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'jobs.db')
+        SqliteQueue(path).put('record', [1])
+
+        runner = JobRunner(app, SqliteQueue(path))
+
+        @runner.job
+        def record(number):
+            self.calls.append(number)
+
+        runner.start()
+        self.assertTrue(runner.join())
+        self.assertEqual(self.calls, [1])
+
+    def test_renew_lease(self):
+        """can a long job keep its lease, on a worker thread only?"""
+
+        renewed = []
+
+        class Recording(MemoryQueue):
+            def renew(queue, job_id, lease=jobs.LEASE):
+                renewed.append(job_id)
+
+        runner = JobRunner(app, Recording())
+
+        @runner.job
+        def long_job():
+            runner.renew_lease()
+
+        job_id = runner.queue.put('long_job', [])
+        with app.app_context():
+            runner.run(*runner.queue.claim())
+            runner.renew_lease()
+
+        self.assertEqual(renewed, [job_id])
+
+    def test_survives_queue_errors(self):
+        """does a worker carry on after the queue fails it?"""
+
+        class LockedOnce(MemoryQueue):
+            def claim(queue, lease=jobs.LEASE):
+                if not self.calls:
+                    self.calls.append('locked')
+                    raise sqlite3.OperationalError("database is locked")
+                return super().claim(lease)
+
+        app.config['JOB_WORKERS'] = 1
+        runner = JobRunner(app, LockedOnce())
+
+        @runner.job
+        def record():
+            self.calls.append('ran')
+
+        with self.assertLogs(app.logger.name, 'ERROR'):
+            runner.start()
+            runner.enqueue(record)
+            self.assertTrue(runner.join())
+
+        self.assertEqual(self.calls, ['locked', 'ran'])
@@ -0,0 +1,183 @@
+"""Live update tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_live.py
+
+
+import json
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, live_updates, CURR_USER_KEY
+import live
+import timelines
+from live import Broker
+
+db.drop_all()
+db.create_all()
+
+
+class BrokerTestCase(TestCase):
+    """Test routing events to subscriptions."""
+
+    def test_publish(self):
+        broker = Broker()
+        first = broker.subscribe([1, 2])
+        second = broker.subscribe([2])
+
+        broker.publish(1, {'id': 10})
+        broker.publish(2, {'id': 11})
+        broker.publish(3, {'id': 12})
+
+        self.assertEqual(first.get(0), {'id': 10})
+        self.assertEqual(first.get(0), {'id': 11})
+        self.assertIsNone(first.get(0))
+        self.assertEqual(second.get(0), {'id': 11})
+        self.assertIsNone(second.get(0))
+
+        first.close()
+        first.close()
+        broker.publish(1, {'id': 13})
+        self.assertIsNone(first.get(0))
+        self.assertEqual(broker.subscription_count(), 1)
+
+    def test_overflow(self):
+        broker = Broker()
+        subscription = broker.subscribe([1])
+        for number in range(live.SUBSCRIPTION_QUEUE_SIZE + 1):
+            broker.publish(1, {'id': number})
+
+        self.assertTrue(subscription.overflowed)
+        events = list(live.event_stream(subscription, timeout=1))
+        self.assertEqual(len(events), 1 + live.SUBSCRIPTION_QUEUE_SIZE)
+        self.assertEqual(broker.subscription_count(), 0)
+
+    def test_relay(self):
+        """are events relayed to brokers in other processes?"""
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        # (two brokers in one process stand in for two processes)
+        here = Broker(relay_dir=directory.name)
+        there = Broker(relay_dir=directory.name)
+        subscription = there.subscribe([1])
+
+        here.publish(1, {'id': 10, 'text': "hello"})
+        self.assertEqual(subscription.get(2), {'id': 10, 'text': "hello"})
+
+    def test_event_stream(self):
+        broker = Broker()
+        subscription = broker.subscribe([1])
+        broker.publish(1, {'id': 2})
+
+        stream = live.event_stream(subscription, missed=[{'id': 1}],
+                                   timeout=0.2, heartbeat=0.1)
+        events = list(stream)
+
+        self.assertEqual(events[:3], [
+            f"retry: {live.RECONNECT_DELAY}\n\n",
+            'id: 1\ndata: {"id": 1}\n\n',
+            'id: 2\ndata: {"id": 2}\n\n',
+        ])
+        self.assertIn(": keepalive\n\n", events[3:])
+
+
+class TimelineStreamTestCase(TestCase):
+    """Test the /timeline/stream view."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        u2 = User(email="test2@test2.com", username="testuser2",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u, u2])
+        db.session.commit()
+        db.session.add(Follows(user_following_id=u.id,
+                               user_being_followed_id=u2.id))
+        db.session.commit()
+
+        self.u_id, self.u2_id = u.id, u2.id
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u_id
+
+        self.old_timeout = app.config['LIVE_STREAM_TIMEOUT']
+        app.config['LIVE_STREAM_TIMEOUT'] = 0.2
+
+    def tearDown(self):
+        app.config['LIVE_STREAM_TIMEOUT'] = self.old_timeout
+        db.session.rollback()
+
+    def read_events(self, resp):
+        return [json.loads(line[len('data: '):])
+                for chunk in resp.response
+                for line in chunk.decode().split('\n')
+                if line.startswith('data: ')]
+
+    def test_stream(self):
+        """are followed users' messages pushed, and others' not?"""
+
+        resp = self.client.get('/timeline/stream', buffered=False)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+
+        live_updates.publish(self.u2_id, {'id': 1, 'text': "followed"})
+        live_updates.publish(12345, {'id': 2, 'text': "not followed"})
+
+        self.assertEqual([event['text'] for event in self.read_events(resp)],
+                         ["followed"])
+        resp.close()
+        self.assertEqual(live_updates.subscription_count(), 0)
+
+    def test_replay_missed(self):
+        """does a reconnect get the messages after its Last-Event-ID?"""
+
+        with app.app_context():
+            messages = []
+            for text in ("seen", "missed 1", "missed 2"):
+                msg = Message(text=text, user_id=self.u2_id)
+                db.session.add(msg)
+                db.session.flush()
+                timelines.push_message(msg)
+                messages.append(msg.id)
+                time.sleep(0.01)
+            db.session.commit()
+
+        resp = self.client.get('/timeline/stream', buffered=False,
+                               headers={'Last-Event-ID': str(messages[0])})
+        self.assertEqual([event['text'] for event in self.read_events(resp)],
+                         ["missed 1", "missed 2"])
+        resp.close()
+
+    def test_busy(self):
+        old_max = app.config['LIVE_MAX_STREAMS']
+        app.config['LIVE_MAX_STREAMS'] = 0
+        try:
+            resp = self.client.get('/timeline/stream')
+        finally:
+            app.config['LIVE_MAX_STREAMS'] = old_max
+
+        self.assertEqual(resp.get_data(as_text=True),
+                         f"retry: {live.BUSY_RECONNECT_DELAY}\n\n")
+
+    def test_logged_out(self):
+        resp = app.test_client().get('/timeline/stream')
+        self.assertEqual(resp.status_code, 401)
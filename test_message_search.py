@@ -0,0 +1,59 @@
+"""Message search index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_message_search.py
+
+
+from unittest import TestCase
+
+from message_search import InvertedIndex
+from pagination import decode_rank_cursor, encode_rank_cursor
+
+
+class InvertedIndexTestCase(TestCase):
+    """Test the in-process message text index."""
+
+    def setUp(self):
+        self.index = InvertedIndex.build([
+            (1, 1, "The quick brown fox"),
+            (2, 1, "A lazy brown dog"),
+            (3, 2, "fox fox fox"),
+            (4, 2, "Nothing to see here"),
+        ])
+
+    def ids(self, query, limit=10, position=None):
+        return [message_id for message_id, _
+                in self.index.search(query, limit, position)]
+
+    def test_matches_every_word(self):
+        self.assertEqual(self.ids("brown"), [2, 1])
+        self.assertEqual(self.ids("Brown FOX"), [1])
+        self.assertEqual(self.ids("brown cat"), [])
+
+    def test_ranks_by_relevance(self):
+        self.assertEqual(self.ids("fox"), [3, 1])
+
+    def test_stop_words_only(self):
+        self.assertEqual(self.ids("the a to"), [])
+
+    def test_cursor_pages(self):
+        first = self.index.search("brown", 1)
+        cursor = decode_rank_cursor(encode_rank_cursor(first[0][1],
+                                                       first[0][0]))
+
+        self.assertEqual(self.ids("brown", 1, cursor), [1])
+        self.assertEqual(self.ids("brown", 1, (first[0][1], 1)), [])
+
+    def test_add_and_remove(self):
+        self.index.add(1, 1, "slow green turtle")
+        self.index.add(5, 3, "brown bear")
+        self.index.remove_user(2)
+
+        self.assertEqual(self.ids("brown"), [5, 2])
+        self.assertEqual(self.ids("fox"), [])
+        self.assertEqual(self.ids("turtle"), [1])
+
+    def test_invalid_cursors(self):
+        for cursor in ("", "abc", "1.5", "NaN-3", "1.5-x"):
+            self.assertIsNone(decode_rank_cursor(cursor))
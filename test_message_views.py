@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -32,6 +32,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run background jobs right away, so their effects can be checked
+
+app.config['JOB_WORKERS'] = 0
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -185,3 +189,95 @@ class MessageViewTestCase(TestCase):
             resp = c.get(f"/messages/{msg_id}", follow_redirects=True)
             html = resp.get_data(as_text=True)
             self.assertIn('testmessage', html)
+
+    def test_like_message(self):
+        """Does liking set (not toggle) the user's own like?"""
+
+        user_id = self.testuser.id
+        other = User.query.get(self.testuser2.id)
+        msg = Message(text="likeable", user_id=other.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        # someone else's like mustn't be toggled off by ours
+        db.session.add(Likes(user_id=other.id, message_id=msg_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            for changed in (True, False):
+                resp = c.post(f"/messages/{msg_id}/like", json={"liked": True})
+                self.assertEqual(resp.get_json(), {
+                    "likes": [{"message_id": msg_id, "liked": True,
+                               "changed": changed}],
+                    "likes_count": 1,
+                })
+
+            self.assertEqual(Likes.query.filter_by(message_id=msg_id).count(),
+                             2)
+
+            resp = c.post(f"/messages/{msg_id}/like", json={"liked": False})
+            self.assertEqual(resp.get_json()["likes_count"], 0)
+            self.assertEqual(Likes.query.filter_by(user_id=user_id).count(), 0)
+
+            resp = c.post("/messages/999/like", json={"liked": True})
+            self.assertEqual(resp.status_code, 404)
+
+    def test_batch_likes(self):
+        """Are batches of likes applied together, the last one winning?"""
+
+        user_id = self.testuser.id
+        msgs = [Message(text=f"msg {i}", user_id=self.testuser2.id)
+                for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        ids = [msg.id for msg in msgs]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.post("/messages/likes", json={"likes": [
+                {"message_id": ids[0], "liked": True},
+                {"message_id": ids[1], "liked": True},
+                {"message_id": ids[1], "liked": False},
+                {"message_id": ids[2], "liked": True},
+                {"message_id": 999, "liked": True},
+            ]})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json()["likes_count"], 2)
+            self.assertEqual(
+                {like.message_id for like
+                 in Likes.query.filter_by(user_id=user_id)},
+                {ids[0], ids[2]})
+
+            resp = c.post("/messages/likes", json={"likes": [
+                {"message_id": ids[0], "liked": "yes"}]})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_json_page_likes(self):
+        """Do JSON pages say which messages the viewer likes?"""
+
+        user_id, author_id = self.testuser.id, self.testuser2.id
+        msgs = [Message(text=f"<b>msg {i}</b>", user_id=author_id)
+                for i in range(2)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        ids = [msg.id for msg in msgs]
+        db.session.add(Likes(user_id=user_id, message_id=ids[1]))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            page = c.get(f"/users/{author_id}/messages").get_json()
+
+        self.assertEqual(sorted(msg["id"] for msg in page["messages"]), ids)
+        self.assertEqual(page["liked"], [ids[1]])
+        # text is sent as is: the page escapes it when rendering
+        self.assertIn("<b>msg 0</b>",
+                      [msg["text"] for msg in page["messages"]])
@@ -0,0 +1,114 @@
+"""SQL statement budget tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_counts.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from counters import reconcile_counters
+from timelines import rebuild_timelines
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Most statements any one page may run, however many messages it lists.
+# A lazy load per message (N+1) blows straight through these.
+ROUTE_QUERY_BUDGETS = {
+    '/': 8,
+    '/timeline': 8,
+    '/users/2': 8,
+    '/users/2/messages': 6,
+    '/users/1/likes': 8,
+    '/users/1/following': 8,
+    '/users': 6,
+}
+
+
+class QueryCounter:
+    """Count SQL statements sent to the database while active."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'before_cursor_execute', self)
+
+
+class QueryCountTestCase(TestCase):
+    """Check message lists don't issue a query per message."""
+
+    def setUp(self):
+        """Make u follow and like the messages of a dozen other users."""
+
+        db.drop_all()
+        db.create_all()
+
+        users = [User(email=f"test{i}@test.com", username=f"testuser{i}",
+                      password="HASHED_PASSWORD") for i in range(1, 13)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        u = users[0]
+        for author in users[1:]:
+            u.following.append(author)
+            for i in range(2):
+                msg = Message(text=f"message {i}", user_id=author.id)
+                db.session.add(msg)
+                db.session.flush()
+                db.session.add(Likes(user_id=u.id, message_id=msg.id))
+        db.session.commit()
+        user_id = u.id
+
+        with app.app_context():
+            reconcile_counters()
+            rebuild_timelines()
+            db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def tearDown(self):
+        """ roll back database to original state """
+        db.session.rollback()
+
+    def test_route_query_budgets(self):
+        """do list pages stay within their statement budgets?"""
+
+        for route, budget in ROUTE_QUERY_BUDGETS.items():
+            with self.subTest(route=route):
+                # start each request with nothing cached in the session
+                db.session.expunge_all()
+
+                with QueryCounter() as counter:
+                    resp = self.client.get(route)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertLessEqual(counter.count, budget)
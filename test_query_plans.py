@@ -0,0 +1,134 @@
+"""Query plan regression tests.
+
+These EXPLAIN Warbler's hot queries against a locally seeded database
+(`python seed.py`) and fail if any of them reads a big table with a
+sequential scan, which usually means a missing or unusable index.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+#
+# Set QUERY_PLAN_DATABASE_URL to check a database other than the dev one,
+# and QUERY_PLAN_MAX_SEQ_SCAN_ROWS to change how many rows a table may
+# have before a sequential scan over it counts as a regression.
+
+
+import json
+import os
+from datetime import datetime
+from unittest import TestCase, skipUnless
+
+from sqlalchemy import func
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, point it at the seeded database. These tests
+# only read, so unlike the other test files they never drop any tables.
+
+os.environ['DATABASE_URL'] = os.environ.get('QUERY_PLAN_DATABASE_URL',
+                                            'postgresql:///warbler')
+
+from app import app
+import message_search
+import queries
+import search
+
+MAX_SEQ_SCAN_ROWS = int(os.environ.get('QUERY_PLAN_MAX_SEQ_SCAN_ROWS', 1000))
+
+
+def hot_queries(user_id, message_id):
+    """The queries behind Warbler's busiest pages, keyed by description."""
+
+    position = (datetime.utcnow(), 0)
+
+    return {
+        "users_show page": queries.author_messages(user_id, position),
+
+        "timeline page": queries.timeline_messages(user_id, position),
+
+        "followers": User.query.join(
+            Follows, Follows.user_following_id == User.id).filter(
+            Follows.user_being_followed_id == user_id),
+
+        "following": User.query.join(
+            Follows, Follows.user_being_followed_id == User.id).filter(
+            Follows.user_following_id == user_id),
+
+        "user likes": queries.liked_messages(user_id),
+
+        "message likes": Likes.query.filter(Likes.message_id == message_id),
+
+        "username search": search.database_search_query("use").limit(
+            search.SEARCH_PAGE_SIZE),
+
+        "username typeahead": search.database_typeahead_query("us").limit(
+            search.TYPEAHEAD_LIMIT),
+
+        "message search": message_search.database_search_query("warble"),
+    }
+
+
+def seq_scanned_tables(plan):
+    """Yield the name of every table a plan node reads sequentially."""
+
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan['Relation Name']
+
+    for child in plan.get('Plans', []):
+        yield from seq_scanned_tables(child)
+
+
+@skipUnless(db.engine.dialect.name == 'postgresql',
+            "query plans are only checked on PostgreSQL")
+class QueryPlanTestCase(TestCase):
+    """Check the hot queries are answered with index scans."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Refresh planner statistics and pick ids with plenty of data."""
+
+        db.session.execute("ANALYZE")
+
+        busiest = (db.session.query(Follows.user_being_followed_id)
+                             .group_by(Follows.user_being_followed_id)
+                             .order_by(func.count().desc())
+                             .first())
+        cls.message_id = db.session.query(func.max(Message.id)).scalar()
+
+        if busiest is None or cls.message_id is None:
+            raise cls.failureException(
+                "Seed the database first (python seed.py)")
+
+        cls.user_id = busiest[0]
+
+    def table_rows(self, table):
+        """Planner's estimate of the number of rows in `table`."""
+
+        return db.session.execute(
+            "SELECT reltuples FROM pg_class WHERE relname = :table",
+            {'table': table}).scalar()
+
+    def explain(self, query):
+        """Return the root node of `query`'s JSON query plan."""
+
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+        result = db.engine.execute(f"EXPLAIN (FORMAT JSON) {compiled}",
+                                   compiled.params).scalar()
+
+        if isinstance(result, str):
+            result = json.loads(result)
+
+        return result[0]['Plan']
+
+    def test_no_large_sequential_scans(self):
+        """do hot queries avoid sequential scans of big tables?"""
+
+        for name, query in hot_queries(self.user_id, self.message_id).items():
+            with self.subTest(query=name):
+                plan = self.explain(query)
+                big_scans = [table for table in seq_scanned_tables(plan)
+                             if self.table_rows(table) > MAX_SEQ_SCAN_ROWS]
+
+                self.assertEqual(big_scans, [],
+                                 f"{name} sequentially scans {big_scans}")
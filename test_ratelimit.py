@@ -0,0 +1,165 @@
+"""Rate limiter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from ratelimit import (RateLimiter, MemoryBackend, SqliteBackend,
+                       FailedLoginCache)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, login_limiter
+from models import db
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class RateLimiterTestCase(TestCase):
+    """Test token buckets in each backend."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.backends = [
+            MemoryBackend(),
+            SqliteBackend(os.path.join(self.tmp.name, 'buckets.db')),
+        ]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_burst_then_refuse(self):
+        for backend in self.backends:
+            with self.subTest(backend=type(backend).__name__):
+                limiter = RateLimiter(backend)
+                taken = [limiter.take('ip:1', rate=0.01, burst=3)
+                         for _ in range(5)]
+
+                self.assertEqual(taken, [True, True, True, False, False])
+                self.assertTrue(limiter.take('ip:2', rate=0.01, burst=3))
+
+    def test_refill(self):
+        for backend in self.backends:
+            with self.subTest(backend=type(backend).__name__):
+                limiter = RateLimiter(backend)
+                limiter.take('ip:1', rate=1000, burst=1)
+
+                # a thousand tokens a second: full again almost at once
+                for _ in range(100):
+                    time.sleep(0.001)
+                    if limiter.take('ip:1', rate=1000, burst=1):
+                        break
+                else:
+                    self.fail("bucket never refilled")
+
+    def test_no_refill(self):
+        """does a rate of 0 allow just the burst, without an error?"""
+
+        for backend in self.backends:
+            with self.subTest(backend=type(backend).__name__):
+                limiter = RateLimiter(backend)
+                taken = [limiter.take('ip:1', rate=0, burst=2)
+                         for _ in range(4)]
+
+                self.assertEqual(taken, [True, True, False, False])
+
+    def test_check_without_taking(self):
+        limiter = RateLimiter()
+
+        self.assertTrue(limiter.take('user:bob', rate=0.01, burst=1, cost=0))
+        self.assertTrue(limiter.take('user:bob', rate=0.01, burst=1))
+        self.assertFalse(limiter.take('user:bob', rate=0.01, burst=1,
+                                      cost=0))
+
+
+class FailedLoginCacheTestCase(TestCase):
+    """Test the failed login cache."""
+
+    def test_remembers_failures(self):
+        failures = FailedLoginCache('secret')
+        failures.add('bob', 'wrong')
+
+        self.assertIn(('bob', 'wrong'), failures)
+        self.assertNotIn(('bob', 'right'), failures)
+
+        failures.discard('bob', 'wrong')
+        self.assertNotIn(('bob', 'wrong'), failures)
+
+    def test_usernames_match_exactly(self):
+        """does a failure as "Alice" leave the real "alice" alone?"""
+
+        failures = FailedLoginCache('secret')
+        failures.add('Alice', 'P')
+
+        self.assertIn(('Alice', 'P'), failures)
+        self.assertNotIn(('alice', 'P'), failures)
+        self.assertNotIn(('ALICE', 'P'), failures)
+
+    def test_expiry(self):
+        failures = FailedLoginCache('secret', ttl=-1)
+        failures.add('bob', 'wrong')
+
+        self.assertNotIn(('bob', 'wrong'), failures)
+
+
+class LoginRateLimitTestCase(TestCase):
+    """Test /login limits each client IP separately behind the router."""
+
+    def setUp(self):
+        self.config = dict(app.config)
+        app.config.update(LOGIN_IP_BURST=2, LOGIN_IP_PER_MINUTE=1,
+                          TRUSTED_PROXY_HOPS=1, PASSWORD_HASH_WORKERS=0,
+                          BCRYPT_LOG_ROUNDS=4)
+        self.backend = login_limiter.backend
+        login_limiter.backend = MemoryBackend()
+
+        self.client = app.test_client()
+        self.attempts = 0
+
+    def tearDown(self):
+        app.config.update(self.config)
+        login_limiter.backend = self.backend
+
+    def login(self, forwarded_for):
+        # each attempt for another username, so only the IP limit applies
+        self.attempts += 1
+        resp = self.client.post(
+            '/login',
+            data={'username': f"nobody{self.attempts}",
+                  'password': "wrong-password"},
+            headers={'X-Forwarded-For': forwarded_for},
+            environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        return resp.status_code
+
+    def test_separate_ips(self):
+        self.assertEqual([self.login('198.51.100.1') for _ in range(3)],
+                         [200, 200, 429])
+
+        # another client, through the same router
+        self.assertEqual(self.login('198.51.100.2'), 200)
+
+        # an address the client made up comes before the router's
+        self.assertEqual(self.login('203.0.113.7, 198.51.100.1'), 429)
+
+    def test_without_proxy(self):
+        app.config['TRUSTED_PROXY_HOPS'] = 0
+
+        self.assertEqual([self.login(f'198.51.100.{i}') for i in range(3)],
+                         [200, 200, 429])
@@ -0,0 +1,91 @@
+"""Username search index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import search
+from search import NgramIndex
+
+db.drop_all()
+db.create_all()
+
+
+class NgramIndexTestCase(TestCase):
+    """Test the in-process username index."""
+
+    def setUp(self):
+        self.index = NgramIndex.build([(1, 'xbobx'), (2, 'bobby'), (3, 'bob'),
+                                       (4, 'alice'), (5, 'abob')])
+
+    def test_search_ranks_exact_then_prefix_then_substring(self):
+        self.assertEqual(self.index.search('bob', 10), [3, 2, 5, 1])
+        self.assertEqual(self.index.search('BOB', 2, offset=1), [2, 5])
+
+    def test_short_query(self):
+        self.assertEqual(self.index.search('al', 10), [4])
+
+    def test_prefix(self):
+        self.assertEqual(self.index.prefix('bo', 10), [3, 2])
+        self.assertEqual(self.index.prefix('bo', 1), [3])
+        self.assertEqual(self.index.prefix('z', 10), [])
+
+    def test_add_and_remove(self):
+        self.index.add(2, 'carol')
+        self.index.remove(3)
+
+        self.assertEqual(self.index.search('bob', 10), [5, 1])
+        self.assertEqual(self.index.prefix('c', 10), [2])
+
+
+class DatabaseTypeaheadTestCase(TestCase):
+    """Test the typeahead route answered by the database (as on PostgreSQL)."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add_all([
+            User(email=f"{name}@test.com", username=name,
+                 password="HASHED_PASSWORD")
+            for name in ('Bobby', 'bob', 'BOBCAT', 'abob', 'bo_x', 'boax')])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def typeahead(self, query):
+        with patch.object(search, 'uses_trigram_index', return_value=True):
+            resp = self.client.get('/users/typeahead', query_string={'q': query})
+
+        self.assertEqual(resp.status_code, 200)
+        return [user['username'] for user in resp.get_json()]
+
+    def test_ignores_case(self):
+        self.assertEqual(self.typeahead('bob'), ['bob', 'Bobby', 'BOBCAT'])
+        self.assertEqual(self.typeahead('BOB'), ['bob', 'Bobby', 'BOBCAT'])
+        self.assertEqual(self.typeahead('bObC'), ['BOBCAT'])
+
+    def test_wildcards_match_themselves(self):
+        self.assertEqual(self.typeahead('bo_'), ['bo_x'])
+        self.assertEqual(self.typeahead('%'), [])
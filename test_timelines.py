@@ -0,0 +1,230 @@
+"""Home timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timelines.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import counters
+import timelines
+from pagination import decode_cursor, next_cursor
+
+db.drop_all()
+db.create_all()
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out on write timelines."""
+
+    def setUp(self):
+        """Create two users where u follows u2."""
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        u2 = User(email="test2@test2.com", username="testuser2",
+                  password="HASHED_PASSWORD2")
+
+        db.session.add_all([u, u2])
+        db.session.commit()
+
+        u.following.append(u2)
+        counters.followed(u.id, u2.id)
+        db.session.commit()
+
+        self.u = u
+        self.u2 = u2
+
+    def tearDown(self):
+        """ roll back database to original state """
+        db.session.rollback()
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 10000
+        timelines._high_follower_cache['expires'] = 0
+        self.ctx.pop()
+
+    def post(self, user, text):
+        msg = Message(text=text, user_id=user.id)
+        db.session.add(msg)
+        db.session.flush()
+        timelines.push_message(msg)
+        db.session.commit()
+        return msg
+
+    def test_push_message(self):
+        """is a new message delivered to the author and their followers?"""
+
+        msg = self.post(self.u2, "hello followers")
+
+        self.assertEqual(timelines.read_timeline(self.u.id), [msg])
+        self.assertEqual(timelines.read_timeline(self.u2.id), [msg])
+
+        # u has no followers, so their message stays on their timeline
+        msg2 = self.post(self.u, "hello me")
+        self.assertEqual(timelines.read_timeline(self.u2.id), [msg])
+        self.assertEqual(timelines.read_timeline(self.u.id), [msg2, msg])
+
+    def test_remove_message(self):
+        """is a deleted message removed from every timeline?"""
+
+        msg = self.post(self.u2, "short lived")
+        timelines.remove_message(msg)
+        db.session.commit()
+
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_follow_changes(self):
+        """do follows and unfollows update the follower's timeline?"""
+
+        msg = self.post(self.u2, "before unfollow")
+
+        timelines.remove_followee(self.u.id, self.u2.id)
+        db.session.commit()
+        self.assertEqual(timelines.read_timeline(self.u.id), [])
+
+        timelines.add_followee(self.u.id, self.u2.id)
+        db.session.commit()
+        self.assertEqual(timelines.read_timeline(self.u.id), [msg])
+
+    def test_rerun_delivery(self):
+        """can deliveries be run again (as retried jobs are)?"""
+
+        msg = self.post(self.u2, "delivered twice")
+
+        timelines.push_to_followers(msg)
+        timelines.add_followee(self.u.id, self.u2.id)
+        db.session.commit()
+
+        self.assertEqual(timelines.read_timeline(self.u.id), [msg])
+        self.assertEqual(TimelineEntry.query.count(), 2)
+
+    def test_rebuild_timelines(self):
+        """does a rebuild match what fan-out on write produced?"""
+
+        self.post(self.u, "one")
+        self.post(self.u2, "two")
+        before = {(e.user_id, e.message_id)
+                  for e in TimelineEntry.query.all()}
+
+        count = timelines.rebuild_timelines()
+        db.session.commit()
+        after = {(e.user_id, e.message_id)
+                 for e in TimelineEntry.query.all()}
+
+        self.assertEqual(count, 3)
+        self.assertEqual(before, after)
+
+    def pull(self, user, threshold=0, since_grace=True):
+        """Make `user` pulled, as of PULL_GRACE ago (or just now)."""
+
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = threshold
+        timelines.followers_changed(user.id)
+        if since_grace:
+            (User.query
+                 .filter_by(id=user.id)
+                 .update({'pulled_since': datetime.utcnow() - timedelta(
+                     seconds=timelines.PULL_GRACE + 1)}))
+            db.session.commit()
+        timelines._high_follower_cache['expires'] = 0
+
+    def entries(self, msg):
+        return TimelineEntry.query.filter_by(message_id=msg.id).count()
+
+    def test_hybrid_pull(self):
+        """are high-follower users' messages pulled instead of pushed?"""
+
+        self.pull(self.u2)
+        own = self.post(self.u, "not fanned out either way")
+        msg = self.post(self.u2, "pulled at read time")
+
+        # only the author's own timeline entry was written...
+        self.assertEqual(self.entries(msg), 1)
+
+        # ...but followers still see it, merged in timestamp order
+        self.assertEqual(timelines.read_timeline(self.u.id), [msg, own])
+
+    def test_pull_grace(self):
+        """are a newly pulled user's messages still pushed for a while?"""
+
+        self.pull(self.u2, since_grace=False)
+        msg = self.post(self.u2, "pushed and pulled")
+
+        self.assertEqual(self.entries(msg), 2)
+        self.assertIn(self.u2.id, timelines.high_follower_ids())
+        self.assertEqual(timelines.read_timeline(self.u.id), [msg])
+
+    def test_push_again(self):
+        """are messages posted while pulled delivered once pushed again?"""
+
+        self.pull(self.u2)
+        msg = self.post(self.u2, "posted while pulled")
+        self.assertEqual(self.entries(msg), 1)
+
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 10000
+        timelines.followers_changed(self.u2.id)
+        timelines._high_follower_cache['expires'] = 0
+
+        self.assertIsNone(User.query.get(self.u2.id).pulled_since)
+        self.assertEqual(self.entries(msg), 2)
+        self.assertEqual(timelines.read_timeline(self.u.id), [msg])
+
+    def test_hysteresis(self):
+        """does a user near the threshold stay put?"""
+
+        def pulled():
+            return User.query.get(self.u2.id).pulled_since is not None
+
+        # one follower: not over a threshold of 1
+        self.pull(self.u2, threshold=1, since_grace=False)
+        self.assertFalse(pulled())
+
+        self.pull(self.u2, threshold=0, since_grace=False)
+        self.assertTrue(pulled())
+
+        # back at the threshold, but not under 90% of it
+        self.pull(self.u2, threshold=1, since_grace=False)
+        self.assertTrue(pulled())
+
+        self.pull(self.u2, threshold=2, since_grace=False)
+        self.assertFalse(pulled())
+
+    def test_cursor_pages(self):
+        """do cursor pages cover the timeline without gaps or repeats?"""
+
+        posted = [self.post(self.u2, f"message {i}") for i in range(5)]
+
+        seen = []
+        position = None
+        while True:
+            page = timelines.read_timeline(self.u.id, limit=2,
+                                           position=position)
+            seen.extend(page)
+            cursor = next_cursor(page, page_size=2)
+            if cursor is None:
+                break
+            position = decode_cursor(cursor)
+
+        self.assertEqual([msg.id for msg in seen],
+                         [msg.id for msg in reversed(posted)])
+        self.assertIsNone(decode_cursor("not-a-cursor"))
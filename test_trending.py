@@ -0,0 +1,98 @@
+"""Trending tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+from unittest import TestCase
+
+from trending import CountMinSketch, Trending, hashtags
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class HashtagsTestCase(TestCase):
+    def test_hashtags(self):
+        self.assertEqual(hashtags("Go #Python #python and #web_dev!"),
+                         {'python', 'web_dev'})
+        self.assertEqual(hashtags("no tags # here"), set())
+
+
+class CountMinSketchTestCase(TestCase):
+    def test_never_underestimates(self):
+        sketch = CountMinSketch(width=16, depth=3)
+        counts = {}
+        for i in range(500):
+            key = f"key{i % 40}"
+            counts[key] = counts.get(key, 0) + 1
+            sketch.add(key, 1)
+
+        for key, count in counts.items():
+            self.assertGreaterEqual(sketch.estimate(key), count)
+
+    def test_exact_without_collisions(self):
+        sketch = CountMinSketch()
+        self.assertEqual(sketch.add('a', 2), 2)
+        self.assertEqual(sketch.add('a', 3), 5)
+        self.assertEqual(sketch.estimate('b'), 0)
+
+
+class TrendingTestCase(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.trending = Trending(half_life=60, capacity=3, clock=self.clock)
+
+    def add(self, key, times):
+        for _ in range(times):
+            self.trending.add(key)
+
+    def test_top(self):
+        self.add('a', 3)
+        self.add('b', 5)
+        self.add('c', 1)
+
+        top = self.trending.top(2)
+        self.assertEqual([key for key, _ in top], ['b', 'a'])
+        self.assertAlmostEqual(top[0][1], 5)
+
+    def test_evicts_lowest(self):
+        self.add('a', 3)
+        self.add('b', 5)
+        self.add('c', 1)
+        self.add('d', 2)
+
+        self.assertEqual([key for key, _ in self.trending.top()],
+                         ['b', 'a', 'd'])
+
+    def test_decay(self):
+        self.add('old', 4)
+        self.clock.now += 120
+        self.add('new', 2)
+
+        top = self.trending.top()
+        self.assertEqual([key for key, _ in top], ['new', 'old'])
+        self.assertAlmostEqual(top[1][1], 1)
+
+    def test_rescale(self):
+        self.add('a', 2)
+        self.clock.now += 60 * 100
+        self.add('b', 1)
+
+        top = self.trending.top()
+        self.assertEqual(top[0][0], 'b')
+        self.assertAlmostEqual(top[0][1], 1)
+        self.assertLess(top[1][1], 1e-20)
+
+    def test_discard(self):
+        self.add('a', 3)
+        self.add('b', 1)
+        self.trending.discard('a')
+
+        self.assertEqual([key for key, _ in self.trending.top()], ['b'])
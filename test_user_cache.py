@@ -0,0 +1,156 @@
+"""Logged-in user loading and caching tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_user_cache.py
+
+
+import os
+from unittest import TestCase
+
+from flask_bcrypt import Bcrypt
+from sqlalchemy import event
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, user_cache
+from user_cache import UserCache
+
+db.drop_all()
+db.create_all()
+
+bcrypt = Bcrypt()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['JOB_WORKERS'] = 0
+
+
+class QueryCounter:
+    """Count SQL statements sent to the database while active."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'before_cursor_execute', self)
+
+
+class UserCacheTestCase(TestCase):
+    """Test the lazy g.user, and the cache of profile rows behind it."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        # With lowered (minimum) work factor!
+        pw_hash = bcrypt.generate_password_hash('HASHED_PASSWORD', 4)
+        u = User(email="test@test.com", username="testuser",
+                 password=pw_hash.decode('utf-8'))
+        db.session.add(u)
+        db.session.commit()
+        self.user_id = u.id
+
+        self.client = app.test_client()
+        user_cache.ttl = 60
+        user_cache.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+        user_cache.ttl = app.config['USER_CACHE_TTL']
+        user_cache.clear()
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_lazy_user(self):
+        """do requests that never use g.user skip loading it?"""
+
+        with QueryCounter() as counter:
+            resp = self.client.get('/')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(counter.count, 0)
+
+        self.login(self.client)
+        with QueryCounter() as counter:
+            resp = self.client.get('/static/stylesheets/style.css')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(counter.count, 0)
+
+    def test_ttl(self):
+        """are rows served from the cache until they expire?"""
+
+        now = [1000.0]
+        cache = UserCache(ttl=10, clock=lambda: now[0])
+
+        with app.app_context():
+            self.assertEqual(cache.get(self.user_id).username, "testuser")
+
+            # changed behind the cache's back
+            (User.query.filter_by(id=self.user_id)
+                       .update({'username': "renamed"}))
+            db.session.commit()
+            db.session.expunge_all()
+
+            now[0] += 9
+            self.assertEqual(cache.get(self.user_id).username, "testuser")
+            db.session.expunge_all()
+
+            now[0] += 2
+            self.assertEqual(cache.get(self.user_id).username, "renamed")
+
+            # cached again from the fresh row
+            with QueryCounter() as counter:
+                db.session.expunge_all()
+                self.assertEqual(cache.get(self.user_id).username, "renamed")
+            self.assertEqual(counter.count, 0)
+
+    def test_profile_invalidates(self):
+        """does editing a profile drop the cached row?"""
+
+        self.login(self.client)
+        resp = self.client.get('/users/profile')
+        self.assertIn(self.user_id, user_cache._rows)
+
+        self.client.post('/users/profile', data={
+            'username': "renamed",
+            'email': "test@test.com",
+            'password': "HASHED_PASSWORD"})
+        self.assertNotIn(self.user_id, user_cache._rows)
+
+        resp = self.client.get('/users/profile')
+        self.assertIn('value="renamed"', resp.get_data(as_text=True))
+
+    def test_delete_invalidates(self):
+        """is a deleted user logged out of other sessions at once?"""
+
+        other = app.test_client()
+        self.login(other)
+        self.login(self.client)
+
+        resp = other.get('/users/profile')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(self.user_id, user_cache._rows)
+
+        self.client.post('/users/delete')
+        self.assertNotIn(self.user_id, user_cache._rows)
+
+        resp = other.get('/users/profile')
+        self.assertEqual(resp.status_code, 302)
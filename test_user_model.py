@@ -86,6 +86,17 @@ class UserModelTestCase(TestCase):
         self.assertFalse(self.u.is_followed_by(self.u2))
         self.assertTrue(self.u2.is_followed_by(self.u))
 
+    def test_following_ids_among(self):
+        "does the batch following check match is_following?"
+
+        self.u.following.append(self.u2)
+        db.session.commit()
+
+        self.assertEqual(self.u.following_ids_among([self.u.id, self.u2.id]),
+                         {self.u2.id})
+        self.assertEqual(self.u2.following_ids_among([self.u.id]), set())
+        self.assertEqual(self.u.following_ids_among([]), set())
+
     def test_create_user_success(self):
         "does creating a user... create a user?"
 
@@ -122,3 +133,17 @@ class UserModelTestCase(TestCase):
         # incorrect logins, bad username, then bad pw
         self.assertFalse(User.authenticate('Bobb', 'bobword'))
         self.assertFalse(User.authenticate('Bob', 'bobbword'))
+
+    def test_authentication_upgrades_old_hashes(self):
+        " does logging in rehash a password made with an old work factor?"
+
+        user = User(username="Old",
+                    email="old@old.com",
+                    password=bcrypt.generate_password_hash(
+                        'oldword', 4).decode('utf-8'))
+        db.session.add(user)
+        db.session.commit()
+
+        self.assertTrue(User.authenticate('Old', 'oldword'))
+        self.assertTrue(user.password.startswith('$2b$12$'))
+        self.assertTrue(User.authenticate('Old', 'oldword'))
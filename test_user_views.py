@@ -6,6 +6,7 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 from flask_bcrypt import Bcrypt
 from flask import g, session
@@ -35,6 +36,10 @@ bcrypt = Bcrypt()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run background jobs right away, so their effects can be checked
+
+app.config['JOB_WORKERS'] = 0
+
 
 class UserViewTests(TestCase):
     """ Test routes related to user functions """
@@ -147,6 +152,28 @@ class UserViewTests(TestCase):
             self.assertIn('<h4 id="sidebar-username">@testuser</h4>', html)
             self.assertIn('<ul class="user-stats nav nav-pills">', html)
 
+    def test_user_page_not_modified(self):
+        """is a user page revalidated by ETag, until what it shows changes?"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2.id
+
+            resp = client.get('/users/1')
+            etag = resp.headers['ETag']
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+
+            resp = client.get('/users/1', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            client.post('/users/follow/1')
+
+            resp = client.get('/users/1', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+            self.assertIn('Unfollow', resp.get_data(as_text=True))
+
     def test_user_following(self):
         """does the list of users you follow load correctly?"""
 
@@ -169,6 +196,23 @@ class UserViewTests(TestCase):
             self.assertEqual(resp.status, '200 OK')
             self.assertIn('<div class="alert alert-danger">Access unauthorized.</div>', html)
 
+    def test_deleted_user_not_listed(self):
+        """are deleted accounts left out of following/followers lists?"""
+
+        user1 = User.query.get_or_404(1)
+        user2 = User.query.get_or_404(2)
+        user1.following.append(user2)
+        user2.following.append(user1)
+        user2.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = '1'
+            for url in ['/users/1/following', '/users/1/followers']:
+                html = client.get(url).get_data(as_text=True)
+                self.assertNotIn('<p>@testuser2</p>', html)
+
     def test_user_followers(self):
         """does the list of users following you load correctly?"""
 
@@ -0,0 +1,340 @@
+"""Precomputed home timelines for Warbler.
+
+Timelines are hybrid push/pull:
+
+- a message from a normal user is copied into the timeline of its author
+  and of each of the author's followers when it is posted (push);
+- a message from a user with more than TIMELINE_FANOUT_THRESHOLD followers
+  is only written to the author's own timeline, and is merged into
+  followers' feeds when they are read (pull).
+
+That keeps posting cheap for high-follower accounts while building the
+homepage stays a few index range scans.
+
+Which users are pulled is recorded in `users.pulled_since`, which both
+sides go by, so no message is left neither pushed nor pulled:
+
+- a user is pulled once they have more than the threshold of followers,
+  and pushed again only once they're back under PUSH_AGAIN_RATIO of it,
+  so accounts hovering around the threshold don't flip back and forth;
+- readers pull the users in `high_follower_ids`, a set each process
+  caches for HIGH_FOLLOWER_TTL seconds, so a newly pulled user's messages
+  are still pushed for PULL_GRACE seconds, until every cache has them;
+- a user switched back to pushed first has the messages they posted
+  while pulled delivered to their followers (`push_again`), and is only
+  then taken out of the pulled set.
+
+After changing TIMELINE_FANOUT_THRESHOLD, run `flask backfill-timelines`
+so existing timelines match the new split.
+"""
+
+import heapq
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import select, literal, exists
+
+from models import db, User, Follows, Message, TimelineEntry
+from pagination import PAGE_SIZE
+import queries
+
+DEFAULT_FANOUT_THRESHOLD = 10000
+
+# How long the set of pulled users is reused before recomputing it, and
+# how long a newly pulled user's messages are pushed as well (a margin
+# over the TTL, for clock differences between hosts)
+HIGH_FOLLOWER_TTL = 60
+PULL_GRACE = 2 * HIGH_FOLLOWER_TTL
+
+# Pulled users are pushed again under this fraction of the threshold
+PUSH_AGAIN_RATIO = 0.9
+
+_high_follower_cache = {'expires': 0, 'ids': frozenset()}
+
+
+def fanout_threshold():
+    """Return the follower count above which messages are pulled, not pushed."""
+
+    return current_app.config.get('TIMELINE_FANOUT_THRESHOLD',
+                                  DEFAULT_FANOUT_THRESHOLD)
+
+
+def is_high_follower(user_id):
+    """Can `user_id`'s messages be left for readers to pull?
+
+    Only once they've been pulled for PULL_GRACE seconds, by when every
+    reader's `high_follower_ids` includes them.
+    """
+
+    pulled_since = (db.session.query(User.pulled_since)
+                              .filter(User.id == user_id)
+                              .scalar())
+    return (pulled_since is not None and
+            pulled_since <= datetime.utcnow() - timedelta(seconds=PULL_GRACE))
+
+
+def high_follower_ids():
+    """Return the ids of every pulled user.
+
+    The set is recomputed at most every HIGH_FOLLOWER_TTL seconds.
+    """
+
+    cache = _high_follower_cache
+
+    if cache['expires'] < time.time():
+        rows = (db.session.query(User.id)
+                          .filter(User.pulled_since.isnot(None)))
+        cache['ids'] = frozenset(user_id for (user_id,) in rows)
+        cache['expires'] = time.time() + HIGH_FOLLOWER_TTL
+
+    return cache['ids']
+
+
+def followers_changed(user_id):
+    """Switch `user_id` between pushed and pulled, if their followers
+    have crossed the threshold. Commits.
+    """
+
+    row = (db.session.query(User.followers_count, User.pulled_since)
+                     .filter(User.id == user_id)
+                     .first())
+    if row is None:
+        return
+
+    followers, pulled_since = row
+    threshold = fanout_threshold()
+
+    if pulled_since is None and followers > threshold:
+        (User.query
+             .filter(User.id == user_id, User.pulled_since.is_(None))
+             .update({User.pulled_since: datetime.utcnow()},
+                     synchronize_session=False))
+        db.session.commit()
+
+    elif (pulled_since is not None
+          and followers < threshold * PUSH_AGAIN_RATIO):
+        push_again(user_id)
+
+
+def push_again(user_id):
+    """Switch pulled `user_id` back to pushed. Commits; can run again.
+
+    The messages they posted while pulled are delivered to their
+    followers before they leave the pulled set (readers pull them until
+    then), and once more after, for any posted in between.
+    """
+
+    pulled_since = (db.session.query(User.pulled_since)
+                              .filter(User.id == user_id)
+                              .scalar())
+    if pulled_since is None:
+        return
+
+    _push_posted_since(user_id, pulled_since)
+    db.session.commit()
+
+    (User.query
+         .filter(User.id == user_id, User.pulled_since == pulled_since)
+         .update({User.pulled_since: None}, synchronize_session=False))
+    db.session.commit()
+
+    _push_posted_since(user_id, pulled_since)
+    db.session.commit()
+
+
+def _push_posted_since(user_id, since):
+    """Deliver `user_id`'s messages since `since` to their followers."""
+
+    messages = (select([Follows.user_following_id,
+                        Message.id,
+                        Message.timestamp])
+                .where(Follows.user_being_followed_id == user_id)
+                .where(Message.user_id == user_id)
+                .where(Message.timestamp >= since)
+                .where(~_has_entry(Follows.user_following_id, Message.id)))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], messages))
+
+
+def push_message(message):
+    """Deliver a new `message` to its author's and followers' timelines.
+
+    The message must already be flushed (so it has an id and timestamp).
+    """
+
+    push_to_author(message)
+    push_to_followers(message)
+
+
+def push_to_author(message):
+    """Deliver a new `message` to its author's own timeline."""
+
+    db.session.add(TimelineEntry(user_id=message.user_id,
+                                 message_id=message.id,
+                                 timestamp=message.timestamp))
+
+
+def push_to_followers(message):
+    """Deliver `message` to its author's followers' timelines.
+
+    Followers who already have it are skipped, so this can be run again
+    (as a background job is, after a failure).
+    """
+
+    if is_high_follower(message.user_id):
+        return
+
+    followers = (select([Follows.user_following_id,
+                         literal(message.id),
+                         literal(message.timestamp)])
+                 .where(Follows.user_being_followed_id == message.user_id)
+                 .where(~_has_entry(Follows.user_following_id,
+                                    literal(message.id))))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], followers))
+
+
+def remove_message(message):
+    """Remove `message` from every timeline it was delivered to."""
+
+    (TimelineEntry.query
+                  .filter(TimelineEntry.message_id == message.id)
+                  .delete(synchronize_session=False))
+
+
+def add_followee(user_id, followee_id):
+    """Copy `followee_id`'s existing messages into `user_id`'s timeline.
+
+    Messages already there are skipped, so this can be run again.
+    """
+
+    if is_high_follower(followee_id):
+        return
+
+    messages = (select([literal(user_id), Message.id, Message.timestamp])
+                .where(Message.user_id == followee_id)
+                .where(~_has_entry(literal(user_id), Message.id)))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], messages))
+
+
+def _has_entry(user_id, message_id):
+    """EXISTS clause: is the message already in the user's timeline?"""
+
+    return (exists().where(TimelineEntry.user_id == user_id)
+                    .where(TimelineEntry.message_id == message_id))
+
+
+def remove_followee(user_id, followee_id):
+    """Drop `followee_id`'s messages from `user_id`'s timeline."""
+
+    followee_messages = (db.session.query(Message.id)
+                                   .filter(Message.user_id == followee_id))
+
+    (TimelineEntry.query
+                  .filter(TimelineEntry.user_id == user_id,
+                          TimelineEntry.message_id.in_(followee_messages))
+                  .delete(synchronize_session=False))
+
+
+def read_timeline(user_id, limit=PAGE_SIZE, position=None):
+    """Return a page of `limit` messages from `user_id`'s timeline.
+
+    `position` is a decoded pagination cursor; the page holds the newest
+    messages older than it (or the newest overall if it's None).
+
+    Pushed entries are merged with the recent messages of any followed
+    high-follower users using a k-way heap merge; each input is already
+    sorted newest first, so only `limit` messages are ever compared.
+    """
+
+    pushed = queries.timeline_messages(user_id, position, limit).all()
+
+    pulled_ids = _followed_high_follower_ids(user_id)
+    if not pulled_ids:
+        return pushed
+
+    streams = [pushed] + [
+        queries.author_messages(author_id, position, limit).all()
+        for author_id in pulled_ids
+    ]
+
+    merged = heapq.merge(*streams,
+                         key=lambda msg: (msg.timestamp, msg.id),
+                         reverse=True)
+
+    return list(islice(_unique_messages(merged), limit))
+
+
+def _followed_high_follower_ids(user_id):
+    """Return the high-follower users that `user_id` follows."""
+
+    high_ids = high_follower_ids()
+    if not high_ids:
+        return []
+
+    return [followed_id for (followed_id,) in
+            (db.session.query(Follows.user_being_followed_id)
+                       .filter(Follows.user_following_id == user_id,
+                               Follows.user_being_followed_id.in_(high_ids)))]
+
+
+def _unique_messages(messages):
+    """Skip repeats (a message can be both pushed and pulled)."""
+
+    seen = set()
+    for msg in messages:
+        if msg.id not in seen:
+            seen.add(msg.id)
+            yield msg
+
+
+def rebuild_timelines():
+    """Rebuild every timeline from the `follows` and `messages` tables.
+
+    Used to backfill timelines for data that predates them (or was loaded
+    with seed.py). Users above the threshold are marked pulled (and those
+    under it pushed), and their messages only written to their own
+    timelines. Returns the number of timeline entries written.
+    """
+
+    threshold = fanout_threshold()
+    (User.query
+         .filter(User.followers_count > threshold,
+                 User.pulled_since.is_(None))
+         .update({User.pulled_since: datetime.utcnow()},
+                 synchronize_session=False))
+    (User.query
+         .filter(User.followers_count <= threshold,
+                 User.pulled_since.isnot(None))
+         .update({User.pulled_since: None}, synchronize_session=False))
+
+    TimelineEntry.query.delete(synchronize_session=False)
+    _high_follower_cache['expires'] = 0
+
+    own = select([Message.user_id, Message.id, Message.timestamp])
+
+    followed = (select([Follows.user_following_id,
+                        Message.id,
+                        Message.timestamp])
+                .where(Follows.user_being_followed_id == Message.user_id))
+
+    high_ids = high_follower_ids()
+    if high_ids:
+        followed = followed.where(~Message.user_id.in_(high_ids))
+
+    columns = ['user_id', 'message_id', 'timestamp']
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(columns, own))
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(columns, followed))
+
+    return TimelineEntry.query.count()
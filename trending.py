@@ -0,0 +1,204 @@
+"""Trending hashtags and warbles, from time-decayed counts.
+
+Every hashtag posted and every like counts towards what's trending, with
+exponentially decaying weight: a count loses half its weight every
+TRENDING_HALF_LIFE seconds, so the counts are a smooth sliding window
+over recent activity. Decay is "forward": rather than shrinking every
+count as time passes, each new count is added with weight
+exp((now - landmark) / tau), which grows over time, and the scale is
+reset (everything multiplied down) once in a long while.
+
+Counting every hashtag and message exactly would take memory growing
+with all the content ever posted, so counts go in a `CountMinSketch` of
+fixed size, and only the top `capacity` keys are tracked exactly, in a
+dict with a min-heap to find the one to evict. Reads only sort that
+small dict, so they take microseconds.
+
+Counts are kept per process, from the posts and likes that process
+handles: with several workers, each sees a sample of the traffic, which
+ranks the same. Unlikes aren't subtracted.
+"""
+
+import heapq
+import math
+import os
+import re
+import threading
+import time
+from array import array
+
+from models import Message
+import queries
+
+TRENDING_HALF_LIFE = float(os.environ.get('TRENDING_HALF_LIFE', 3600))
+
+HASHTAG_RE = re.compile(r"#(\w{1,50})")
+
+# Rescale the weights when they grow past exp(RESCALE_AT)
+RESCALE_AT = 64
+
+
+def hashtags(text):
+    """The distinct hashtags in `text`, lowercased, without the '#'."""
+
+    return {tag.lower() for tag in HASHTAG_RE.findall(text)}
+
+
+class CountMinSketch:
+    """Approximate counts of any number of keys, in fixed memory.
+
+    Each key adds to one counter in each of `depth` rows, picked by a
+    different hash per row; its count is the smallest of those counters,
+    which can only overestimate (by colliding keys' counts). Updates are
+    conservative: counters already above the new estimate are left
+    alone, which keeps overestimates smaller.
+    """
+
+    def __init__(self, width=4096, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('d', [0.0]) * width for _ in range(depth)]
+
+    def _cells(self, key):
+        return [hash((row, key)) % self.width for row in range(self.depth)]
+
+    def add(self, key, amount):
+        """Count `amount` more of `key`; return its new estimate."""
+
+        cells = self._cells(key)
+        estimate = min(row[cell]
+                       for row, cell in zip(self.rows, cells)) + amount
+        for row, cell in zip(self.rows, cells):
+            if row[cell] < estimate:
+                row[cell] = estimate
+        return estimate
+
+    def estimate(self, key):
+        return min(row[cell] for row, cell in zip(self.rows, self._cells(key)))
+
+    def scale(self, factor):
+        for index, row in enumerate(self.rows):
+            self.rows[index] = array('d', (count * factor for count in row))
+
+
+class Trending:
+    """The `capacity` keys with the highest time-decayed counts."""
+
+    def __init__(self, half_life=TRENDING_HALF_LIFE, capacity=100,
+                 clock=time.time):
+        self.tau = half_life / math.log(2)
+        self.capacity = capacity
+        self.clock = clock
+        self.landmark = clock()
+        self.sketch = CountMinSketch()
+
+        # {key: score} of the top keys, and a min-heap of (score, key)
+        # that may hold stale entries for keys whose score has moved on
+        self._scores = {}
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def add(self, key, amount=1):
+        with self._lock:
+            exponent = (self.clock() - self.landmark) / self.tau
+            if exponent > RESCALE_AT:
+                self._rescale()
+                exponent = 0
+
+            score = self.sketch.add(key, amount * math.exp(exponent))
+
+            if key in self._scores or len(self._scores) < self.capacity:
+                self._set(key, score)
+            else:
+                lowest, lowest_key = self._lowest()
+                if score > lowest:
+                    del self._scores[lowest_key]
+                    self._set(key, score)
+
+    def discard(self, key):
+        """Stop tracking `key` (e.g. a deleted message)."""
+
+        with self._lock:
+            self._scores.pop(key, None)
+
+    def top(self, limit=10):
+        """[(key, decayed count)] of the top `limit` keys, highest first."""
+
+        with self._lock:
+            decay = math.exp(-(self.clock() - self.landmark) / self.tau)
+            best = heapq.nlargest(limit, self._scores.items(),
+                                  key=lambda item: item[1])
+
+        return [(key, score * decay) for key, score in best]
+
+    def _set(self, key, score):
+        self._scores[key] = score
+        heapq.heappush(self._heap, (score, key))
+        if len(self._heap) > 4 * self.capacity:
+            self._rebuild_heap()
+
+    def _lowest(self):
+        """(score, key) of the lowest tracked key."""
+
+        while True:
+            score, key = self._heap[0]
+            if self._scores.get(key) == score:
+                return score, key
+            heapq.heappop(self._heap)
+
+    def _rebuild_heap(self):
+        self._heap = [(score, key) for key, score in self._scores.items()]
+        heapq.heapify(self._heap)
+
+    def _rescale(self):
+        now = self.clock()
+        factor = math.exp(-(now - self.landmark) / self.tau)
+        self.sketch.scale(factor)
+        self._scores = {key: score * factor
+                        for key, score in self._scores.items()}
+        self._rebuild_heap()
+        self.landmark = now
+
+
+##############################################################################
+# The process's counts
+
+
+trending_hashtags = Trending()
+trending_messages = Trending()
+
+
+def message_added(message):
+    """Count a new message's hashtags."""
+
+    for tag in hashtags(message.text):
+        trending_hashtags.add(tag)
+
+
+def message_liked(message_id):
+    """Count a new like."""
+
+    trending_messages.add(message_id)
+
+
+def message_removed(message_id):
+    trending_messages.discard(message_id)
+
+
+def top_hashtags(limit=10):
+    """[(hashtag, decayed count)], most trending first."""
+
+    return trending_hashtags.top(limit)
+
+
+def top_messages(limit=10):
+    """The most trending messages (with their authors), most first."""
+
+    ids = [message_id for message_id, _ in trending_messages.top(limit)]
+    if not ids:
+        return []
+
+    found = {message.id: message
+             for message in queries.with_authors(Message.query)
+                                   .filter(Message.id.in_(ids))}
+    return [found[message_id] for message_id in ids if message_id in found]
@@ -0,0 +1,81 @@
+"""Optional in-process TTL cache of user profile rows.
+
+Nearly every page renders the logged-in user's name and picture, so caching
+their profile row for a few seconds saves a query per request. Only the
+profile columns are cached: counters (and the password hash) are left
+unloaded on the returned user and load from the database if a page uses
+them.
+
+Each worker process has its own cache, and invalidation is local to the
+process, so other workers can serve a profile up to `ttl` seconds stale
+after an edit. A `ttl` of 0 disables caching.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, User
+
+PROFILE_COLUMNS = ('id', 'email', 'username', 'image_url', 'header_image_url',
+                   'bio', 'location', 'deleted_at')
+
+
+class UserCache:
+    """LRU cache of user profile rows that expire after `ttl` seconds.
+
+    `clock` returns the time in seconds (time.monotonic by default).
+    """
+
+    def __init__(self, ttl=0, maxsize=10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Return the user with `user_id` (attached to the session), or None."""
+
+        if not self.ttl:
+            return User.query.get(user_id)
+
+        with self._lock:
+            entry = self._rows.get(user_id)
+            if entry is not None and entry[0] > self.clock():
+                self._rows.move_to_end(user_id)
+                return self._attach(entry[1])
+
+        user = User.query.get(user_id)
+        if user is not None:
+            self._store(user)
+
+        return user
+
+    def invalidate(self, user_id):
+        """Forget the cached profile of `user_id` (after it changes)."""
+
+        with self._lock:
+            self._rows.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+
+    def _store(self, user):
+        row = {column: getattr(user, column) for column in PROFILE_COLUMNS}
+
+        with self._lock:
+            self._rows[user.id] = (self.clock() + self.ttl, row)
+            self._rows.move_to_end(user.id)
+            while len(self._rows) > self.maxsize:
+                self._rows.popitem(last=False)
+
+    def _attach(self, row):
+        """Turn a cached row into a persistent User without a query."""
+
+        user = User(**row)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)